@@ -0,0 +1,238 @@
+"""
+Track every actor a run spawns and always clean up, even after a crash.
+
+The scripts used to end with `camera.destroy()` and then `apply_batch()` of
+`actor_list`, which destroys the camera twice, and raises NameError in the
+`finally` block when spawning failed before `camera` or `world` were set, so the
+actors leaked and the server stayed in synchronous mode. The `ActorRegistry`
+is a context manager instead:
+
+  with ActorRegistry(client, endpoint='127.0.0.1:2000') as actors:
+    actors.enable_sync(0.04, tm)
+    main_vehicle = actors.spawn(bp, transform)
+    camera = actors.spawn(camera_bp, camera_transform, attach_to=main_vehicle)
+    actors.track(spawn_npcs(client, actors.world, 100))
+    ...
+  # Sensors stopped, everything destroyed in one `apply_batch_sync`, async again.
+
+`on_close()` adds cleanup that has to happen before that, e.g. joining the
+thread that ticks the world.
+
+Actors that a killed run (SIGKILL, a crashed server connection) could not
+destroy would stay on the shared server and slow every later run down. So each
+registry keeps a small ledger of its actor ids in `LEDGER_DIR`, and a new
+registry first reaps the actors of the ledgers whose process is gone.
+"""
+
+import itertools
+import json
+import os
+import socket
+import types
+from pathlib import Path
+
+try:
+  import carla
+except ImportError:  # Only a fake client works without the CARLA client.
+  carla = None
+
+LEDGER_DIR = Path(os.path.abspath(os.path.dirname(__file__))) / '..' / 'tmp' / 'actor_registry'
+
+_ledger_ids = itertools.count()
+
+
+def destroy_command(actor_id):
+  if carla is None:
+    return types.SimpleNamespace(actor_id=actor_id)
+  return carla.command.DestroyActor(actor_id)
+
+
+def _pid_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True
+  return True
+
+
+def _restore_async(world, tm=None):
+  settings = world.get_settings()
+  settings.synchronous_mode = False
+  settings.fixed_delta_seconds = None
+  world.apply_settings(settings)
+  if tm is not None:
+    tm.set_synchronous_mode(False)
+
+
+def destroy_actors(client, actor_ids):
+  """Destroy `actor_ids` in one `apply_batch_sync`, returns how many failed."""
+  if not actor_ids:
+    return 0
+  failed = 0
+  for response in client.apply_batch_sync([destroy_command(i) for i in actor_ids], False):
+    if response.error:
+      failed += 1
+  return failed
+
+
+def reap_orphans(client, endpoint=None, ledger_dir=LEDGER_DIR):
+  """Destroy the actors left by dead runs against `endpoint`, returns how many.
+
+  An id is only destroyed if the actor still has the type it was spawned with,
+  in case the server restarted and gave the id to someone else. If a dead run
+  had put the server in synchronous mode, it goes back to asynchronous, but
+  only when no live run has a ledger for `endpoint`: that run may be ticking
+  the world in synchronous mode itself.
+  """
+  ledger_dir = Path(ledger_dir)
+  if not ledger_dir.is_dir():
+    return 0
+  ledgers = []
+  for path in ledger_dir.glob('*.json'):
+    try:
+      with open(path) as f:
+        ledger = json.load(f)
+    except (OSError, ValueError):
+      continue  # Being written, or not ours.
+    if ledger.get('endpoint') == endpoint:
+      ledgers.append((path, ledger))
+  # Whether a process of another host is alive is unknown, so it counts as live.
+  dead = [(path, ledger) for path, ledger in ledgers
+          if ledger.get('host') == socket.gethostname() and not _pid_alive(ledger['pid'])]
+  live = len(ledgers) - len(dead)
+  if not dead:
+    return 0
+  world = client.get_world()
+  reaped = 0
+  synchronous = False
+  for path, ledger in dead:
+    spawned = {int(i): t for i, t in ledger['actors'].items()}
+    alive = [a.id for a in world.get_actors(list(spawned)) if spawned.get(a.id) == a.type_id]
+    destroy_actors(client, alive)
+    synchronous |= bool(ledger.get('synchronous'))
+    path.unlink()
+    reaped += len(alive)
+  if reaped:
+    print(f'Reaped {reaped} actors left by crashed runs.')
+  if synchronous and world.get_settings().synchronous_mode:
+    if live:
+      print(f'A crashed run left {endpoint} in synchronous mode, kept since '
+            f'{live} live run(s) use it.')
+    else:
+      _restore_async(world)
+      print(f'A crashed run left {endpoint} in synchronous mode, back to asynchronous.')
+  return reaped
+
+
+class ActorRegistry:
+  """Owns the actors and the synchronous mode of one run."""
+
+  def __init__(self, client, endpoint=None, reap=True, ledger_dir=LEDGER_DIR):
+    """`endpoint` ('host:port') tells apart the ledgers of different servers."""
+    self.client = client
+    self.world = client.get_world()
+    self.endpoint = endpoint
+    self.reap = reap
+    self.ledger_dir = Path(ledger_dir)
+    self._ledger = self.ledger_dir / f'{os.getpid()}_{next(_ledger_ids)}.json'
+    self._actors = []  # Spawn order, sensors are usually last
+    self._settings = None  # What to go back to, once synchronous mode is on
+    self._tm = None
+    self._callbacks = []
+
+  def __enter__(self):
+    if self.reap:
+      reap_orphans(self.client, self.endpoint, self.ledger_dir)
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def __len__(self):
+    return len(self._actors)
+
+  @property
+  def actors(self):
+    return list(self._actors)
+
+  def enable_sync(self, fixed_delta_seconds=0.04, tm=None):
+    """Synchronous mode on the world (and `tm`), until `close()`."""
+    if self._settings is None:
+      self._settings = self.world.get_settings()
+    settings = self.world.get_settings()
+    settings.fixed_delta_seconds = fixed_delta_seconds
+    settings.synchronous_mode = True  # (Required) Enables synchronous mode on world
+    self._tm = tm
+    self._write_ledger()  # Before the switch, so a crash right after is still undone.
+    if tm is not None:
+      tm.set_synchronous_mode(True)  # (Required) Enables synchronous mode on traffic manager
+    self.world.apply_settings(settings)
+
+  def on_close(self, fn, *args):
+    """Call `fn(*args)` in `close()` before the actors go, last registered first.
+
+    E.g. to stop the thread that ticks the world before leaving synchronous mode.
+    """
+    self._callbacks.append((fn, args))
+
+  def spawn(self, blueprint, transform, attach_to=None):
+    """`world.spawn_actor()`, the actor is destroyed by `close()`."""
+    actor = self.world.spawn_actor(blueprint, transform, attach_to=attach_to)
+    return self.track([actor])[0]
+
+  def track(self, actors):
+    """Take over `actors` spawned elsewhere (e.g. `spawn_npcs()`), returns them."""
+    actors = list(actors)
+    self._actors.extend(actors)
+    self._write_ledger()
+    return actors
+
+  def _write_ledger(self):
+    self.ledger_dir.mkdir(parents=True, exist_ok=True)
+    ledger = {'pid': os.getpid(), 'host': socket.gethostname(), 'endpoint': self.endpoint,
+              'synchronous': self._settings is not None,
+              'actors': {str(a.id): a.type_id for a in self._actors}}
+    tmp_path = self._ledger.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+      json.dump(ledger, f)
+    os.replace(tmp_path, self._ledger)
+
+  def destroy_all(self):
+    """Stop the sensors, then destroy every actor in one batch, sensors first."""
+    actors, self._actors = self._actors, []
+    for actor in actors:
+      # A property in older CARLA releases, a method in newer ones.
+      listening = getattr(actor, 'is_listening', False)
+      if callable(listening):
+        listening = listening()
+      if listening:
+        actor.stop()
+    actors.sort(key=lambda a: not a.type_id.startswith('sensor.'))
+    failed = destroy_actors(self.client, [a.id for a in actors])
+    print(f'Destroyed {len(actors) - failed}/{len(actors)} actors.')
+
+  def restore_settings(self):
+    """Back to the settings from before `enable_sync()`."""
+    if self._settings is None:
+      return
+    settings, self._settings = self._settings, None
+    if self._tm is not None:
+      self._tm.set_synchronous_mode(settings.synchronous_mode)
+    self.world.apply_settings(settings)
+
+  def close(self):
+    """Clean up everything, the settings are restored even if destroying fails."""
+    try:
+      while self._callbacks:
+        fn, args = self._callbacks.pop()
+        try:
+          fn(*args)
+        except Exception as e:  # The actors must go anyway.
+          print(f'Close callback {fn!r} failed: {e!r}')
+      self.destroy_all()
+    finally:
+      self.restore_settings()
+      if self._ledger.exists():
+        self._ledger.unlink()
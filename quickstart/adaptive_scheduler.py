@@ -0,0 +1,192 @@
+"""
+Hold a target FPS under load by detecting less often, on smaller frames, or with
+a longer tick.
+
+Every stage runs on every frame at `image_size_x=800`, `fixed_delta_seconds=0.04`
+no matter the load, so with 100 NPCs and YOLO the client falls behind and
+stutters. The `AdaptiveScheduler` watches the wall time of each frame (tick to
+tick) and the latency of the stages it is told about, and moves along a ladder
+of `LEVELS`, cheapest last:
+
+  detect_every  run the detector on one frame out of N, the others reuse (or
+                track) the last detections
+  scale         letterbox size of the detector, relative to the full one
+  tick_factor   `fixed_delta_seconds` times this, fewer ticks per simulated
+                second, the simulation stays real time with a frame budget
+                that many times longer
+
+It goes one level down when the mean frame time of the last `window` frames is
+over the budget (or a stage's p95 is over its own budget), and one level up when
+there is room again, at most once per `cooldown` frames. A level that was
+left for being too slow is only tried again after a cooldown that doubles each
+time, so the scheduler does not flip between two levels. Every change is
+printed and written to `log_path` as a JSON line, with the measurements that
+led to it.
+
+  scheduler = AdaptiveScheduler(target_fps=25, world=world, stage_budgets={'detect': 0.2})
+  def on_tick(bundle):
+    plan = scheduler.tick(bundle.frame)
+    if plan.detect:
+      detector.submit(frame, bundle.frame, callback=..., scale=plan.scale)  # records 'detect'
+"""
+
+import collections
+import json
+import os
+import time
+
+import numpy as np
+
+import instrumentation
+
+# detect_every, scale, tick_factor
+LEVELS = (
+    (1, 1.0, 1.0),
+    (2, 1.0, 1.0),
+    (2, 0.75, 1.0),
+    (3, 0.75, 1.0),
+    (3, 0.5, 1.0),
+    (4, 0.5, 1.0),
+    (4, 0.5, 1.5),
+    (4, 0.5, 2.0),
+)
+
+# A level left for being too slow is retried after at most cooldown * 2**this frames.
+MAX_BACKOFF_DOUBLINGS = 5
+
+# What to do with the frame of one tick.
+Plan = collections.namedtuple('Plan', ['frame', 'level', 'detect', 'scale', 'fixed_delta_seconds'])
+# One change of level, `stages` has the p95 ms of every stage at that time.
+Decision = collections.namedtuple('Decision', ['frame', 'time', 'old_level', 'level', 'action',
+                                               'reason', 'frame_ms', 'budget_ms', 'stages'])
+
+
+class AdaptiveScheduler:
+  """Picks per frame whether to detect, at which scale, and the tick length."""
+
+  def __init__(self, target_fps=25.0, levels=LEVELS, world=None, fixed_delta_seconds=0.04,
+               stage_budgets=None, window=25, cooldown=50, recover_below=0.7, log_path=None,
+               profiler=None):
+    """`world` (in synchronous mode) gets its `fixed_delta_seconds` changed, without
+    it the tick factor is only reported in the plans. `stage_budgets` maps a stage
+    to the seconds its p95 may take, e.g. the latency of the detections."""
+    self.budget = 1.0 / target_fps
+    self.levels = levels
+    self.world = world
+    self.fixed_delta_seconds = fixed_delta_seconds
+    self.stage_budgets = dict(stage_budgets or {})
+    self.window = window
+    self.cooldown = cooldown
+    self.recover_below = recover_below
+    self.log_path = log_path
+    self.profiler = profiler or instrumentation.DISABLED
+    self.level = 0
+    self.decisions = []
+    self._frame_times = collections.deque(maxlen=window)
+    self._stages = collections.defaultdict(lambda: collections.deque(maxlen=window))
+    self._last_tick = None
+    self._since_change = 0
+    self._since_detect = None  # Frames since the last detection, None before the first
+    self._failures = collections.Counter()  # level -> times it was left for being too slow
+    self._retry_at = {}  # level -> frame from which recovering to it is tried again
+    # Counters, only for reading.
+    self.frame_count = 0
+    self.detect_count = 0
+    if log_path:
+      os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+
+  def record(self, stage, seconds):
+    """One latency sample of `stage`, e.g. from the detector callback."""
+    self._stages[stage].append(seconds)
+    self.profiler.record(stage, seconds)
+
+  def tick(self, frame, now=None):
+    """Call once per tick, returns the `Plan` of this frame.
+
+    The time since the previous call is the frame time the budget is about.
+    """
+    now = time.perf_counter() if now is None else now
+    if self._last_tick is not None:
+      self._frame_times.append(now - self._last_tick)
+    self._last_tick = now
+    self.frame_count += 1
+    self._since_change += 1
+    self._adapt(frame)
+
+    detect_every, scale, tick_factor = self.levels[self.level]
+    detect = self._since_detect is None or self._since_detect + 1 >= detect_every
+    self._since_detect = 0 if detect else self._since_detect + 1
+    self.detect_count += detect
+    return Plan(frame, self.level, detect, scale, self.fixed_delta_seconds * tick_factor)
+
+  def frame_budget(self):
+    """Seconds a frame may take at the current level."""
+    return self.budget * self.levels[self.level][2]
+
+  def _p95(self, stage):
+    return float(np.percentile(self._stages[stage], 95)) if self._stages[stage] else 0.0
+
+  def _adapt(self, frame):
+    # Only on a full window measured entirely at the current level.
+    if self._since_change < max(self.cooldown, self.window) or len(self._frame_times) < self.window:
+      return
+    mean = float(np.mean(self._frame_times))
+    budget = self.frame_budget()
+    over = [s for s, b in self.stage_budgets.items() if self._p95(s) > b]
+    if mean > budget and self.level < len(self.levels) - 1:
+      self._change(frame, self.level + 1, f'mean frame {mean * 1e3:.1f} ms over budget', mean)
+    elif over and self.level < len(self.levels) - 1:
+      reason = ', '.join(f'{s} p95 {self._p95(s) * 1e3:.1f} ms over {self.stage_budgets[s] * 1e3:.0f} ms'
+                         for s in over)
+      self._change(frame, self.level + 1, reason, mean)
+    elif (not over and self.level > 0
+          and mean < self.budget * self.levels[self.level - 1][2] * self.recover_below
+          and frame >= self._retry_at.get(self.level - 1, 0)
+          and all(self._p95(s) < b * self.recover_below for s, b in self.stage_budgets.items())):
+      self._change(frame, self.level - 1, f'mean frame {mean * 1e3:.1f} ms, room to spare', mean)
+
+  def _change(self, frame, level, reason, mean):
+    old = self.levels[self.level]
+    new = self.levels[level]
+    actions = []
+    if new[0] != old[0]:
+      actions.append(f'detect every {new[0]} frames')
+    if new[1] != old[1]:
+      actions.append(f'detector scale {new[1]:g}')
+    if new[2] != old[2]:
+      actions.append(f'fixed_delta_seconds {self.fixed_delta_seconds * new[2]:g}')
+      self._apply_tick(self.fixed_delta_seconds * new[2])
+    if level > self.level:
+      self._failures[self.level] += 1
+      backoff = 2 ** min(self._failures[self.level], MAX_BACKOFF_DOUBLINGS)
+      self._retry_at[self.level] = frame + self.cooldown * backoff
+    decision = Decision(frame, time.time(), self.level, level, ', '.join(actions), reason,
+                        mean * 1e3, self.frame_budget() * 1e3,
+                        {s: self._p95(s) * 1e3 for s in self._stages})
+    self.level = level
+    self._since_change = 0
+    self._frame_times.clear()
+    for samples in self._stages.values():
+      samples.clear()
+    self.decisions.append(decision)
+    print(f'[scheduler] frame {frame}: level {decision.old_level} -> {level} '
+          f'({decision.action}), {reason}')
+    if self.log_path:
+      with open(self.log_path, 'a') as f:
+        f.write(json.dumps(decision._asdict()) + '\n')
+
+  def _apply_tick(self, fixed_delta_seconds):
+    if self.world is None:
+      return
+    settings = self.world.get_settings()
+    settings.fixed_delta_seconds = fixed_delta_seconds
+    self.world.apply_settings(settings)
+
+  def stats(self):
+    return {
+        'level': self.level,
+        'frames': self.frame_count,
+        'detected': self.detect_count,
+        'decisions': len(self.decisions),
+        'mean_frame_ms': float(np.mean(self._frame_times)) * 1e3 if self._frame_times else 0.0,
+    }
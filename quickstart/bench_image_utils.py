@@ -0,0 +1,57 @@
+"""
+Micro-benchmark of `image_utils` against the old `np.array(raw_data)` path.
+
+No simulator is needed, frames are random 800x600 BGRA buffers shaped like
+`carla.Image`.
+
+  python bench_image_utils.py
+"""
+
+import timeit
+
+import cv2
+import numpy as np
+from absl import app
+
+import image_utils
+
+WIDTH = 800
+HEIGHT = 600
+REPEAT = 1000
+
+
+class FakeImage:
+  """Only what we need from `carla.Image`."""
+
+  def __init__(self, width, height):
+    self.width = width
+    self.height = height
+    data = np.random.randint(0, 256, size=width * height * 4, dtype=np.uint8)
+    self.raw_data = memoryview(bytearray(data.tobytes()))
+
+
+def main(argv):
+  img = FakeImage(WIDTH, HEIGHT)
+  out = image_utils.alloc_frame(img)
+
+  cases = {
+      # What the quickstart scripts used to do.
+      'np.array + reshape + [:,:,:3]': lambda: np.array(
+          img.raw_data, dtype=np.uint8).reshape((HEIGHT, WIDTH, 4))[:, :, :3],
+      'np.array + reshape + cvtColor': lambda: cv2.cvtColor(
+          np.array(img.raw_data, dtype=np.uint8).reshape((HEIGHT, WIDTH, 4)),
+          cv2.COLOR_BGRA2RGB),
+      # The new ones.
+      'bgr_view': lambda: image_utils.bgr_view(img),
+      'rgb_view': lambda: image_utils.rgb_view(img),
+      'to_bgr(out=)': lambda: image_utils.to_bgr(img, out=out),
+      'to_rgb(out=)': lambda: image_utils.to_rgb(img, out=out),
+  }
+  print(f'{WIDTH}x{HEIGHT} BGRA, {REPEAT} runs each')
+  for name, fn in cases.items():
+    sec = timeit.timeit(fn, number=REPEAT) / REPEAT
+    print(f'{name:32} {sec * 1e6:10.1f} us/frame')
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,266 @@
+"""
+Benchmark the camera-processing paths of the quickstart scripts.
+
+Every case (depth decoding and YOLO preprocessing included) runs on synthetic
+800x600 BGRA frames and on the `data/finetune_yolo` images (resized to the
+camera size), and reports frames/sec, per-frame latency percentiles and the
+peak RSS during the case, with how much it grew over the RSS the case started
+at (the peak is reset per case through /proc/self/clear_refs, where Linux
+allows it, else it is the peak of the process so far). The results are saved as
+JSON, named after the current commit, so runs can be compared across commits:
+
+  python bench_pipeline.py
+  python bench_pipeline.py --yolo --compare ../out/bench/<older>.json
+"""
+
+import collections
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from absl import app
+from absl import flags
+
+import depth_utils
+import image_utils
+import yolo_preprocess
+from bench_image_utils import FakeImage
+from instrumentation import Profiler
+from replay import ReplayImage, load_frames
+from video_recorder import VideoRecorder
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('frames', 200, 'Frames per case.')
+flags.DEFINE_integer('width', 800, 'Frame width.')
+flags.DEFINE_integer('height', 600, 'Frame height.')
+flags.DEFINE_string('dataset', '../data/finetune_yolo/images', 'Real frames, empty to skip.')
+flags.DEFINE_string('out_dir', '../out/bench', 'Where the JSON results go.')
+flags.DEFINE_string('compare', '', 'An older JSON result to compare with.')
+flags.DEFINE_bool('yolo', False, 'Also run YOLO single vs. batched, needs torch.')
+flags.DEFINE_integer('yolo_batch', 4, 'Batch size of the batched YOLO case.')
+
+# `fn(image)` handles `per_call` images at once (a list if more than one).
+# `setup()` is called before the clock starts, e.g. to open a writer, and
+# `finish()` at the end, counted in the fps, e.g. to flush it. `latencies()`
+# returns per-frame seconds the case measured itself, for work that `fn` only
+# queues, `latency_of` says what they are.
+Case = collections.namedtuple('Case', ['fn', 'finish', 'per_call', 'setup', 'latencies',
+                                       'latency_of'],
+                              defaults=(None, 1, None, None, 'call'))
+
+
+def _call_frames(case, images, frames):
+  """Per-frame latencies of `case.fn` over `frames` frames."""
+  latencies = []
+  for i in range(0, frames, case.per_call):
+    batch = [images[(i + j) % len(images)] for j in range(case.per_call)]
+    t = time.perf_counter()
+    case.fn(batch if case.per_call > 1 else batch[0])
+    latencies.append((time.perf_counter() - t) / case.per_call)
+  return latencies
+
+
+def _proc_status_mb(field):
+  with open('/proc/self/status') as f:
+    for line in f:
+      if line.startswith(field + ':'):
+        return int(line.split()[1]) / 1024  # kB
+  raise KeyError(field)
+
+
+def reset_peak_rss():
+  """Start a new peak RSS, returns the RSS now, None where it can't be reset."""
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')  # Resets VmHWM (Linux 4.0+)
+    return _proc_status_mb('VmRSS')
+  except (OSError, KeyError):
+    return None
+
+
+def peak_rss_mb():
+  """Peak RSS since `reset_peak_rss()`, or of the process if it can't be reset."""
+  try:
+    return _proc_status_mb('VmHWM')
+  except (OSError, KeyError):
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def run_case(case, images, frames):
+  """Time `case` over `frames` frames, with the peak RSS while it runs."""
+  if case.setup is not None:
+    case.setup()
+  start_rss = reset_peak_rss()
+  start = time.perf_counter()
+  latencies = _call_frames(case, images, frames)
+  if case.finish is not None:
+    case.finish()
+  elapsed = time.perf_counter() - start
+  peak_rss = peak_rss_mb()
+  calls = len(latencies)
+  if case.latencies is not None:
+    latencies = case.latencies()
+  ms = np.array(latencies) * 1e3
+  p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+  return {
+      'fps': calls * case.per_call / elapsed,
+      'p50_ms': float(p50),
+      'p95_ms': float(p95),
+      'p99_ms': float(p99),
+      'latency_of': case.latency_of,
+      'peak_rss_mb': peak_rss,
+      'rss_growth_mb': None if start_rss is None else peak_rss - start_rss,
+  }
+
+
+def image_cases(width, height, tmp_dir):
+  """name -> `Case` of the conversion and output paths."""
+  out = np.empty((height, width, 3), dtype=np.uint8)
+  counter = iter(range(10 ** 9))
+  recorder = {}
+  profiler = {}
+
+  def open_recorder():
+    # Before the clock, starting ffmpeg is not part of the frames.
+    profiler['p'] = Profiler(window=10 ** 7, log_every=0)
+    recorder['r'] = VideoRecorder(os.path.join(tmp_dir, 'bench.mp4'), width, height,
+                                  pix_fmt='bgr24', profiler=profiler['p'])
+
+  def encode(img):
+    # A copy, like the scripts do, the recorder thread reads it later.
+    recorder['r'].write(image_utils.to_bgr(img))
+
+  def finish_encode():
+    recorder.pop('r').close()
+
+  def encode_latencies():
+    # write() only queues the frame, the time of each frame is on the recorder thread.
+    return profiler.pop('p').samples('encode')
+
+  return {
+      # raw_data -> array, what the scripts used to do vs. `image_utils`.
+      'convert/np.array+reshape': Case(lambda img: np.array(
+          img.raw_data, dtype=np.uint8).reshape((img.height, img.width, 4))[:, :, :3]),
+      'convert/bgr_view': Case(image_utils.bgr_view),
+      # Color conversion, allocating vs. into a reused buffer.
+      'color/cvtColor': Case(lambda img: cv2.cvtColor(image_utils.bgra_view(img),
+                                                      cv2.COLOR_BGRA2RGB)),
+      'color/to_rgb(out=)': Case(lambda img: image_utils.to_rgb(img, out=out)),
+      # Output, one PNG per frame vs. streamed into one video.
+      'output/png': Case(lambda img: cv2.imwrite(
+          os.path.join(tmp_dir, f'{next(counter):04}.png'), image_utils.bgra_view(img))),
+      'output/stream_encode': Case(encode, finish_encode, setup=open_recorder,
+                                   latencies=encode_latencies, latency_of='encode thread'),
+  }
+
+
+def depth_cases(width, height):
+  """Depth decoding, float64 formula vs. `depth_utils`, and the point cloud."""
+  decoder = depth_utils.DepthDecoder(width, height)
+
+  def formula(img):
+    bgra = image_utils.bgra_view(img).astype(np.float64)
+    return (bgra[..., 2] + bgra[..., 1] * 256 + bgra[..., 0] * 65536) / (256 ** 3 - 1) * 1000
+
+  def point_cloud(img):
+    decoder.decode(img)
+    return decoder.point_cloud(max_depth=100.0)
+
+  return {
+      'depth/formula': Case(formula),
+      'depth/decode': Case(decoder.decode),
+      'depth/decode+point_cloud': Case(point_cloud),
+  }
+
+
+def preprocess_cases(width, height, batch_size):
+  """YOLO input batches, AutoShape-like allocations vs. `yolo_preprocess.Preprocessor`."""
+  preprocessor = yolo_preprocess.Preprocessor(width, height, max_batch_size=batch_size)
+  _, new_size, (left, top), (batch_w, batch_h) = yolo_preprocess.letterbox_shape(width, height)
+
+  def allocating(imgs):
+    frames = []
+    for img in imgs:
+      rgb = cv2.resize(image_utils.to_rgb(img), new_size)
+      frames.append(cv2.copyMakeBorder(
+          rgb, top, batch_h - new_size[1] - top, left, batch_w - new_size[0] - left,
+          cv2.BORDER_CONSTANT, value=(yolo_preprocess.PAD_VALUE,) * 3))
+    return np.ascontiguousarray(np.stack(frames).transpose(0, 3, 1, 2)).astype(np.float32) / 255
+
+  return {
+      f'preprocess/allocating{batch_size}': Case(allocating, per_call=batch_size),
+      f'preprocess/letterbox{batch_size}': Case(
+          lambda imgs: preprocessor([image_utils.bgra_view(img) for img in imgs]),
+          per_call=batch_size),
+  }
+
+
+def yolo_cases(batch_size):
+  """Single-frame vs. batched YOLOv5 calls, both on RGB frames."""
+  from model_registry import load_yolo  # torch is only needed here
+  model = load_yolo('yolov5l6')
+  return {
+      'yolo/single': Case(lambda img: model(image_utils.to_rgb(img))),
+      f'yolo/batch{batch_size}': Case(
+          lambda imgs: model([image_utils.to_rgb(img) for img in imgs]), per_call=batch_size),
+  }
+
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                   text=True, stderr=subprocess.DEVNULL).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return 'unknown'
+
+
+def main(argv):
+  inputs = {'synthetic': [FakeImage(FLAGS.width, FLAGS.height) for _ in range(4)]}
+  if FLAGS.dataset and os.path.isdir(FLAGS.dataset):
+    frames = load_frames(FLAGS.dataset, size=(FLAGS.width, FLAGS.height))
+    inputs['finetune_yolo'] = [ReplayImage(f, i, 0.0) for i, f in enumerate(frames)]
+
+  results = {}
+  for input_name, images in inputs.items():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      cases = image_cases(FLAGS.width, FLAGS.height, tmp_dir)
+      cases.update(depth_cases(FLAGS.width, FLAGS.height))
+      cases.update(preprocess_cases(FLAGS.width, FLAGS.height, FLAGS.yolo_batch))
+      if FLAGS.yolo:
+        cases.update(yolo_cases(FLAGS.yolo_batch))
+      for case_name, case in cases.items():
+        name = f'{input_name}/{case_name}'
+        result = run_case(case, images, FLAGS.frames)
+        results[name] = result
+        growth = result['rss_growth_mb']
+        print(f'{name:45} {result["fps"]:9.1f} fps  p50 {result["p50_ms"]:7.2f}  '
+              f'p95 {result["p95_ms"]:7.2f}  p99 {result["p99_ms"]:7.2f} ms  '
+              f'rss {result["peak_rss_mb"]:.0f} MB'
+              + ('' if growth is None else f' (+{growth:.1f})')
+              + ('' if result['latency_of'] == 'call' else f'  [{result["latency_of"]}]'))
+
+  commit = git_commit()
+  os.makedirs(FLAGS.out_dir, exist_ok=True)
+  path = os.path.join(FLAGS.out_dir, f'{time.strftime("%Y%m%d-%H%M%S")}_{commit}.json')
+  with open(path, 'w') as f:
+    json.dump({'commit': commit, 'frames': FLAGS.frames,
+               'size': [FLAGS.width, FLAGS.height], 'results': results}, f, indent=2)
+  print(f'Results written to {path}')
+
+  if FLAGS.compare:
+    with open(FLAGS.compare) as f:
+      old = json.load(f)
+    print(f'Compared with {old["commit"]} (fps, new / old):')
+    for name, result in results.items():
+      if name in old['results']:
+        ratio = result['fps'] / old['results'][name]['fps']
+        print(f'  {name:45} {ratio:6.2f}x')
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,165 @@
+"""
+Export YOLO-format training data straight from the simulator ground truth.
+
+For every synchronized tick the 3D bounding boxes of the NPC vehicles are
+projected into the camera, all actors at once with NumPy, and turned into
+`class cx cy w h` lines (normalized, like `data/finetune_yolo/labels`). Images
+and label files are written by background threads into sharded directories:
+
+  <out_dir>/images/00000/000000.png   <out_dir>/labels/00000/000000.txt
+  ...                                 ...
+  <out_dir>/images/00001/001000.png   <out_dir>/labels/00001/001000.txt
+
+YOLOv5 finds the labels by replacing `images` with `labels` in the path, so the
+shards can be listed directly in the dataset yaml.
+
+NOTE: Boxes are not checked for occlusion, a car behind a wall is still
+labelled. Raise `min_visible` or lower `max_distance` to keep it cleaner.
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+from frame_pipeline import BLOCK, FrameQueue, FrameWorker
+from image_utils import to_bgr
+
+# Class ids by blueprint prefix, the same ids as `data/finetune_yolo` (1 is vehicle).
+CLASS_IDS = {'vehicle.': 1}
+
+# The 8 corners of a unit box, to be scaled by the bounding box extent.
+_CORNER_SIGNS = np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)],
+                         dtype=np.float64)
+
+
+def camera_intrinsics(width, height, fov):
+  """3x3 pinhole matrix of a CARLA camera, `fov` is the horizontal one in degrees."""
+  focal = width / (2.0 * np.tan(np.radians(fov) / 2.0))
+  return np.array([[focal, 0.0, width / 2.0],
+                   [0.0, focal, height / 2.0],
+                   [0.0, 0.0, 1.0]])
+
+
+def actor_corners(actors):
+  """(N, 8, 3) world coordinates of the bounding box corners of `actors`."""
+  if not actors:
+    return np.zeros((0, 8, 3))
+  extents = np.array([[a.bounding_box.extent.x, a.bounding_box.extent.y,
+                       a.bounding_box.extent.z] for a in actors])
+  centers = np.array([[a.bounding_box.location.x, a.bounding_box.location.y,
+                       a.bounding_box.location.z] for a in actors])
+  matrices = np.array([a.get_transform().get_matrix() for a in actors])  # (N, 4, 4)
+  local = centers[:, None, :] + extents[:, None, :] * _CORNER_SIGNS[None]  # (N, 8, 3)
+  return np.einsum('nij,nkj->nki', matrices[:, :3, :3], local) + matrices[:, None, :3, 3]
+
+
+def project_boxes(corners, world_to_camera, intrinsics, width, height,
+                  max_distance=80.0, min_size=4.0, min_visible=0.3):
+  """Project box corners into the image, all actors at once.
+
+  Returns `(boxes, keep)`: `boxes` are the (M, 4) x1, y1, x2, y2 pixel boxes
+  clipped to the image, `keep` the (N,) mask of the actors they belong to.
+  """
+  if len(corners) == 0:
+    return np.zeros((0, 4)), np.zeros(0, dtype=bool)
+  points = corners @ world_to_camera[:3, :3].T + world_to_camera[:3, 3]
+  # UE4 is x forward, y right, z up, the camera is x right, y down, z forward.
+  cam = np.stack([points[..., 1], -points[..., 2], points[..., 0]], axis=-1)
+  depth = cam[..., 2]
+  in_front = (depth > 0.1).all(axis=1)
+  near = np.linalg.norm(corners.mean(axis=1) - _camera_position(world_to_camera), axis=1) < max_distance
+  safe_depth = np.where(depth > 0.1, depth, 1.0)
+  u = intrinsics[0, 0] * cam[..., 0] / safe_depth + intrinsics[0, 2]
+  v = intrinsics[1, 1] * cam[..., 1] / safe_depth + intrinsics[1, 2]
+  raw = np.stack([u.min(axis=1), v.min(axis=1), u.max(axis=1), v.max(axis=1)], axis=1)
+  clipped = np.clip(raw, 0, [width, height, width, height])
+  raw_area = (raw[:, 2] - raw[:, 0]) * (raw[:, 3] - raw[:, 1])
+  clipped_w = clipped[:, 2] - clipped[:, 0]
+  clipped_h = clipped[:, 3] - clipped[:, 1]
+  visible = clipped_w * clipped_h / np.maximum(raw_area, 1e-6)
+  keep = (in_front & near & (clipped_w >= min_size) & (clipped_h >= min_size)
+          & (visible >= min_visible))
+  return clipped[keep], keep
+
+
+def _camera_position(world_to_camera):
+  rotation = world_to_camera[:3, :3]
+  return -rotation.T @ world_to_camera[:3, 3]
+
+
+def yolo_lines(boxes, classes, width, height):
+  """`class cx cy w h` lines, normalized by the image size."""
+  cx = (boxes[:, 0] + boxes[:, 2]) / 2 / width
+  cy = (boxes[:, 1] + boxes[:, 3]) / 2 / height
+  w = (boxes[:, 2] - boxes[:, 0]) / width
+  h = (boxes[:, 3] - boxes[:, 1]) / height
+  return [f'{c} {x:.6f} {y:.6f} {bw:.6f} {bh:.6f}' for c, x, y, bw, bh in zip(classes, cx, cy, w, h)]
+
+
+def class_of(type_id, class_ids=CLASS_IDS):
+  for prefix, class_id in class_ids.items():
+    if type_id.startswith(prefix):
+      return class_id
+  return None
+
+
+class DatasetExporter:
+  """Labels camera frames from the ground truth and writes them in the background."""
+
+  def __init__(self, out_dir, shard_size=1000, num_writers=2, queue_size=64,
+               image_ext='png', class_ids=CLASS_IDS, **project_kwargs):
+    self.out_dir = out_dir
+    self.shard_size = shard_size
+    self.image_ext = image_ext
+    self.class_ids = class_ids
+    self.project_kwargs = project_kwargs
+    self.frame_count = 0
+    self.box_count = 0
+    self.queue = FrameQueue(maxsize=queue_size, policy=BLOCK)
+    self._workers = [FrameWorker(self.queue, self._write, name=f'DatasetWriter-{i}')
+                     for i in range(num_writers)]
+    for worker in self._workers:
+      worker.start()
+
+  def label(self, carla_img, actors):
+    """The YOLO label lines of `actors` as seen in `carla_img`."""
+    actors = [a for a in actors if class_of(a.type_id, self.class_ids) is not None]
+    intrinsics = camera_intrinsics(carla_img.width, carla_img.height, carla_img.fov)
+    world_to_camera = np.array(carla_img.transform.get_inverse_matrix())
+    boxes, keep = project_boxes(actor_corners(actors), world_to_camera, intrinsics,
+                                carla_img.width, carla_img.height, **self.project_kwargs)
+    classes = [class_of(a.type_id, self.class_ids) for a, k in zip(actors, keep) if k]
+    return yolo_lines(boxes, classes, carla_img.width, carla_img.height)
+
+  def export(self, carla_img, actors):
+    """Label one frame and queue it for writing, blocks if the writers are behind."""
+    lines = self.label(carla_img, actors)
+    index = self.frame_count
+    self.frame_count += 1
+    self.box_count += len(lines)
+    # A copy: a view of `raw_data` is gone with the image, before the writers get to it.
+    self.queue.put((index, to_bgr(carla_img), lines))
+    return lines
+
+  def _paths(self, index):
+    shard = f'{index // self.shard_size:05}'
+    image_dir = os.path.join(self.out_dir, 'images', shard)
+    label_dir = os.path.join(self.out_dir, 'labels', shard)
+    return (os.path.join(image_dir, f'{index:06}.{self.image_ext}'),
+            os.path.join(label_dir, f'{index:06}.txt'))
+
+  def _write(self, item):
+    index, image, lines = item
+    image_path, label_path = self._paths(index)
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    os.makedirs(os.path.dirname(label_path), exist_ok=True)
+    cv2.imwrite(image_path, image)
+    with open(label_path, 'w') as f:
+      f.write('\n'.join(lines) + ('\n' if lines else ''))
+
+  def close(self):
+    """Write what is still queued."""
+    for worker in self._workers:
+      worker.stop()
+    print(f'Exported {self.frame_count} frames with {self.box_count} boxes to {self.out_dir}')
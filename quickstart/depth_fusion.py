@@ -0,0 +1,115 @@
+"""
+Fuse YOLO boxes with the depth frame of the same tick into per-object distances.
+
+A box also covers road and background, so its distance is a percentile (the
+median by default) of the depth in the central part of the box, the sky and
+anything past `max_depth` left out. Every box is sampled on the same `grid` x
+`grid` points, so all boxes of a frame are one gather and one sort,
+well under a millisecond for a few dozen boxes.
+
+Detections come back later than the depth frame, from the detector thread.
+`DepthFusion` keeps the decoded depth of the last `history` frames in reused
+buffers, by frame id, so the boxes are always matched with their own tick:
+
+  fusion = DepthFusion(800, 600, fov=90.0)
+  def on_tick(bundle):
+    fusion.add_depth(bundle.data['depth'])
+    detector.submit(to_rgb(bundle.data['rgb']), bundle.frame,
+                    callback=lambda frame_id, camera, det: print(fusion.fuse(frame_id, det)))
+"""
+
+import collections
+import threading
+
+import numpy as np
+
+from dataset_exporter import camera_intrinsics
+from depth_utils import to_depth
+
+# One detected object. `box` is x1, y1, x2, y2 in pixels, `distance` the planar
+# depth in meters (NaN if no valid depth in the box) and `position` x forward,
+# y right, z up in the camera frame.
+ObjectRange = collections.namedtuple('ObjectRange', ['box', 'conf', 'cls', 'distance', 'position'])
+
+
+def box_distances(depth, boxes, percentile=50.0, shrink=0.5, grid=16, max_depth=100.0):
+  """(N,) robust depth of each x1, y1, x2, y2 box of `depth`, all boxes at once.
+
+  Only the central `shrink` part (per side) of a box is sampled, on `grid` x
+  `grid` points.
+  """
+  boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+  if not len(boxes):
+    return np.zeros(0, dtype=np.float32)
+  height, width = depth.shape
+  center = (boxes[:, :2] + boxes[:, 2:]) / 2
+  half = (boxes[:, 2:] - boxes[:, :2]) * (shrink / 2)
+  steps = np.linspace(-1.0, 1.0, grid, dtype=np.float32)
+  xs = center[:, 0, None] + half[:, 0, None] * steps  # (N, grid)
+  ys = center[:, 1, None] + half[:, 1, None] * steps
+  xs = np.clip(xs, 0, width - 1).astype(np.intp)
+  ys = np.clip(ys, 0, height - 1).astype(np.intp)
+  samples = depth[ys[:, :, None], xs[:, None, :]].reshape(len(boxes), -1)
+  samples = np.where(samples < max_depth, samples, np.nan)
+  # Sorting puts the NaNs last, the percentile is then the nearest rank among
+  # the valid samples of each box (NaN if there are none).
+  samples.sort(axis=1)
+  valid = (~np.isnan(samples)).sum(axis=1)
+  rank = np.floor(np.maximum(valid - 1, 0) * (percentile / 100.0)).astype(np.intp)
+  return samples[np.arange(len(boxes)), rank]
+
+
+class DepthFusion:
+  """Matches detections with the depth of their frame and measures each object."""
+
+  def __init__(self, width, height, fov=90.0, history=16, percentile=50.0, shrink=0.5,
+               grid=16, max_depth=100.0):
+    self.width = width
+    self.height = height
+    self.percentile = percentile
+    self.shrink = shrink
+    self.grid = grid
+    self.max_depth = max_depth
+    self.intrinsics = camera_intrinsics(width, height, fov)
+    self._buffers = np.empty((history, height, width), dtype=np.float32)
+    self._scratch = np.empty((height, width), dtype=np.uint32)
+    self._slots = collections.OrderedDict()  # frame -> buffer index, oldest first
+    self._free = list(range(history))[::-1]  # Buffer indexes never used yet
+    self._lock = threading.Lock()
+    # Counters, only for reading.
+    self.fused_count = 0
+    self.missed_count = 0  # Detections whose depth frame was already gone.
+
+  def add_depth(self, depth_img):
+    """Decode a depth `carla.Image` and keep it for the detections of its frame."""
+    with self._lock:
+      if depth_img.frame in self._slots:
+        # The same frame again (a resent tick, a replay), it takes its old slot.
+        slot = self._slots.pop(depth_img.frame)
+      elif self._free:
+        slot = self._free.pop()
+      else:
+        _, slot = self._slots.popitem(last=False)
+      # Not in `_slots` while it is written, a reader can't see half a frame.
+    to_depth(depth_img, out=self._buffers[slot], scratch=self._scratch)
+    with self._lock:
+      self._slots[depth_img.frame] = slot
+
+  def fuse(self, frame_id, det):
+    """`ObjectRange`s of the (N, 6) detections of `frame_id`, None without its depth."""
+    with self._lock:
+      slot = self._slots.get(frame_id)
+      if slot is None:
+        self.missed_count += 1
+        return None
+      # Measured under the lock, so the buffer is not reused meanwhile.
+      distances = box_distances(self._buffers[slot], det[:, :4], self.percentile,
+                                self.shrink, self.grid, self.max_depth)
+    self.fused_count += 1
+    focal, cx, cy = self.intrinsics[0, 0], self.intrinsics[0, 2], self.intrinsics[1, 2]
+    u = (det[:, 0] + det[:, 2]) / 2
+    v = (det[:, 1] + det[:, 3]) / 2
+    positions = np.stack([distances, distances * (u - cx) / focal,
+                          -distances * (v - cy) / focal], axis=1)
+    return [ObjectRange(d[:4], float(d[4]), int(d[5]), float(dist), pos)
+            for d, dist, pos in zip(det, distances, positions)]
@@ -0,0 +1,102 @@
+"""
+Decode `sensor.camera.depth` frames into meters, and into point clouds.
+
+CARLA encodes the depth in the 24 bits of R, G and B:
+
+  normalized = (R + G * 256 + B * 256 * 256) / (256 ** 3 - 1)
+  meters = 1000 * normalized
+
+The raw buffer is BGRA, so read as big-endian uint32 a pixel is
+`B << 24 | G << 16 | R << 8 | A` and one right shift by 8 gives the 24-bit
+value. That is two NumPy ufuncs over the frame, written into reused buffers,
+about 1 ms for 800x600.
+
+  decoder = DepthDecoder(800, 600, fov=90.0)
+  depth_camera.listen(lambda img: on_depth(decoder.decode(img)))
+  points = decoder.point_cloud(max_depth=100.0)  # (N, 3) x forward, y right, z up
+
+NOTE: CARLA depth is planar, the distance along the camera axis (x), not the
+length of the ray.
+"""
+
+import numpy as np
+
+from dataset_exporter import camera_intrinsics
+from image_utils import bgra_view
+
+MAX_DEPTH = 1000.0  # Meters, what the sky decodes to.
+DEPTH_SCALE = np.float32(MAX_DEPTH / (256 ** 3 - 1))
+
+
+def alloc_depth(carla_img):
+  """A float32 (height, width) buffer to be reused with `out`."""
+  return np.empty((carla_img.height, carla_img.width), dtype=np.float32)
+
+
+def to_depth(carla_img, out=None, scratch=None):
+  """(height, width) float32 depth in meters, into `out` if given.
+
+  `scratch` is a uint32 buffer of the same shape, pass one to not allocate it.
+  """
+  if out is None:
+    out = alloc_depth(carla_img)
+  if scratch is None:
+    scratch = np.empty(out.shape, dtype=np.uint32)
+  packed = bgra_view(carla_img).view('>u4')[..., 0]
+  np.right_shift(packed, 8, out=scratch)
+  return np.multiply(scratch, DEPTH_SCALE, out=out)
+
+
+def to_world(points, transform):
+  """Sensor `points` (N, 3) into the world, `transform` is the sensor `carla.Transform`."""
+  matrix = np.asarray(transform.get_matrix(), dtype=np.float32)
+  return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+class DepthDecoder:
+  """Decodes the frames of one depth camera into its own reused buffers.
+
+  `decode()` returns a view into the same buffer every time, copy it to keep a
+  frame past the next call. `stride` subsamples the point cloud, 2 keeps every
+  second row and column.
+  """
+
+  def __init__(self, width, height, fov=90.0, stride=1):
+    self.width = width
+    self.height = height
+    self.stride = stride
+    self.depth = np.empty((height, width), dtype=np.float32)
+    self._scratch = np.empty((height, width), dtype=np.uint32)
+    # Per pixel y/x and z/x of its ray, so a point is only 2 multiplies.
+    intrinsics = camera_intrinsics(width, height, fov)
+    focal, cx, cy = intrinsics[0, 0], intrinsics[0, 2], intrinsics[1, 2]
+    u = np.arange(0, width, stride, dtype=np.float32) + 0.5
+    v = np.arange(0, height, stride, dtype=np.float32) + 0.5
+    self._ray_y = ((u - cx) / focal)[None, :].astype(np.float32)
+    self._ray_z = (-(v - cy) / focal)[:, None].astype(np.float32)
+    self._points = np.empty((len(v), len(u), 3), dtype=np.float32)
+
+  def decode(self, carla_img):
+    """Depth in meters of `carla_img`, in the decoder buffer."""
+    if (carla_img.width, carla_img.height) != (self.width, self.height):
+      raise ValueError(f'Image is {carla_img.width}x{carla_img.height}, '
+                       f'the decoder {self.width}x{self.height}')
+    return to_depth(carla_img, out=self.depth, scratch=self._scratch)
+
+  def point_cloud(self, depth=None, max_depth=None):
+    """(N, 3) points in the sensor frame, x forward, y right, z up.
+
+    `depth` defaults to the last decoded frame. Points at `max_depth` or farther
+    (e.g. the sky) are left out, which makes a copy; without it the result is a
+    view into the decoder buffer.
+    """
+    depth = self.depth if depth is None else depth
+    s = self.stride
+    x = depth[::s, ::s]
+    self._points[..., 0] = x
+    np.multiply(x, self._ray_y, out=self._points[..., 1])
+    np.multiply(x, self._ray_z, out=self._points[..., 2])
+    points = self._points.reshape(-1, 3)
+    if max_depth is not None:
+      points = points[x.reshape(-1) < max_depth]
+    return points
@@ -0,0 +1,324 @@
+"""
+Compare YOLO models side by side, decoding the frames only once.
+
+Running `detect.py` once per weights file decodes the same video again for each
+model. Here one thread decodes the source (a video, a folder of images or a
+`frame_store` recording) and every batch of frames goes to all models at once,
+each on its own thread. Per model it reports:
+
+  * mAP@0.5 and mAP@0.5:0.95 against YOLO labels, when the source is a folder
+    of images with a `labels` folder next to it (e.g. `data/finetune_yolo`)
+  * the number of boxes per class
+  * agreement with every other model, the F1 of matching their boxes at IoU 0.5
+
+and renders one video with the models next to each other.
+
+  python evaluate_models.py --source ../data/finetune_yolo/images
+  python evaluate_models.py --source ../out/yolo_recognize_moving_objects/frames \
+      --models yolov5l6,yolov5l6_ft --conf 0.25,0.5
+
+COCO models (with a 'car' class) are compared on the dataset classes through
+`COCO_TO_DATASET`, and their mAP only covers the classes they map to. Every
+other model is assumed to use the dataset class ids.
+"""
+
+import concurrent.futures
+import glob
+import json
+import os
+import threading
+
+import cv2
+import numpy as np
+from absl import app
+from absl import flags
+
+from dataset_exporter import CLASS_IDS
+from frame_pipeline import BLOCK, FrameQueue
+from frame_store import FrameStoreReader
+from label_dataset import LabelIndex
+from object_tracker import box_iou
+from replay import IMAGE_SUFFIXES
+from resumable_run import draw_boxes
+from video_recorder import VideoRecorder
+from yolo_worker import yolov5_xyxy
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string('source', '../data/finetune_yolo/images',
+                    'A video, a folder of images or a frame store.')
+flags.DEFINE_string('labels', '', 'YOLO labels of the images, by default `labels` next to them.')
+flags.DEFINE_list('models', ['yolov5l6', 'yolov5l6_ft'], 'Weights names to compare.')
+flags.DEFINE_list('conf', ['0.25', '0.5'], 'Confidence threshold of each model, or one for all.')
+flags.DEFINE_integer('batch', 8, 'Frames per model call.')
+flags.DEFINE_string('out', '../out/evaluate_models', 'Where the video and the report go.')
+
+VEHICLE = CLASS_IDS['vehicle.']
+# COCO names that are a vehicle in the dataset.
+COCO_TO_DATASET = {'car': VEHICLE, 'truck': VEHICLE, 'bus': VEHICLE, 'motorcycle': VEHICLE}
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+COLORS = [(0, 255, 0), (0, 128, 255), (255, 0, 255), (255, 255, 0)]
+
+
+def class_map(names):
+  """Model class id -> dataset class id (-1 to ignore), an array to index with."""
+  names = list(names.values()) if isinstance(names, dict) else list(names or [])
+  if 'car' not in names:
+    return None  # Already dataset ids.
+  return np.array([COCO_TO_DATASET.get(n, -1) for n in names])
+
+
+def to_dataset_classes(det, mapping):
+  """Detections with the classes of the dataset, the unmapped ones removed."""
+  if mapping is None or not len(det):
+    return det
+  det = det.copy()
+  det[:, 5] = mapping[det[:, 5].astype(int)]
+  return det[det[:, 5] >= 0]
+
+
+def match(det, gt, thresholds=IOU_THRESHOLDS):
+  """(N, T) true positive flags of `det` (N, 6) against `gt` (M, 5) class, x1, y1, x2, y2.
+
+  Greedy by confidence, a label is matched at most once per threshold and only
+  by a box of its class.
+  """
+  tp = np.zeros((len(det), len(thresholds)), dtype=bool)
+  if not len(det) or not len(gt):
+    return tp
+  iou = box_iou(det[:, :4], gt[:, 1:5])
+  iou[det[:, 5][:, None] != gt[:, 0][None, :]] = 0.0
+  for t, threshold in enumerate(thresholds):
+    taken = np.zeros(len(gt), dtype=bool)
+    for i in np.argsort(-det[:, 4]):
+      candidates = np.where(taken, 0.0, iou[i])
+      j = candidates.argmax()
+      if candidates[j] >= threshold:
+        taken[j] = True
+        tp[i, t] = True
+  return tp
+
+
+def average_precision(tp, conf, num_gt):
+  """Area under the interpolated precision/recall curve, per IoU threshold."""
+  if num_gt == 0 or not len(tp):
+    return np.zeros(tp.shape[1])
+  order = np.argsort(-conf)
+  hits = np.cumsum(tp[order], axis=0)
+  recall = hits / num_gt
+  precision = hits / np.arange(1, len(order) + 1)[:, None]
+  # Make precision monotonic from the right, then sum it over the recall steps.
+  precision = np.maximum.accumulate(precision[::-1], axis=0)[::-1]
+  recall = np.vstack([np.zeros((1, tp.shape[1])), recall])
+  return (np.diff(recall, axis=0) * precision).sum(axis=0)
+
+
+def agreement(a, b, threshold=0.5):
+  """F1 of matching the boxes of two models of one frame, class agnostic."""
+  if not len(a) and not len(b):
+    return None
+  if not len(a) or not len(b):
+    return 0.0
+  gt = np.concatenate([np.zeros((len(b), 1)), b[:, :4]], axis=1)
+  det = a.copy()
+  det[:, 5] = 0
+  matched = match(det, gt, [threshold])[:, 0].sum()
+  return 2.0 * matched / (len(a) + len(b))
+
+
+def read_labels(labels, name, width, height):
+  """(M, 5) class, x1, y1, x2, y2 pixel boxes of `name` in a `LabelIndex`, None if missing."""
+  rows = labels.get(name)
+  if rows is None:
+    return None
+  cx, cy, w, h = rows[:, 1] * width, rows[:, 2] * height, rows[:, 3] * width, rows[:, 4] * height
+  return np.stack([rows[:, 0], cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+
+
+def decode(source):
+  """Yields `(name, bgr)` of every frame of `source`, name is the image stem or frame id."""
+  if os.path.isfile(os.path.join(source, 'meta.json')):
+    store = FrameStoreReader(source)
+    for record, frame in store:
+      yield str(record['frame']), cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+  elif os.path.isdir(source):
+    for path in sorted(glob.glob(os.path.join(source, '*'))):
+      if path.lower().endswith(IMAGE_SUFFIXES):
+        yield os.path.splitext(os.path.basename(path))[0], cv2.imread(path, cv2.IMREAD_COLOR)
+  else:
+    cap = cv2.VideoCapture(source)
+    try:
+      index = 0
+      while True:
+        ok, bgr = cap.read()
+        if not ok:
+          break
+        yield str(index), bgr
+        index += 1
+    finally:
+      cap.release()
+
+
+def side_by_side(bgr, detections, titles, colors=COLORS):
+  """One panel per model, next to each other."""
+  panels = []
+  for i, (det, title) in enumerate(zip(detections, titles)):
+    color = colors[i % len(colors)]
+    panel = draw_boxes(bgr.copy(), det, color=color)
+    cv2.putText(panel, f'{title}  {len(det)} boxes', (10, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.7,
+                color, 2)
+    panels.append(panel)
+  return np.hstack(panels)
+
+
+class ModelComparison:
+  """Fans frames out to several models and collects the comparison metrics."""
+
+  def __init__(self, models, labels_dir=None, batch_size=8, video_path=None, fps=25):
+    """`models` maps a name to a YOLOv5 AutoShape model."""
+    self.models = dict(models)
+    self.names = list(self.models)
+    self.labels = LabelIndex(labels_dir) if labels_dir else None
+    self.batch_size = batch_size
+    self.video_path = video_path
+    self.fps = fps
+    self._maps = {n: class_map(getattr(m, 'names', None)) for n, m in self.models.items()}
+    self._pool = concurrent.futures.ThreadPoolExecutor(len(self.models))
+    self._recorder = None
+    self.frame_count = 0
+    self.labeled_count = 0
+    self.num_gt = {}  # class -> labels
+    self.class_counts = {n: {} for n in self.names}
+    self._matches = {n: [] for n in self.names}  # (conf, class, (T,) tp) per box
+    self._agreement = {(a, b): [] for i, a in enumerate(self.names) for b in self.names[i + 1:]}
+
+  def _infer(self, name, frames):
+    rgb = [cv2.cvtColor(f, cv2.COLOR_BGR2RGB) for f in frames]
+    return [to_dataset_classes(d, self._maps[name]) for d in yolov5_xyxy(self.models[name](rgb))]
+
+  def add_batch(self, names, frames):
+    """Run every model on one batch of BGR frames, all models at the same time."""
+    futures = {n: self._pool.submit(self._infer, n, frames) for n in self.names}
+    detections = {n: f.result() for n, f in futures.items()}
+    for i, (frame_name, bgr) in enumerate(zip(names, frames)):
+      self._add_frame(frame_name, bgr, [detections[n][i] for n in self.names])
+
+  def _add_frame(self, frame_name, bgr, detections):
+    self.frame_count += 1
+    height, width = bgr.shape[:2]
+    gt = None
+    if self.labels is not None:
+      gt = read_labels(self.labels, frame_name, width, height)
+    if gt is not None:
+      self.labeled_count += 1
+      for c in gt[:, 0].astype(int):
+        self.num_gt[c] = self.num_gt.get(c, 0) + 1
+    for name, det in zip(self.names, detections):
+      counts = self.class_counts[name]
+      for c in det[:, 5].astype(int):
+        counts[c] = counts.get(c, 0) + 1
+      if gt is not None:
+        self._matches[name].append((det[:, 4], det[:, 5].astype(int), match(det, gt)))
+    for (a, b), scores in self._agreement.items():
+      score = agreement(detections[self.names.index(a)], detections[self.names.index(b)])
+      if score is not None:
+        scores.append(score)
+    if self.video_path:
+      panel = side_by_side(bgr, detections, self.names)
+      if self._recorder is None:
+        self._recorder = VideoRecorder(self.video_path, panel.shape[1], panel.shape[0],
+                                       fps=self.fps, pix_fmt='bgr24')
+      self._recorder.write(panel)
+
+  def run(self, source, queue_size=32):
+    """Decode `source` once on a background thread and evaluate all of it."""
+    queue = FrameQueue(maxsize=queue_size, policy=BLOCK)
+
+    def produce():
+      try:
+        for item in decode(source):
+          queue.put(item)
+      finally:
+        queue.close()
+
+    decoder = threading.Thread(target=produce, name='Decoder', daemon=True)
+    decoder.start()
+    batch = []
+    while True:
+      item = queue.get(timeout=0.1)
+      if item is not None:
+        batch.append(item)
+      done = item is None and queue.closed and not len(queue)
+      if batch and (len(batch) == self.batch_size or done):
+        self.add_batch(*zip(*batch))
+        batch = []
+      if done:
+        break
+    decoder.join()
+    return self.close()
+
+  def report(self):
+    """Per model mAP (None without labels), class counts and pairwise agreement."""
+    report = {'frames': self.frame_count, 'labeled_frames': self.labeled_count,
+              'labels': {int(c): n for c, n in sorted(self.num_gt.items())}, 'models': {},
+              'agreement': {f'{a} vs {b}': float(np.mean(s)) if s else None
+                            for (a, b), s in self._agreement.items()}}
+    for name in self.names:
+      result = {'boxes': {int(c): n for c, n in sorted(self.class_counts[name].items())},
+                'mAP50': None, 'mAP50_95': None}
+      if self.labeled_count:
+        matches = self._matches[name]
+        conf = np.concatenate([m[0] for m in matches]) if matches else np.zeros(0)
+        classes = np.concatenate([m[1] for m in matches]) if matches else np.zeros(0, int)
+        tp = (np.concatenate([m[2] for m in matches]) if matches
+              else np.zeros((0, len(IOU_THRESHOLDS)), bool))
+        # A COCO model can't find the dataset classes it has no name for.
+        mapping = self._maps[name]
+        ap = np.array([average_precision(tp[classes == c], conf[classes == c], n)
+                       for c, n in self.num_gt.items() if mapping is None or c in mapping])
+        if len(ap):
+          result['mAP50'] = float(ap[:, 0].mean())
+          result['mAP50_95'] = float(ap.mean())
+      report['models'][name] = result
+    return report
+
+  def close(self):
+    """Finish the video, returns the report."""
+    self._pool.shutdown()
+    if self._recorder is not None:
+      self._recorder.close()
+      self._recorder = None
+    return self.report()
+
+
+def main(argv):
+  confs = FLAGS.conf * len(FLAGS.models) if len(FLAGS.conf) == 1 else FLAGS.conf
+  if len(confs) != len(FLAGS.models):
+    raise app.UsageError(f'{len(FLAGS.conf)} --conf values for {len(FLAGS.models)} --models, '
+                         'give one per model or one for all')
+  from model_registry import load_yolo  # torch is only needed here
+  models = {}
+  for name, conf in zip(FLAGS.models, confs):
+    models[name] = load_yolo(name)
+    models[name].conf = float(conf)
+  labels_dir = FLAGS.labels or os.path.join(os.path.dirname(os.path.abspath(FLAGS.source)),
+                                            'labels')
+  os.makedirs(FLAGS.out, exist_ok=True)
+  comparison = ModelComparison(models, labels_dir if os.path.isdir(labels_dir) else None,
+                               batch_size=FLAGS.batch,
+                               video_path=os.path.join(FLAGS.out, 'comparison.mp4'))
+  report = comparison.run(FLAGS.source)
+
+  print(f'{report["frames"]} frames, {report["labeled_frames"]} with labels {report["labels"]}')
+  for name, result in report['models'].items():
+    ap = ('' if result['mAP50'] is None else
+          f'mAP@0.5 {result["mAP50"]:.3f}  mAP@0.5:0.95 {result["mAP50_95"]:.3f}  ')
+    print(f'  {name:20} {ap}boxes {result["boxes"]}')
+  for pair, score in report['agreement'].items():
+    print(f'  agreement {pair}: {"-" if score is None else f"{score:.3f}"}')
+  with open(os.path.join(FLAGS.out, 'report.json'), 'w') as f:
+    json.dump(report, f, indent=2)
+  print(f'Video and report written to {FLAGS.out}')
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,201 @@
+"""
+A stand-in for a CARLA server, to run scenario jobs without a simulator.
+
+`FakeClient` answers the part of the `carla.Client`/`carla.World` API the
+scenario jobs use: settings, the blueprint library, spawn points, spawning and
+destroying actors, `apply_batch_sync` with `DestroyActor` commands, and
+`tick()`. Cameras are `replay.ReplayCamera`s, fed with blank frames of their
+`image_size_x`/`image_size_y` or with the frames of a replay source.
+
+  client = FakeClient(tick_time=0.005)  # Slows each tick down like a server would
+  world = client.get_world()
+"""
+
+import itertools
+import threading
+import time
+import types
+
+import numpy as np
+
+from replay import ReplayCamera, ReplayWorld, load_frames
+
+
+def _transform(x=0.0, y=0.0, z=0.0, yaw=0.0):
+  location = types.SimpleNamespace(x=x, y=y, z=z)
+  rotation = types.SimpleNamespace(pitch=0.0, yaw=yaw, roll=0.0)
+  return types.SimpleNamespace(location=location, rotation=rotation)
+
+
+class FakeBlueprint:
+
+  def __init__(self, blueprint_id):
+    self.id = blueprint_id
+    self.tags = blueprint_id.split('.')
+    self.attributes = {'image_size_x': '800', 'image_size_y': '600', 'fov': '90'}
+
+  def has_attribute(self, name):
+    return name in self.attributes
+
+  def set_attribute(self, name, value):
+    self.attributes[name] = value
+
+  def get_attribute(self, name):
+    return self.attributes[name]
+
+
+class FakeBlueprintLibrary:
+
+  BLUEPRINTS = ('vehicle.tesla.model3', 'vehicle.nissan.patrol', 'vehicle.audi.tt',
+                'sensor.camera.rgb', 'sensor.camera.depth')
+
+  def find(self, blueprint_id):
+    return FakeBlueprint(blueprint_id)
+
+  def filter(self, pattern):
+    prefix = pattern.rstrip('*')
+    return [FakeBlueprint(b) for b in self.BLUEPRINTS if b.startswith(prefix)]
+
+
+class FakeActor:
+
+  def __init__(self, actor_id, type_id, transform, parent=None):
+    self.id = actor_id
+    self.type_id = type_id
+    self.parent = parent
+    self.attributes = {}
+    self._transform = transform
+
+  def get_transform(self):
+    return self._transform
+
+  def set_autopilot(self, enabled=True, tm_port=8000):
+    pass
+
+  def destroy(self):
+    return True
+
+
+class FakeCamera(ReplayCamera):
+  """A replay camera that is also an actor."""
+
+  def __init__(self, actor_id, blueprint, transform, parent, frames):
+    super().__init__(frames)
+    self.id = actor_id
+    self.type_id = blueprint.id
+    self.parent = parent
+    self.attributes = dict(blueprint.attributes)
+    self._transform = transform
+
+  def get_transform(self):
+    return self._transform
+
+  def destroy(self):
+    super().destroy()
+    return True
+
+
+class FakeWorld(ReplayWorld):
+  """A `ReplayWorld` that can spawn actors and takes `tick_time` per tick."""
+
+  def __init__(self, source=None, tick_time=0.0, num_spawn_points=50):
+    super().__init__([], rate=None)
+    self.tick_time = tick_time
+    self.actors = {}
+    self._source_frames = load_frames(source) if source else None
+    self._settings = types.SimpleNamespace(synchronous_mode=False, fixed_delta_seconds=None,
+                                           no_rendering_mode=False)
+    self._spawn_points = [_transform(x=10.0 * i, y=5.0 * (i % 7)) for i in range(num_spawn_points)]
+    self._ids = itertools.count(1)
+    self._lock = threading.Lock()
+
+  def get_settings(self):
+    return types.SimpleNamespace(**vars(self._settings))
+
+  def apply_settings(self, settings):
+    self._settings = types.SimpleNamespace(**vars(settings))
+    return self.frame
+
+  def get_blueprint_library(self):
+    return FakeBlueprintLibrary()
+
+  def get_map(self):
+    return types.SimpleNamespace(get_spawn_points=lambda: list(self._spawn_points))
+
+  def set_weather(self, weather):
+    self.weather = weather
+
+  def get_actors(self, actor_ids=None):
+    with self._lock:
+      actors = list(self.actors.values())
+    return [a for a in actors if actor_ids is None or a.id in actor_ids]
+
+  def get_actor(self, actor_id):
+    return self.actors.get(actor_id)
+
+  def spawn_actor(self, blueprint, transform, attach_to=None):
+    with self._lock:
+      actor_id = next(self._ids)
+      if blueprint.id.startswith('sensor.camera'):
+        width = int(blueprint.attributes['image_size_x'])
+        height = int(blueprint.attributes['image_size_y'])
+        frames = self._source_frames or [np.zeros((height, width, 4), dtype=np.uint8)]
+        actor = FakeCamera(actor_id, blueprint, transform, attach_to, frames)
+        self.cameras.append(actor)
+      else:
+        actor = FakeActor(actor_id, blueprint.id, transform, attach_to)
+      self.actors[actor_id] = actor
+    return actor
+
+  def try_spawn_actor(self, blueprint, transform, attach_to=None):
+    return self.spawn_actor(blueprint, transform, attach_to)
+
+  def destroy_actor(self, actor_id):
+    with self._lock:
+      actor = self.actors.pop(actor_id, None)
+      if actor in self.cameras:
+        self.cameras.remove(actor)
+    if actor is not None:
+      actor.destroy()
+    return actor is not None
+
+  def tick(self, seconds=None):
+    if self.tick_time:
+      time.sleep(self.tick_time)
+    return super().tick(seconds)
+
+  def wait_for_tick(self, seconds=None):
+    return self.get_snapshot()
+
+
+class FakeClient:
+  """The `carla.Client` of a `FakeWorld`, one world per client."""
+
+  def __init__(self, source=None, tick_time=0.0):
+    self.world = FakeWorld(source, tick_time)
+    self.timeout = None
+
+  def set_timeout(self, seconds):
+    self.timeout = seconds
+
+  def get_world(self):
+    return self.world
+
+  def get_trafficmanager(self, port=8000):
+    return types.SimpleNamespace(set_synchronous_mode=lambda enabled: None,
+                                 get_port=lambda: port)
+
+  def apply_batch_sync(self, commands, do_tick=False):
+    """Runs `DestroyActor` commands (anything with an `actor_id`)."""
+    responses = []
+    for command in commands:
+      ok = self.world.destroy_actor(command.actor_id)
+      responses.append(types.SimpleNamespace(
+          actor_id=command.actor_id, error='' if ok else f'Actor {command.actor_id} not found',
+          has_error=lambda ok=ok: not ok))
+    if do_tick:
+      self.world.tick()
+    return responses
+
+  def apply_batch(self, commands, do_tick=False):
+    self.apply_batch_sync(commands, do_tick)
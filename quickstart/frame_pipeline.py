@@ -0,0 +1,145 @@
+"""
+A bounded frame queue between the CARLA sensor callback and the processing.
+
+The callback given to `camera.listen()` runs on the CARLA client thread, so
+anything slow in there (reshape, imshow, waitKey, saving...) backs up the
+simulator tick loop. With this module the listener only puts the frame into a
+`FrameQueue`, and a `FrameWorker` thread takes it out and does the real work.
+
+  queue = FrameQueue(maxsize=4, policy=DROP_OLDEST)
+  worker = FrameWorker(queue, show_image)
+  worker.start()
+  camera.listen(queue.put)
+  ...
+  worker.stop()
+"""
+
+import collections
+import threading
+
+# What to do when the queue is full and a new frame comes in.
+DROP_OLDEST = 'drop_oldest'  # Throw away the oldest queued frame, keep the new one.
+DROP_NEWEST = 'drop_newest'  # Keep the queued frames, throw away the new one.
+BLOCK = 'block'  # Wait for the consumer (backpressure), drop only after `put_timeout`.
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class FrameQueue:
+  """A thread-safe ring buffer of frames, only `BLOCK` may block the producer."""
+
+  def __init__(self, maxsize=4, policy=DROP_OLDEST, put_timeout=None, on_drop=None):
+    if maxsize < 1:
+      raise ValueError(f'maxsize must be >= 1, got {maxsize}')
+    if policy not in POLICIES:
+      raise ValueError(f'Unknown policy {policy!r}, expected one of {POLICIES}')
+    self.maxsize = maxsize
+    self.policy = policy
+    self.put_timeout = put_timeout
+    self.on_drop = on_drop  # Called with every dropped frame, outside the lock.
+    self._frames = collections.deque()
+    self._cond = threading.Condition()
+    self._closed = False
+    # Counters, only for reading.
+    self.put_count = 0
+    self.get_count = 0
+    self.dropped_count = 0
+    self.max_depth = 0
+
+  def put(self, frame):
+    """Queue a frame, returns False if the frame (or an older one) was dropped."""
+    dropped = self._put(frame)
+    if dropped is not None and self.on_drop is not None:
+      self.on_drop(dropped[0])
+    return dropped is None
+
+  def _put(self, frame):
+    """Returns None if nothing was dropped, else a 1-tuple with the dropped frame."""
+    with self._cond:
+      if self._closed:
+        self.dropped_count += 1
+        return (frame,)
+      self.put_count += 1
+      dropped = None
+      if self.policy == BLOCK:
+        self._cond.wait_for(
+            lambda: len(self._frames) < self.maxsize or self._closed,
+            self.put_timeout)
+        if self._closed or len(self._frames) >= self.maxsize:
+          self.dropped_count += 1
+          return (frame,)
+      elif len(self._frames) >= self.maxsize:
+        self.dropped_count += 1
+        if self.policy == DROP_NEWEST:
+          return (frame,)
+        dropped = (self._frames.popleft(),)
+      self._frames.append(frame)
+      self.max_depth = max(self.max_depth, len(self._frames))
+      self._cond.notify_all()
+      return dropped
+
+  def get(self, timeout=None):
+    """Take the oldest frame, returns None on timeout or once closed and empty."""
+    with self._cond:
+      if not self._cond.wait_for(lambda: self._frames or self._closed, timeout):
+        return None
+      if not self._frames:
+        return None
+      self.get_count += 1
+      frame = self._frames.popleft()
+      self._cond.notify_all()  # A producer may be waiting for the space.
+      return frame
+
+  def close(self):
+    """Refuse new frames and wake up the consumer, queued frames still can be taken."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+
+  @property
+  def closed(self):
+    return self._closed
+
+  def __len__(self):
+    with self._cond:
+      return len(self._frames)
+
+  def stats(self):
+    """A snapshot of the counters, handy for printing."""
+    with self._cond:
+      return {
+          'depth': len(self._frames),
+          'max_depth': self.max_depth,
+          'put': self.put_count,
+          'get': self.get_count,
+          'dropped': self.dropped_count,
+      }
+
+
+class FrameWorker(threading.Thread):
+  """Consumes frames from a `FrameQueue` with `fn(frame)` on its own thread."""
+
+  def __init__(self, queue, fn, name='FrameWorker'):
+    super().__init__(name=name, daemon=True)
+    self.queue = queue
+    self.fn = fn
+    self.processed_count = 0
+    self.error = None
+
+  def run(self):
+    while True:
+      frame = self.queue.get(timeout=0.1)
+      if frame is None:
+        if self.queue.closed:
+          break
+        continue
+      try:
+        self.fn(frame)
+      except Exception as e:  # Keep going, one bad frame should not kill the stream.
+        self.error = e
+        print(f'{self.name} failed on a frame: {e!r}')
+      self.processed_count += 1
+
+  def stop(self, timeout=None):
+    """Close the queue, let the worker drain it and wait for it."""
+    self.queue.close()
+    self.join(timeout)
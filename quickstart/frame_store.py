@@ -0,0 +1,188 @@
+"""
+A compact, memory-mappable store of the frames of a recorded run.
+
+Instead of one PNG per frame, frames are appended raw (or zlib level 1) into
+chunk files, and an index keeps per-frame metadata (frame id, sim timestamp,
+ego transform) and where each frame is. Raw chunks are read back with
+`np.memmap`, so a frame is a zero-copy NumPy view and a 2000-frame run replays
+without decoding anything.
+
+  <path>/meta.json         shape, dtype, chunk size, compression
+  <path>/index.npy         one `INDEX_DTYPE` record per frame
+  <path>/chunk_00000.bin   frames 0 .. chunk_frames-1
+  ...
+
+  with FrameStoreWriter('../tmp/run.frames', (600, 800, 4)) as store:
+    store.append(bgra_view(img), img.frame, img.timestamp, main_vehicle.get_transform())
+
+  store = FrameStoreReader('../tmp/run.frames')
+  for record, frame in store:
+    ...
+"""
+
+import json
+import os
+import zlib
+
+import numpy as np
+
+INDEX_DTYPE = np.dtype([
+    ('frame', np.int64),  # Simulator frame id
+    ('timestamp', np.float64),  # Simulator time, seconds
+    ('chunk', np.int32),
+    ('offset', np.int64),  # Bytes into the chunk file
+    ('nbytes', np.int64),  # Stored bytes, smaller than the frame if compressed
+    ('ego', np.float32, (6,)),  # x, y, z, pitch, yaw, roll of the ego vehicle
+])
+
+
+def transform_to_array(transform):
+  """carla.Transform -> (x, y, z, pitch, yaw, roll), NaN if there is none."""
+  if transform is None:
+    return np.full(6, np.nan, dtype=np.float32)
+  loc, rot = transform.location, transform.rotation
+  return np.array([loc.x, loc.y, loc.z, rot.pitch, rot.yaw, rot.roll], dtype=np.float32)
+
+
+def _chunk_path(path, chunk):
+  return os.path.join(path, f'chunk_{chunk:05}.bin')
+
+
+class FrameStoreWriter:
+  """Appends frames of one fixed shape to a frame store.
+
+  With `resume=True` an existing store is continued after its last complete
+  chunk, a chunk that was cut by a crash is written again.
+  """
+
+  def __init__(self, path, shape, dtype=np.uint8, chunk_frames=256, compress=False,
+               resume=False):
+    self.path = path
+    self.shape = tuple(shape)
+    self.dtype = np.dtype(dtype)
+    self.chunk_frames = chunk_frames
+    self.compress = compress
+    self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+    self._records = []
+    self._file = None
+    self._offset = 0
+    os.makedirs(path, exist_ok=True)
+    meta = {'shape': list(self.shape), 'dtype': self.dtype.str,
+            'chunk_frames': chunk_frames, 'compress': compress}
+    index_path = os.path.join(path, 'index.npy')
+    if resume and os.path.isfile(index_path):
+      with open(os.path.join(path, 'meta.json')) as f:
+        if json.load(f) != meta:
+          raise ValueError(f'Can not resume {path}, it was written with other settings')
+      index = np.load(index_path)
+      complete = len(index) // chunk_frames * chunk_frames
+      self._records = index[:complete].tolist()
+      self.flush_index()
+    else:
+      with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+  def __len__(self):
+    return len(self._records)
+
+  @property
+  def num_complete_chunks(self):
+    return len(self._records) // self.chunk_frames
+
+  def append(self, frame, frame_id, timestamp=0.0, ego_transform=None):
+    """Append one frame (any strides) with its metadata.
+
+    Returns the number of the chunk this frame completed, else None.
+    """
+    if frame.shape != self.shape:
+      raise ValueError(f'Frame shape {frame.shape} does not match the store {self.shape}')
+    chunk = len(self._records) // self.chunk_frames
+    if self._file is None:
+      self._offset = 0
+      self._file = open(_chunk_path(self.path, chunk), 'wb')
+    data = np.ascontiguousarray(frame, dtype=self.dtype)
+    data = zlib.compress(data, 1) if self.compress else data.data
+    self._file.write(data)
+    nbytes = len(data) if self.compress else self.frame_bytes
+    self._records.append((frame_id, timestamp, chunk, self._offset, nbytes,
+                          transform_to_array(ego_transform)))
+    self._offset += nbytes
+    if len(self._records) % self.chunk_frames:
+      return None
+    # The chunk is full, make it durable. A crash loses at most the current chunk.
+    self._file.close()
+    self._file = None
+    self.flush_index()
+    return chunk
+
+  def flush_index(self):
+    """Write the index, atomically, a reader never sees half of it."""
+    tmp_path = os.path.join(self.path, 'index.tmp.npy')
+    np.save(tmp_path, np.array(self._records, dtype=INDEX_DTYPE))
+    os.replace(tmp_path, os.path.join(self.path, 'index.npy'))
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+    self.flush_index()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+class FrameStoreReader:
+  """Random access and streaming over a frame store, zero-copy if not compressed."""
+
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, 'meta.json')) as f:
+      meta = json.load(f)
+    self.shape = tuple(meta['shape'])
+    self.dtype = np.dtype(meta['dtype'])
+    self.chunk_frames = meta['chunk_frames']
+    self.compress = meta['compress']
+    self.index = np.load(os.path.join(path, 'index.npy'))
+    self._chunks = {}  # chunk -> np.memmap of its frames, opened on first use
+    self._by_frame = None
+
+  def __len__(self):
+    return len(self.index)
+
+  def _chunk(self, chunk):
+    if chunk not in self._chunks:
+      if self.compress:
+        with open(_chunk_path(self.path, chunk), 'rb') as f:
+          self._chunks[chunk] = f.read()
+      else:
+        count = int((self.index['chunk'] == chunk).sum())
+        self._chunks[chunk] = np.memmap(_chunk_path(self.path, chunk), dtype=self.dtype,
+                                        mode='r', shape=(count,) + self.shape)
+    return self._chunks[chunk]
+
+  def __getitem__(self, i):
+    """Frame number `i` of the run (not the frame id), a read-only view if raw."""
+    record = self.index[i]
+    chunk = self._chunk(int(record['chunk']))
+    if self.compress:
+      start = int(record['offset'])
+      data = zlib.decompress(chunk[start:start + int(record['nbytes'])])
+      return np.frombuffer(data, dtype=self.dtype).reshape(self.shape)
+    return chunk[int(record['offset']) // int(record['nbytes'])]
+
+  def __iter__(self):
+    """Streams `(index record, frame)` in recording order."""
+    for i in range(len(self)):
+      yield self.index[i], self[i]
+
+  def find(self, frame_id):
+    """The frame with simulator frame id `frame_id`."""
+    if self._by_frame is None:
+      self._by_frame = {int(f): i for i, f in enumerate(self.index['frame'])}
+    return self[self._by_frame[frame_id]]
+
+  def close(self):
+    self._chunks.clear()
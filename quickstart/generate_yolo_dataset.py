@@ -0,0 +1,83 @@
+"""
+1. Create a main_vehicle and camera
+2. Create random cars in the map
+3. Label every tick from the ground truth and write a YOLO dataset.
+"""
+
+import random
+
+from absl import app
+
+import carla
+
+from actor_registry import ActorRegistry
+from dataset_exporter import DatasetExporter
+from tick_driver import TickDriver
+from traffic import spawn_npcs
+
+SYNC_MASTER = True
+NUM_FRAMES = 5000  # Labeled frames to write.
+NUM_OF_VEHS = 100
+IMAGE_WIDTH = 800
+IMAGE_HEIGHT = 600
+DATASET_DIR = '../data/generated_yolo'
+random.seed(3)
+
+
+def main(argv):
+  # First of all, we need to create the client that will send the requests
+  # to the simulator. Here we'll assume the simulator is accepting
+  # requests in the localhost at port 2000.
+  host_ip = '127.0.0.1'
+  client = carla.Client(host_ip, 2000)
+  client.set_timeout(5.0)
+
+  # Leaving this block, also with an exception, destroys every actor spawned
+  # through the registry and gets the server back to the async mode.
+  with ActorRegistry(client, endpoint=f'{host_ip}:2000') as actors:
+    # Once we have a client we can retrieve the world that is currently running.
+    world = actors.world
+    tm = client.get_trafficmanager()
+
+    if SYNC_MASTER:
+      actors.enable_sync(0.04, tm)
+
+    blueprint_library = world.get_blueprint_library()
+
+    #NOTE: the main vehicle is deterministic now
+    bp = blueprint_library.find('vehicle.tesla.model3')
+    main_vehicle_transform = random.choice(world.get_map().get_spawn_points())
+    main_vehicle = actors.spawn(bp, main_vehicle_transform)
+    main_vehicle.set_autopilot(True)
+    print('created %s' % main_vehicle.type_id)
+
+    camera_bp = blueprint_library.find('sensor.camera.rgb')
+    camera_bp.set_attribute('image_size_x', str(IMAGE_WIDTH))
+    camera_bp.set_attribute('image_size_y', str(IMAGE_HEIGHT))
+    # The vehicle model towards positive "x". Positive "z" is upward.
+    camera_transform = carla.Transform(carla.Location(x=1.2, z=1.2))
+    camera = actors.spawn(camera_bp, camera_transform, attach_to=main_vehicle)
+    print('created %s' % camera.type_id)
+
+    npcs = actors.track(spawn_npcs(client, world, NUM_OF_VEHS, tm_port=tm.get_port(),
+                                   exclude=[main_vehicle_transform]))
+
+    # Every tick hands us the camera frame of that tick, the NPCs are where
+    # they were when it was taken.
+    exporter = DatasetExporter(DATASET_DIR)
+    actors.on_close(exporter.close)  # Writes what is still queued.
+    driver = TickDriver(world)
+    driver.add_sensor('rgb', camera)
+
+    def export(bundle):
+      if bundle.data['rgb'] is not None:
+        exporter.export(bundle.data['rgb'], npcs)
+      if exporter.frame_count % 500 == 0:
+        print(f'{exporter.frame_count} frames labeled, {exporter.box_count} boxes.')
+
+    driver.run(export, max_ticks=NUM_FRAMES)
+    print('Disconnecting from server...')
+  print('Done.')
+
+if __name__ == '__main__':
+  app.run(main)
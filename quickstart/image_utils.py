@@ -0,0 +1,50 @@
+"""
+Convert `carla.Image` to NumPy without copying the frame around.
+
+`np.array(carla_img.raw_data, dtype=np.uint8).reshape((600, 800, 4))` copies the
+whole BGRA buffer, and the `[:,:,:3]` slice or `cv2.cvtColor` after it makes
+another copy. Here `np.frombuffer` wraps `raw_data` as it is, and the size comes
+from the image itself, so it works for any `image_size_x`/`image_size_y`.
+
+NOTE: The views share memory with `carla_img`, they are only valid while the
+image is alive. Use `to_bgr()`/`to_rgb()` with `out` to keep a frame around.
+"""
+
+import cv2
+import numpy as np
+
+
+def bgra_view(carla_img):
+  """(height, width, 4) uint8 view of the raw BGRA buffer, no copy."""
+  buf = np.frombuffer(carla_img.raw_data, dtype=np.uint8)
+  return buf.reshape((carla_img.height, carla_img.width, 4))
+
+
+def bgr_view(carla_img):
+  """(height, width, 3) strided BGR view, the alpha channel is skipped, no copy."""
+  return bgra_view(carla_img)[:, :, :3]
+
+
+def rgb_view(carla_img):
+  """(height, width, 3) strided RGB view, channels are read backwards, no copy."""
+  return bgra_view(carla_img)[:, :, 2::-1]
+
+
+def alloc_frame(carla_img, channels=3):
+  """A contiguous buffer with the image size, to be reused with `out`."""
+  return np.empty((carla_img.height, carla_img.width, channels), dtype=np.uint8)
+
+
+def to_bgr(carla_img, out=None):
+  """Contiguous BGR frame, written into `out` if given (one copy, no allocation)."""
+  if out is None:
+    out = alloc_frame(carla_img)
+  # cvtColor is much faster than np.copyto() from the strided view.
+  return cv2.cvtColor(bgra_view(carla_img), cv2.COLOR_BGRA2BGR, dst=out)
+
+
+def to_rgb(carla_img, out=None):
+  """Contiguous RGB frame, written into `out` if given (one copy, no allocation)."""
+  if out is None:
+    out = alloc_frame(carla_img)
+  return cv2.cvtColor(bgra_view(carla_img), cv2.COLOR_BGRA2RGB, dst=out)
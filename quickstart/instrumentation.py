@@ -0,0 +1,186 @@
+"""
+Per-stage latency and throughput of the sim -> sensor -> process -> output pipeline.
+
+Two kinds of records go into rolling windows, one per name:
+  * `profiler.mark(frame, stage)` timestamps a frame when it reaches a stage,
+    kept as the latency since the first mark of that frame under
+    'first->stage' (e.g. 'tick->callback'), so mark 'tick' first.
+  * `with profiler.timed(stage):` measures how long the block took, under the
+    stage name.
+`summary()` gives p50/p95/p99 and FPS of each, a line is printed every
+`log_every` seconds and `dump()` writes everything to JSON or CSV on exit.
+
+A disabled profiler does nothing but an `if`, so it can stay in the code.
+
+  profiler = Profiler(enabled=True)
+  profiler.mark(frame, 'tick', issued)  # Where the latencies of the frame start
+  profiler.mark(img.frame, 'callback')  # 'tick->callback'
+  with profiler.timed('convert'):
+    np_img = to_bgr(img)
+  ...
+  profiler.dump('../out/profile.json')
+"""
+
+import collections
+import contextlib
+import csv
+import json
+import threading
+import time
+
+import numpy as np
+
+# The stages of the quickstart pipelines, in order.
+STAGES = ('tick', 'callback', 'convert', 'inference', 'display', 'encode', 'write')
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class Profiler:
+  """Rolling per-stage latency histograms and FPS."""
+
+  def __init__(self, enabled=True, window=1000, log_every=5.0, max_frames=10000):
+    self.enabled = enabled
+    self.window = window
+    self.log_every = log_every
+    self._lock = threading.Lock()
+    self._samples = {}  # name -> deque of seconds
+    self._times = {}  # name -> deque of when the samples were taken, for FPS
+    self._counts = collections.Counter()
+    # frame -> {stage: timestamp}, only the last `max_frames` frames are kept.
+    self._frames = collections.OrderedDict()
+    self._max_frames = max_frames
+    self._last_log = time.perf_counter()
+
+  def record(self, name, seconds, now=None):
+    """Add one sample of `seconds` to `name`."""
+    if not self.enabled:
+      return
+    now = time.perf_counter() if now is None else now
+    with self._lock:
+      if name not in self._samples:
+        self._samples[name] = collections.deque(maxlen=self.window)
+        self._times[name] = collections.deque(maxlen=self.window)
+      self._samples[name].append(seconds)
+      self._times[name].append(now)
+      self._counts[name] += 1
+    self.maybe_log(now)
+
+  def mark(self, frame, stage, now=None):
+    """`frame` reached `stage` now, records the latency since its first mark.
+
+    The latency goes under 'first->stage', apart from the durations of `timed()`.
+    The first mark of a frame only starts its clock. `now` is when it got
+    there, for marks recorded afterwards.
+    """
+    if not self.enabled:
+      return
+    now = time.perf_counter() if now is None else now
+    with self._lock:
+      stamps = self._frames.get(frame)
+      if stamps is None:
+        stamps = self._frames[frame] = {}
+        if len(self._frames) > self._max_frames:
+          self._frames.popitem(last=False)
+      stamps[stage] = now
+      first = min(stamps, key=stamps.get)
+      if first != stage:
+        latencies = {stage: now - stamps[first]}
+      else:
+        # Marked from another thread after the later stages, e.g. a tick that
+        # returns after the callbacks of its frame: their latencies start here.
+        latencies = {s: t - now for s, t in stamps.items() if s != stage}
+    for later, latency in latencies.items():
+      self.record(latency_name(first, later), latency, stamps[later])
+
+  def timed(self, name):
+    """Context manager recording the duration of its block under `name`."""
+    if not self.enabled:
+      return _NULL_CONTEXT
+    return self._timed(name)
+
+  @contextlib.contextmanager
+  def _timed(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.record(name, time.perf_counter() - start)
+
+  def samples(self, name):
+    """The seconds of `name` in the rolling window, oldest first."""
+    with self._lock:
+      return list(self._samples.get(name, ()))
+
+  def summary(self):
+    """{name: {count, fps, mean_ms, p50_ms, p95_ms, p99_ms}} over the rolling window."""
+    with self._lock:
+      samples = {name: np.array(s) for name, s in self._samples.items()}
+      times = {name: (t[0], t[-1], len(t)) for name, t in self._times.items()}
+      counts = dict(self._counts)
+    result = {}
+    for name in sorted(samples, key=_stage_order):
+      ms = samples[name] * 1e3
+      first, last, n = times[name]
+      p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+      result[name] = {
+          'count': counts[name],
+          'fps': (n - 1) / (last - first) if last > first else 0.0,
+          'mean_ms': float(ms.mean()),
+          'p50_ms': float(p50),
+          'p95_ms': float(p95),
+          'p99_ms': float(p99),
+      }
+    return result
+
+  def format_summary(self):
+    """The summary as one log line."""
+    return ' | '.join(
+        f'{name} p50 {s["p50_ms"]:.1f} p95 {s["p95_ms"]:.1f} p99 {s["p99_ms"]:.1f}ms '
+        f'{s["fps"]:.1f}fps' for name, s in self.summary().items())
+
+  def maybe_log(self, now=None):
+    """Print the summary if the last one is older than `log_every` seconds."""
+    now = time.perf_counter() if now is None else now
+    if not self.log_every or now - self._last_log < self.log_every:
+      return
+    self._last_log = now
+    print(f'[profile] {self.format_summary()}')
+
+  def dump(self, path):
+    """Write the summary and the per-frame timestamps, `.csv` or else JSON."""
+    if not self.enabled:
+      return
+    with self._lock:
+      frames = {frame: dict(stamps) for frame, stamps in self._frames.items()}
+    if str(path).endswith('.csv'):
+      # One row per frame, one column per stage, in seconds since its first mark.
+      stages = sorted({s for stamps in frames.values() for s in stamps}, key=_stage_order)
+      with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['frame'] + list(stages))
+        for frame, stamps in frames.items():
+          first = min(stamps.values())
+          writer.writerow([frame] + [
+              f'{stamps[s] - first:.6f}' if s in stamps else '' for s in stages])
+    else:
+      with open(path, 'w') as f:
+        json.dump({
+            'summary': self.summary(),
+            'frames': {str(frame): stamps for frame, stamps in frames.items()},
+        }, f, indent=2)
+    print(f'Profile written to {path}')
+
+
+def latency_name(first, stage):
+  """Name of the latency from the mark `first` to the mark `stage`."""
+  return f'{first}->{stage}'
+
+
+def _stage_order(name):
+  stage = name.split('->')[-1]
+  return (STAGES.index(stage) if stage in STAGES else len(STAGES), name)
+
+
+# Shared by everything that gets no profiler, it never records anything.
+DISABLED = Profiler(enabled=False)
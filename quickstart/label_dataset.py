@@ -0,0 +1,270 @@
+"""
+Index YOLO label files once into a columnar NumPy cache, and query it.
+
+Every `*.txt` under the labels folder (sharded folders too, like the ones of
+`DatasetExporter`) is parsed into flat arrays, one row per box:
+
+  image  index of the label file in `names`
+  cls    class id
+  cx cy w h  normalized box, as in the files
+
+and per file its name (the path without suffix, relative to the folder), mtime,
+size and where its boxes are. The index is kept in `<labels>.index.npz` next to
+the folder. On `refresh()` only the files whose mtime or size changed are read
+again, so an unchanged 100k-frame dataset is one directory scan.
+
+Statistics, validation and train/val splits are vectorized over the arrays:
+
+  index = LabelIndex('../data/finetune_yolo/labels')
+  index.class_histogram()  # boxes per class
+  index.empty_frames()     # label files without a box
+  train, val = index.split(0.1)
+
+  python label_dataset.py --label_dir ../data/finetune_yolo/labels --split_dir ../data/finetune_yolo
+"""
+
+import concurrent.futures
+import os
+import time
+import zlib
+
+import numpy as np
+from absl import app
+from absl import flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string('label_dir', '../data/finetune_yolo/labels', 'Folder of YOLO label files.')
+flags.DEFINE_integer('image_width', 800, 'Image width, for the box sizes in pixels.')
+flags.DEFINE_integer('image_height', 600, 'Image height, for the box sizes in pixels.')
+flags.DEFINE_float('val_fraction', 0.1, 'Fraction of the frames in the validation split.')
+flags.DEFINE_string('split_dir', '', 'Write train.txt and val.txt image lists there.')
+
+CACHE_VERSION = 1
+
+
+def scan(labels_dir):
+  """Names (relative, no suffix), mtimes (ns) and sizes of all label files."""
+  names, mtimes, sizes = [], [], []
+  stack = ['']
+  while stack:
+    rel = stack.pop()
+    with os.scandir(os.path.join(labels_dir, rel)) as entries:
+      for entry in entries:
+        if entry.is_dir():
+          stack.append(os.path.join(rel, entry.name))
+        elif entry.name.endswith('.txt'):
+          stat = entry.stat()
+          names.append(os.path.join(rel, entry.name[:-4]))
+          mtimes.append(stat.st_mtime_ns)
+          sizes.append(stat.st_size)
+  order = np.argsort(names)
+  return (np.array(names, dtype=str)[order] if names else np.zeros(0, dtype='<U1'),
+          np.array(mtimes, dtype=np.int64)[order], np.array(sizes, dtype=np.int64)[order])
+
+
+def _read(path):
+  with open(path, 'rb') as f:
+    return f.read()
+
+
+def parse(texts):
+  """(N, 5) rows and per text box counts (-1 if malformed) of label file contents.
+
+  All files are split at once. A file whose number of values is not a multiple
+  of 5 is malformed, its boxes are left out.
+  """
+  tokens = [t.split() for t in texts]
+  counts = np.array([len(t) for t in tokens], dtype=np.int64)
+  malformed = counts % 5 != 0
+  flat = [v for t, bad in zip(tokens, malformed) if not bad for v in t]
+  try:
+    rows = np.array(flat, dtype=np.float32).reshape(-1, 5)
+  except ValueError:  # A value that is not a number, find the files one by one.
+    rows_list = []
+    for i, t in enumerate(tokens):
+      if malformed[i]:
+        continue
+      try:
+        rows_list.append(np.array(t, dtype=np.float32).reshape(-1, 5))
+      except ValueError:
+        malformed[i] = True
+    rows = np.concatenate(rows_list) if rows_list else np.zeros((0, 5), dtype=np.float32)
+  counts = np.where(malformed, -1, counts // 5)
+  return rows, counts
+
+
+class LabelIndex:
+  """All boxes of a YOLO labels folder, as columns."""
+
+  def __init__(self, labels_dir, cache_path=None, refresh=True, num_readers=16):
+    self.labels_dir = os.path.normpath(labels_dir)
+    self.cache_path = cache_path or self.labels_dir + '.index.npz'
+    self.num_readers = num_readers
+    self._set(np.zeros(0, dtype='<U1'), np.zeros(0, np.int64), np.zeros(0, np.int64),
+              np.zeros(0, np.int64), np.zeros((0, 5), np.float32))
+    if os.path.isfile(self.cache_path):
+      self._load()
+    if refresh:
+      self.refresh()
+
+  def _set(self, names, mtimes, sizes, counts, rows):
+    self.names = names
+    self.mtimes = mtimes
+    self.sizes = sizes
+    self.counts = counts  # Boxes per file, -1 if malformed
+    self.offsets = np.concatenate([[0], np.cumsum(np.maximum(counts, 0))]).astype(np.int64)
+    self.image = np.repeat(np.arange(len(names), dtype=np.int32), np.maximum(counts, 0))
+    self.cls = rows[:, 0].astype(np.int32)
+    self.boxes = rows[:, 1:5]  # cx, cy, w, h
+    self._rows = rows
+
+  def __len__(self):
+    return len(self.names)
+
+  @property
+  def num_boxes(self):
+    return len(self.cls)
+
+  def get(self, name):
+    """(M, 5) class, cx, cy, w, h rows of the label file `name`, None if there is none."""
+    i = np.searchsorted(self.names, name)
+    if i == len(self.names) or self.names[i] != name or self.counts[i] < 0:
+      return None
+    return self._rows[self.offsets[i]:self.offsets[i + 1]]
+
+  def _load(self):
+    with np.load(self.cache_path) as cache:
+      if int(cache['version']) != CACHE_VERSION:
+        return
+      self._set(cache['names'], cache['mtimes'], cache['sizes'], cache['counts'], cache['rows'])
+
+  def save(self):
+    """Write the cache, atomically."""
+    tmp_path = self.cache_path + '.tmp.npz'
+    np.savez(tmp_path, version=CACHE_VERSION, names=self.names, mtimes=self.mtimes,
+             sizes=self.sizes, counts=self.counts, rows=self._rows)
+    os.replace(tmp_path, self.cache_path)
+
+  def refresh(self):
+    """Re-read the files that changed since the cache was written.
+
+    Returns how many files were parsed. The cache is saved if anything changed.
+    """
+    names, mtimes, sizes = scan(self.labels_dir)
+    # Where each file was in the cache, -1 if it is new.
+    where = np.full(len(names), -1, dtype=np.int64)
+    if len(self.names):
+      pos = np.clip(np.searchsorted(self.names, names), 0, len(self.names) - 1)
+      known = self.names[pos] == names
+      where[known] = pos[known]
+    unchanged = where >= 0
+    unchanged[unchanged] = ((self.mtimes[where[unchanged]] == mtimes[unchanged])
+                            & (self.sizes[where[unchanged]] == sizes[unchanged]))
+    stale = np.flatnonzero(~unchanged)
+    if not len(stale) and len(names) == len(self.names):
+      return 0
+
+    paths = [os.path.join(self.labels_dir, n + '.txt') for n in names[stale]]
+    with concurrent.futures.ThreadPoolExecutor(self.num_readers) as pool:
+      texts = list(pool.map(_read, paths))
+    new_rows, new_counts = parse(texts)
+
+    # Counts and rows in the new file order: where each file's block starts in
+    # the old rows followed by the new ones, then one gather of all rows.
+    counts = np.zeros(len(names), dtype=np.int64)
+    counts[unchanged] = self.counts[where[unchanged]]
+    counts[stale] = new_counts
+    starts = np.zeros(len(names), dtype=np.int64)
+    starts[unchanged] = self.offsets[where[unchanged]]
+    starts[stale] = len(self._rows) + np.concatenate([[0], np.cumsum(np.maximum(new_counts, 0))])[:-1]
+    lengths = np.maximum(counts, 0)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    gather = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+    rows = np.concatenate([self._rows, new_rows])[gather]
+    self._set(names, mtimes, sizes, counts, rows)
+    self.save()
+    return len(stale)
+
+  # Queries, all vectorized over the columns.
+
+  def class_histogram(self, num_classes=None):
+    """Boxes per class id."""
+    return np.bincount(self.cls, minlength=num_classes or 0)
+
+  def frames_per_class(self, num_classes=None):
+    """Label files with at least one box of each class."""
+    pairs = np.unique(self.image.astype(np.int64) * (self.cls.max(initial=0) + 1) + self.cls)
+    return np.bincount(pairs % (self.cls.max(initial=0) + 1), minlength=num_classes or 0)
+
+  def box_sizes(self, width=1, height=1, bins=10):
+    """Histogram of sqrt(box area), in pixels if the image size is given."""
+    side = np.sqrt(self.boxes[:, 2] * width * self.boxes[:, 3] * height)
+    return np.histogram(side, bins=bins)
+
+  def empty_frames(self):
+    """Names of the label files without any box."""
+    return self.names[self.counts == 0]
+
+  def malformed(self):
+    """Names of the label files that could not be parsed."""
+    return self.names[self.counts < 0]
+
+  def invalid_boxes(self):
+    """Per box: class not a non-negative integer, or box not inside the image."""
+    cx, cy, w, h = self.boxes.T
+    rows = self._rows
+    return ((rows[:, 0] < 0) | (rows[:, 0] != np.round(rows[:, 0]))
+            | (w <= 0) | (h <= 0)
+            | (cx - w / 2 < -1e-3) | (cx + w / 2 > 1 + 1e-3)
+            | (cy - h / 2 < -1e-3) | (cy + h / 2 > 1 + 1e-3))
+
+  def invalid_frames(self):
+    """Names of the label files with at least one invalid box."""
+    return self.names[np.unique(self.image[self.invalid_boxes()])]
+
+  def select(self, classes=None, min_size=0.0):
+    """Mask of the boxes of `classes` with both sides at least `min_size` (normalized)."""
+    mask = (self.boxes[:, 2] >= min_size) & (self.boxes[:, 3] >= min_size)
+    if classes is not None:
+      mask &= np.isin(self.cls, classes)
+    return mask
+
+  def split(self, val_fraction=0.1, seed=0):
+    """(train, val) names, by a hash of the name.
+
+    A frame stays on its side when the dataset grows, unlike a shuffled split.
+    """
+    salt = str(seed).encode()
+    hashes = np.array([zlib.crc32(salt + n.encode()) for n in self.names], dtype=np.uint64)
+    val = hashes % 10000 < int(val_fraction * 10000)
+    return self.names[~val], self.names[val]
+
+  def image_paths(self, names, images_dir=None, suffix='.png'):
+    """Image paths of label `names`, `images` next to `labels` by default (as YOLOv5)."""
+    if images_dir is None:
+      images_dir = os.path.join(os.path.dirname(self.labels_dir), 'images')
+    return [os.path.join(images_dir, n + suffix) for n in names]
+
+
+def main(argv):
+  start = time.perf_counter()
+  index = LabelIndex(FLAGS.label_dir, refresh=False)
+  parsed = index.refresh()
+  print(f'{len(index)} label files, {index.num_boxes} boxes, {parsed} files parsed '
+        f'in {time.perf_counter() - start:.2f}s')
+  print(f'boxes per class: {dict(enumerate(index.class_histogram().tolist()))}')
+  print(f'frames per class: {dict(enumerate(index.frames_per_class().tolist()))}')
+  counts, edges = index.box_sizes(FLAGS.image_width, FLAGS.image_height, bins=[0, 8, 16, 32, 64, 128, 256, 1e9])
+  print('box side (px): ' + ', '.join(f'<{e:g}: {c}' for c, e in zip(counts, edges[1:])))
+  print(f'empty: {len(index.empty_frames())}, malformed: {len(index.malformed())}, '
+        f'invalid: {len(index.invalid_frames())}')
+  train, val = index.split(FLAGS.val_fraction)
+  print(f'split: {len(train)} train, {len(val)} val')
+  if FLAGS.split_dir:
+    for name, names in (('train', train), ('val', val)):
+      with open(os.path.join(FLAGS.split_dir, f'{name}.txt'), 'w') as f:
+        f.writelines(p + '\n' for p in index.image_paths(names))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,116 @@
+"""
+Load YOLO models once, from local files, and warm them up.
+
+`torch.hub.load('ultralytics/yolov5', 'yolov5l6', pretrained=True)` resolves the
+hub and maybe downloads on every start. Here the weights are looked up in
+`MODEL_DIR` first (e.g. `yolov5l6.pt`, the fine-tuned `yolov5l6_ft.pt` or their
+exported `.torchscript`/`.onnx`), the yolov5 code comes from the local clone
+`YOLOV5_DIR` when it is there, and the built model is cached for the process.
+
+  model = load_yolo('yolov5l6')  # ../model/pretrained/yolov5l6.pt
+  model = load_yolo('yolov5l6_ft', prefer='torchscript', warmup_runs=2)
+"""
+
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+MODEL_DIR = Path(os.path.abspath(os.path.dirname(__file__))) / '..' / 'model' / 'pretrained'
+YOLOV5_DIR = Path(os.path.abspath(os.path.dirname(__file__))) / '..' / '..' / '..' / 'common' / 'yolov5'
+YOLOV5_REPO = 'ultralytics/yolov5'
+# Where the pretrained weights are released, and the detection models that are.
+WEIGHTS_URL = 'https://github.com/ultralytics/yolov5/releases/download/v7.0/{name}.pt'
+RELEASED_WEIGHTS = frozenset(f'yolov5{size}{p6}' for size in 'nsmlx' for p6 in ('', '6'))
+# File suffix of each format, as written by yolov5 `export.py`.
+SUFFIXES = {'pt': '.pt', 'torchscript': '.torchscript', 'onnx': '.onnx'}
+
+_models = {}  # Built models, keyed by (name, prefer, device, model_dir)
+
+
+def weights_path(name, fmt='pt', model_dir=MODEL_DIR):
+  """Where the weights of `name` in format `fmt` live, it may not exist yet."""
+  return Path(model_dir) / f'{name}{SUFFIXES[fmt]}'
+
+
+def resolve_weights(name, prefer=None, model_dir=MODEL_DIR):
+  """The local weights file to load, `prefer` format first, then `.pt`, or None."""
+  for fmt in ([prefer] if prefer else []) + ['pt']:
+    path = weights_path(name, fmt, model_dir)
+    if path.is_file():
+      return path
+  return None
+
+
+def export_model(name, include=('torchscript',), img_size=(640, 640), model_dir=MODEL_DIR):
+  """Export local `.pt` weights with yolov5 `export.py`, next to the weights."""
+  weights = weights_path(name, 'pt', model_dir)
+  if not weights.is_file():
+    raise FileNotFoundError(f'No weights to export at {weights}')
+  subprocess.check_call([
+      sys.executable, str(YOLOV5_DIR / 'export.py'), '--weights', str(weights),
+      '--imgsz', str(img_size[0]), str(img_size[1]), '--include', *include,
+  ])
+  return [weights_path(name, fmt, model_dir) for fmt in include]
+
+
+def download_weights(name, model_dir=MODEL_DIR):
+  """Download the released `<name>.pt` into `model_dir`, returns its path.
+
+  `torch.hub.load(..., pretrained=True)` would save it in the current directory
+  instead, and download it again from anywhere else. Raises FileNotFoundError
+  for a name that is not released, e.g. a fine-tuned `yolov5l6_ft`.
+  """
+  path = weights_path(name, 'pt', model_dir)
+  if name not in RELEASED_WEIGHTS:
+    raise FileNotFoundError(f'No weights for {name} in {model_dir}, expected {path} '
+                            f'(only {", ".join(sorted(RELEASED_WEIGHTS))} can be downloaded)')
+  path.parent.mkdir(parents=True, exist_ok=True)
+  url = WEIGHTS_URL.format(name=name)
+  print(f'No local weights for {name} in {model_dir}, downloading {url}')
+  tmp_path = path.with_suffix('.pt.tmp')
+  torch.hub.download_url_to_file(url, str(tmp_path))
+  os.replace(tmp_path, path)
+  return path
+
+
+def _build(name, prefer, device, model_dir):
+  weights = resolve_weights(name, prefer, model_dir)
+  local_repo = (YOLOV5_DIR / 'hubconf.py').is_file()
+  repo, source = (str(YOLOV5_DIR), 'local') if local_repo else (YOLOV5_REPO, 'github')
+  if weights is None:
+    # Nothing local yet, download the released weights once into `model_dir`.
+    weights = download_weights(name, model_dir)
+  print(f'Loading {name} from {weights}')
+  return torch.hub.load(repo, 'custom', path=str(weights), device=device, source=source)
+
+
+def warmup(model, runs=1, img_size=(600, 800)):
+  """Run blank frames through the model so the first real frame is not slow."""
+  blank = np.zeros((img_size[0], img_size[1], 3), dtype=np.uint8)
+  for _ in range(runs):
+    model(blank)
+
+
+def load_yolo(name='yolov5l6', prefer=None, device=None, warmup_runs=1,
+              warmup_size=(600, 800), model_dir=MODEL_DIR):
+  """Build (or get the cached) YOLOv5 AutoShape model of `name`.
+
+  `prefer` may be 'torchscript' or 'onnx' to load an exported artifact instead
+  of the `.pt` file when there is one. The model is warmed up with
+  `warmup_runs` blank frames of `warmup_size` (height, width) when it is built.
+  """
+  key = (name, prefer, device, str(model_dir))
+  if key not in _models:
+    start = time.perf_counter()
+    model = _build(name, prefer, device, model_dir)
+    loaded = time.perf_counter()
+    warmup(model, warmup_runs, warmup_size)
+    print(f'{name} loaded in {loaded - start:.2f}s, '
+          f'warmed up in {time.perf_counter() - loaded:.2f}s')
+    _models[key] = model
+  return _models[key]
@@ -0,0 +1,244 @@
+"""
+Track detected objects across frames, so YOLO only has to run every few frames.
+
+At 25 Hz consecutive frames are nearly the same, yet `yolov5l6` ran on every
+one. The `Tracker` keeps a constant velocity Kalman filter per object (box
+center, size and their velocities, as in SORT), all tracks in one array, so
+predicting and updating them is a few batched matrix products. On a detected
+frame the predicted boxes are matched to the detections of the same class by
+IoU, greedily from the best pair, then what is left by center distance (a new
+track does not know its velocity yet, a fast small car may not overlap its
+prediction five frames later); on the other frames the tracks are only
+predicted forward. Each track keeps its id for as long as it is matched, and
+every box it had is kept for its trajectory.
+
+  tracker = Tracker(detect_every=5)
+  for frame_id, frame in frames:
+    det = yolov5_xyxy(model(frame))[0] if tracker.should_detect() else None
+    tracks = tracker.step(frame_id, det)  # (K, 7) x1, y1, x2, y2, conf, class, id
+  trajectories = tracker.trajectories()   # id -> (L, 5) frame, x1, y1, x2, y2
+"""
+
+import numpy as np
+
+# Noise of the filter relative to the box height, as in DeepSORT.
+STD_POSITION = 1.0 / 20
+STD_VELOCITY = 1.0 / 160
+
+# 8-state constant velocity model (cx, cy, w, h and their velocities per frame),
+# the detections measure the first 4.
+_F = np.eye(8)
+_F[:4, 4:] = np.eye(4)
+_H = np.eye(4, 8)
+
+
+def box_iou(a, b):
+  """(N, M) IoU of x1, y1, x2, y2 boxes."""
+  lt = np.maximum(a[:, None, :2], b[None, :, :2])
+  rb = np.minimum(a[:, None, 2:4], b[None, :, 2:4])
+  inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+  area_a = np.prod(a[:, 2:4] - a[:, :2], axis=1)
+  area_b = np.prod(b[:, 2:4] - b[:, :2], axis=1)
+  return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def xyxy_to_cxcywh(boxes):
+  wh = boxes[:, 2:4] - boxes[:, :2]
+  return np.concatenate([boxes[:, :2] + wh / 2, wh], axis=1)
+
+
+def cxcywh_to_xyxy(boxes):
+  half = boxes[:, 2:4] / 2
+  return np.concatenate([boxes[:, :2] - half, boxes[:, :2] + half], axis=1)
+
+
+def _noise(h, std):
+  """(N, K, K) diagonal covariances, `std` per state scaled by box heights `h`."""
+  std = h[:, None] * np.asarray(std)[None, :]
+  noise = np.zeros(std.shape + (std.shape[1],))
+  idx = np.arange(std.shape[1])
+  noise[:, idx, idx] = std ** 2
+  return noise
+
+
+def center_similarity(a, b):
+  """(N, M) 1 - center distance over the diagonal of the `a` box, of x1, y1, x2, y2 boxes."""
+  ca = (a[:, None, :2] + a[:, None, 2:4]) / 2
+  cb = (b[None, :, :2] + b[None, :, 2:4]) / 2
+  diagonal = np.hypot(a[:, 2] - a[:, 0], a[:, 3] - a[:, 1])[:, None]
+  return 1.0 - np.hypot(*(ca - cb).transpose(2, 0, 1)) / np.maximum(diagonal, 1e-9)
+
+
+def greedy_match(iou, threshold):
+  """(rows, cols) of pairs with IoU >= `threshold`, best first, each row and column once."""
+  rows, cols = np.nonzero(iou >= threshold)
+  order = np.argsort(-iou[rows, cols])
+  taken_rows = np.zeros(iou.shape[0], dtype=bool)
+  taken_cols = np.zeros(iou.shape[1], dtype=bool)
+  matched = []
+  for r, c in zip(rows[order], cols[order]):
+    if not taken_rows[r] and not taken_cols[c]:
+      taken_rows[r] = taken_cols[c] = True
+      matched.append((r, c))
+  matched = np.array(matched, dtype=np.intp).reshape(-1, 2)
+  return matched[:, 0], matched[:, 1]
+
+
+def group_trajectories(rows, min_length=2):
+  """id -> (L, 5) frame, x1, y1, x2, y2 of (R, 6+) frame, id, x1, y1, x2, y2 rows."""
+  if not len(rows):
+    return {}
+  rows = rows[np.lexsort((rows[:, 0], rows[:, 1]))]
+  ids, starts, counts = np.unique(rows[:, 1], return_index=True, return_counts=True)
+  return {int(i): rows[s:s + c][:, [0, 2, 3, 4, 5]]
+          for i, s, c in zip(ids, starts, counts) if c >= min_length}
+
+
+class Tracker:
+  """IoU-matched Kalman tracks with stable ids, for detections of some frames."""
+
+  def __init__(self, detect_every=5, iou_threshold=0.3, max_age=None, min_hits=2,
+               max_uncertainty=None, keep_history=True, first_id=0):
+    """A track is shown after `min_hits` detections and dropped when it was not
+    detected for `max_age` frames (two detection rounds by default).
+
+    `should_detect()` also asks for a detection before `detect_every` frames
+    when a track's center is more uncertain than `max_uncertainty` pixels.
+    Ids are given from `first_id` on.
+    """
+    self.detect_every = detect_every
+    self.iou_threshold = iou_threshold
+    self.max_age = max_age if max_age is not None else 2 * detect_every
+    self.min_hits = min_hits
+    self.max_uncertainty = max_uncertainty
+    self.keep_history = keep_history
+    self._x = np.zeros((0, 8))  # States
+    self._p = np.zeros((0, 8, 8))  # Covariances
+    self._ids = np.zeros(0, dtype=np.int64)
+    self._cls = np.zeros(0)
+    self._conf = np.zeros(0)
+    self._hits = np.zeros(0, dtype=np.int64)
+    self._age = np.zeros(0, dtype=np.int64)  # Frames since the last match
+    self._next_id = first_id
+    self._since_detect = None
+    self._history = []  # (K, 7) frame, id, x1, y1, x2, y2, class per step
+    # Counters, only for reading.
+    self.frame_count = 0
+    self.detect_count = 0
+
+  def __len__(self):
+    return len(self._ids)
+
+  def should_detect(self):
+    """Whether the next frame should go to the detector."""
+    if self._since_detect is None or self._since_detect + 1 >= self.detect_every:
+      return True
+    if self.max_uncertainty is not None and len(self._p):
+      std = np.sqrt(self._p[:, 0, 0] + self._p[:, 1, 1])
+      return bool((std > self.max_uncertainty).any())
+    return False
+
+  def _predict(self):
+    # The size must not shrink below zero by its velocity.
+    self._x[:, 6:8] = np.where(self._x[:, 2:4] + self._x[:, 6:8] <= 0, 0, self._x[:, 6:8])
+    h = self._x[:, 3]
+    q = _noise(h, [STD_POSITION] * 4 + [STD_VELOCITY] * 4)
+    self._x = self._x @ _F.T
+    self._p = _F @ self._p @ _F.T + q
+    self._age += 1
+
+  def _update(self, tracks, det):
+    x, p = self._x[tracks], self._p[tracks]
+    z = xyxy_to_cxcywh(det[:, :4])
+    r = _noise(x[:, 3], [STD_POSITION] * 4)
+    s = _H @ p @ _H.T + r  # (M, 4, 4)
+    pht = p @ _H.T  # (M, 8, 4)
+    gain = np.linalg.solve(s, pht.transpose(0, 2, 1)).transpose(0, 2, 1)
+    self._x[tracks] = x + (gain @ (z - x[:, :4])[:, :, None])[:, :, 0]
+    self._p[tracks] = p - gain @ _H @ p
+    self._conf[tracks] = det[:, 4]
+    self._hits[tracks] += 1
+    self._age[tracks] = 0
+
+  def _add(self, det):
+    n = len(det)
+    x = np.zeros((n, 8))
+    x[:, :4] = xyxy_to_cxcywh(det[:, :4])
+    h = x[:, 3]
+    p = _noise(h, [2 * STD_POSITION] * 4 + [10 * STD_VELOCITY] * 4)
+    self._x = np.concatenate([self._x, x])
+    self._p = np.concatenate([self._p, p])
+    self._ids = np.concatenate([self._ids, np.arange(self._next_id, self._next_id + n)])
+    self._next_id += n
+    self._cls = np.concatenate([self._cls, det[:, 5]])
+    self._conf = np.concatenate([self._conf, det[:, 4]])
+    self._hits = np.concatenate([self._hits, np.ones(n, dtype=np.int64)])
+    self._age = np.concatenate([self._age, np.zeros(n, dtype=np.int64)])
+
+  def _keep(self, mask):
+    self._x, self._p, self._ids = self._x[mask], self._p[mask], self._ids[mask]
+    self._cls, self._conf = self._cls[mask], self._conf[mask]
+    self._hits, self._age = self._hits[mask], self._age[mask]
+
+  def step(self, frame_id, det=None):
+    """Advance one frame, with its (N, 6) detections or None if it was not detected.
+
+    Returns the shown tracks, (K, 7) x1, y1, x2, y2, conf, class, id.
+    """
+    self.frame_count += 1
+    self._predict()
+    if det is not None:
+      self.detect_count += 1
+      self._since_detect = 0
+      det = np.asarray(det, dtype=np.float64).reshape(-1, 6)
+      predicted = cxcywh_to_xyxy(self._x[:, :4])
+      other_class = self._cls[:, None] != det[None, :, 5]
+      iou = box_iou(predicted, det[:, :4])
+      iou[other_class] = 0.0
+      tracks, matched = greedy_match(iou, self.iou_threshold)
+      # Then the rest by center distance, up to one box diagonal.
+      similarity = center_similarity(predicted, det[:, :4])
+      similarity[other_class] = -1.0
+      similarity[tracks] = -1.0
+      similarity[:, matched] = -1.0
+      more_tracks, more_matched = greedy_match(similarity, 0.0)
+      tracks = np.concatenate([tracks, more_tracks])
+      matched = np.concatenate([matched, more_matched])
+      self._update(tracks, det[matched])
+      unmatched = np.ones(len(det), dtype=bool)
+      unmatched[matched] = False
+      self._keep(self._age <= self.max_age)
+      self._add(det[unmatched])
+    elif self._since_detect is not None:
+      self._since_detect += 1
+    # Confirmed, and not missed by the last detection.
+    shown = (((self._hits >= self.min_hits) | (self.frame_count <= self.min_hits))
+             & (self._age < self.detect_every))
+    boxes = cxcywh_to_xyxy(self._x[shown, :4])
+    out = np.concatenate([boxes, self._conf[shown, None], self._cls[shown, None],
+                          self._ids[shown, None]], axis=1)
+    if self.keep_history and len(out):
+      self._history.append(np.concatenate(
+          [np.full((len(out), 1), frame_id), out[:, 6:7], boxes, out[:, 5:6]], axis=1))
+    return out
+
+  def trajectories(self, min_length=2):
+    """id -> (L, 5) frame, x1, y1, x2, y2 of every shown track, by frame."""
+    return group_trajectories(self.history(), min_length)
+
+  def history(self):
+    """(R, 7) frame, id, x1, y1, x2, y2, class rows of every shown box so far."""
+    return np.concatenate(self._history) if self._history else np.zeros((0, 7))
+
+  def reset(self):
+    """Forget all tracks (not the history), e.g. after a gap in the frames."""
+    self._keep(np.zeros(len(self._ids), dtype=bool))
+    self._since_detect = None
+
+  def stats(self):
+    return {
+        'frames': self.frame_count,
+        'detected': self.detect_count,
+        'tracks': len(self._ids),
+        'ids': self._next_id,
+    }
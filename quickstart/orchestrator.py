@@ -0,0 +1,293 @@
+"""
+Run many scenario variations against one or more simulators at once, with asyncio.
+
+A scenario is a plain blocking function `scenario(ctx)`, written like the
+quickstart scripts (`ctx.client`, `ctx.world`, `ctx.params`). It spawns its
+actors through `ctx.spawn()` and checks `ctx.should_stop()` in its loop. The
+`Orchestrator` keeps a queue of jobs and, per simulator endpoint, `slots`
+workers that take the next job and run it on their own thread, under a timeout.
+Whatever happens, a job's actors are destroyed in one batch (by an
+`ActorRegistry`) and the world is put back to the settings it had, before the
+worker takes its next job.
+
+A job that puts the world in synchronous mode (`ctx.enable_sync()`) says so
+with `Job(..., synchronous=True)`: two synchronous masters would tick one world
+together, so those jobs need `slots=1`.
+
+  jobs = [Job(f'seed{s}', drive, {'seed': s, 'num_npcs': n}, timeout=120, synchronous=True)
+          for s in range(8) for n in (0, 50)]
+  results = asyncio.run(Orchestrator(['10.0.0.1:2000', '10.0.0.2:2000']).run(jobs))
+
+The 'fake' host is a `fake_endpoint.FakeClient`, to try the orchestration
+without a simulator:
+
+  python orchestrator.py --endpoints fake:0,fake:1 --seeds 0,1,2,3 --ticks 100
+"""
+
+import asyncio
+import collections
+import itertools
+import random
+import threading
+import time
+
+from absl import app
+from absl import flags
+
+from actor_registry import ActorRegistry
+from fake_endpoint import FakeClient
+from tick_driver import TickDriver
+
+try:
+  import carla
+except ImportError:  # Only the fake endpoint works without the CARLA client.
+  carla = None
+
+FLAGS = flags.FLAGS
+flags.DEFINE_list('endpoints', ['127.0.0.1:2000'], 'host:port of each simulator, fake:N for a fake.')
+flags.DEFINE_integer('slots', 1, 'Jobs at the same time per endpoint, 1 for synchronous jobs.')
+flags.DEFINE_list('seeds', ['0', '1'], 'random seeds, one job per seed and vehicle count.')
+flags.DEFINE_list('num_npcs', ['30'], 'NPC vehicle counts.')
+flags.DEFINE_list('weathers', ['ClearNoon'], 'carla.WeatherParameters presets.')
+flags.DEFINE_integer('ticks', 500, 'Ticks per job.')
+flags.DEFINE_float('timeout', 300.0, 'Seconds a job may take.')
+
+FAKE_HOST = 'fake'
+OK = 'ok'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+
+Endpoint = collections.namedtuple('Endpoint', ['host', 'port'])
+# `scenario(ctx)` is called with `params`, `timeout` is in seconds (None is no limit),
+# `synchronous` if it calls `ctx.enable_sync()`.
+Job = collections.namedtuple('Job', ['name', 'scenario', 'params', 'timeout', 'synchronous'],
+                             defaults=(None, False))
+# `status` is OK, FAILED or TIMEOUT, `result` what the scenario returned.
+JobResult = collections.namedtuple('JobResult', ['name', 'endpoint', 'status', 'result', 'error',
+                                                 'elapsed'])
+
+
+def parse_endpoint(text):
+  host, _, port = text.rpartition(':')
+  return Endpoint(host, int(port))
+
+
+def _run_in_thread(loop, fn, *args):
+  """An asyncio future of `fn(*args)`, run on a new daemon thread.
+
+  Not an executor: the threads of `concurrent.futures` are joined at exit, so
+  one job stuck on a dead server would keep the process from ever exiting.
+  """
+  future = loop.create_future()
+
+  def set_result(result, error):
+    if future.done():
+      return
+    if error is not None:
+      future.set_exception(error)
+    else:
+      future.set_result(result)
+
+  def target():
+    try:
+      result, error = fn(*args), None
+    except BaseException as e:
+      result, error = None, e
+    try:
+      loop.call_soon_threadsafe(set_result, result, error)
+    except RuntimeError:  # The loop is closed, nobody waits for it anymore.
+      pass
+
+  threading.Thread(target=target, name=getattr(fn, '__name__', 'job'), daemon=True).start()
+  return future
+
+
+def connect(endpoint, timeout=5.0):
+  """A `carla.Client` of `endpoint`, or a `FakeClient` for the 'fake' host."""
+  if endpoint.host == FAKE_HOST:
+    return FakeClient()
+  client = carla.Client(endpoint.host, endpoint.port)
+  client.set_timeout(timeout)
+  return client
+
+
+class JobContext:
+  """What a running scenario gets: the client, the world and its parameters."""
+
+  def __init__(self, endpoint, params, synchronous=False):
+    self.endpoint = endpoint
+    self.params = dict(params or {})
+    self.synchronous = synchronous
+    self.client = None
+    self.world = None
+    self.actors = None  # The `ActorRegistry` of the job
+    self._stop = threading.Event()
+
+  @property
+  def is_fake(self):
+    return self.endpoint.host == FAKE_HOST
+
+  def enable_sync(self, fixed_delta_seconds=0.04, tm=None):
+    """Synchronous mode until the job ends, only for a `Job(synchronous=True)`."""
+    if not self.synchronous:
+      raise RuntimeError('Synchronous mode in a job without Job.synchronous, it could '
+                         'share the world with another job')
+    self.actors.enable_sync(fixed_delta_seconds, tm)
+
+  def spawn(self, blueprint, transform, attach_to=None):
+    """`world.spawn_actor()`, the actor is destroyed when the job ends."""
+    return self.actors.spawn(blueprint, transform, attach_to)
+
+  def track(self, actors):
+    """Destroy these `actors` (e.g. from `spawn_npcs()`) when the job ends."""
+    return self.actors.track(actors)
+
+  def should_stop(self):
+    """True once the job timed out, the scenario should return soon."""
+    return self._stop.is_set()
+
+  def cancel(self):
+    self._stop.set()
+
+
+class Orchestrator:
+  """Runs a queue of jobs on a pool of simulator endpoints."""
+
+  def __init__(self, endpoints, slots=1, connect=connect, grace=10.0):
+    """`grace` is how long a timed out job gets to return and clean up."""
+    self.endpoints = [parse_endpoint(e) if isinstance(e, str) else e for e in endpoints]
+    self.slots = slots
+    self.connect = connect
+    self.grace = grace
+    # Counters, only for reading.
+    self.lost_slots = 0  # Workers retired because a job never returned.
+
+  def _run_blocking(self, endpoint, job, ctx):
+    ctx.client = self.connect(endpoint)
+    ctx.world = ctx.client.get_world()
+    settings = ctx.world.get_settings()
+    try:
+      # Also reaps what jobs of a crashed orchestrator left on this endpoint.
+      with ActorRegistry(ctx.client, f'{endpoint.host}:{endpoint.port}') as ctx.actors:
+        return job.scenario(ctx)
+    finally:
+      ctx.world.apply_settings(settings)
+
+  async def _run_job(self, endpoint, job):
+    """Runs one job, returns its `JobResult` and whether the worker can go on."""
+    loop = asyncio.get_running_loop()
+    ctx = JobContext(endpoint, job.params, job.synchronous)
+    start = time.perf_counter()
+    future = _run_in_thread(loop, self._run_blocking, endpoint, job, ctx)
+    status, result, error, healthy = OK, None, None, True
+    try:
+      # Shielded, so the job keeps its thread until it cleaned up.
+      result = await asyncio.wait_for(asyncio.shield(future), job.timeout)
+    except asyncio.TimeoutError:
+      status, error = TIMEOUT, f'Did not finish in {job.timeout}s'
+      ctx.cancel()
+      try:
+        await asyncio.wait_for(asyncio.shield(future), self.grace)
+      except asyncio.TimeoutError:
+        # Still blocked on the server, its thread can't take another job.
+        healthy = False
+      except Exception:
+        pass
+    except Exception as e:
+      status, error = FAILED, repr(e)
+    return JobResult(job.name, f'{endpoint.host}:{endpoint.port}', status, result, error,
+                     time.perf_counter() - start), healthy
+
+  async def _worker(self, endpoint, queue, results):
+    while True:
+      try:
+        index, job = queue.get_nowait()
+      except asyncio.QueueEmpty:
+        return
+      result, healthy = await self._run_job(endpoint, job)
+      results[index] = result
+      print(f'{result.name} on {result.endpoint}: {result.status} in {result.elapsed:.1f}s'
+            + (f' ({result.error})' if result.error else ''))
+      if not healthy:
+        # Its thread is left behind, a daemon, so it does not block the exit.
+        self.lost_slots += 1
+        return
+
+  async def run(self, jobs):
+    """Run all `jobs`, returns their `JobResult`s in the order they were given.
+
+    Raises ValueError for synchronous jobs with more than one slot per endpoint.
+    """
+    jobs = list(jobs)
+    if self.slots > 1 and any(job.synchronous for job in jobs):
+      raise ValueError(f'{self.slots} slots per endpoint, synchronous jobs need 1: '
+                       'they would all tick the same world')
+    queue = asyncio.Queue()
+    for item in enumerate(jobs):
+      queue.put_nowait(item)
+    results = [None] * len(jobs)
+    await asyncio.gather(*[self._worker(endpoint, queue, results)
+                           for endpoint in self.endpoints for _ in range(self.slots)])
+    # Jobs never started if every worker was lost.
+    while not queue.empty():
+      index, job = queue.get_nowait()
+      results[index] = JobResult(job.name, None, FAILED, None, 'No endpoint left', 0.0)
+    return results
+
+
+def drive(ctx):
+  """Scenario: an ego car with a camera among `num_npcs` NPCs, for `ticks` ticks."""
+  params = ctx.params
+  rng = random.Random(params.get('seed', 0))
+  world = ctx.world
+  tm = None if ctx.is_fake else ctx.client.get_trafficmanager()
+  ctx.enable_sync(0.04, tm)
+  if params.get('weather') and not ctx.is_fake:
+    world.set_weather(getattr(carla.WeatherParameters, params['weather']))
+
+  blueprint_library = world.get_blueprint_library()
+  spawn_points = world.get_map().get_spawn_points()
+  ego_transform = rng.choice(spawn_points)
+  ego = ctx.spawn(blueprint_library.find('vehicle.tesla.model3'), ego_transform)
+  # The fake takes any transform, there may be no `carla.Transform` to make one.
+  camera_transform = (ego_transform if ctx.is_fake
+                      else carla.Transform(carla.Location(x=1.2, z=1.2)))
+  camera = ctx.spawn(blueprint_library.find('sensor.camera.rgb'), camera_transform,
+                     attach_to=ego)
+  num_npcs = params.get('num_npcs', 0)
+  if num_npcs and ctx.is_fake:
+    vehicles = blueprint_library.filter('vehicle')
+    for transform in rng.sample(spawn_points, min(num_npcs, len(spawn_points))):
+      ctx.spawn(rng.choice(vehicles), transform)
+  elif num_npcs:
+    from traffic import spawn_npcs
+    ctx.track(spawn_npcs(ctx.client, world, num_npcs, tm_port=tm.get_port(),
+                         exclude=[ego_transform], rng=rng))
+
+  driver = TickDriver(world)
+  driver.add_sensor('rgb', camera)
+  frames = 0
+  while frames < params.get('ticks', 100) and not ctx.should_stop():
+    bundle = driver.tick()
+    frames += bundle.data['rgb'] is not None
+  return {'ticks': driver.tick_count, 'frames': frames, 'missed': driver.missed_count}
+
+
+def main(argv):
+  variations = itertools.product(FLAGS.seeds, FLAGS.num_npcs, FLAGS.weathers)
+  jobs = [Job(f'seed{seed}_npcs{num}_{weather}', drive,
+              {'seed': int(seed), 'num_npcs': int(num), 'weather': weather, 'ticks': FLAGS.ticks},
+              FLAGS.timeout, synchronous=True)
+          for seed, num, weather in variations]
+  orchestrator = Orchestrator(FLAGS.endpoints, slots=FLAGS.slots)
+  start = time.perf_counter()
+  results = asyncio.run(orchestrator.run(jobs))
+  elapsed = time.perf_counter() - start
+  for result in results:
+    print(f'{result.name:40} {result.status:8} {result.elapsed:7.1f}s  {result.result or result.error}')
+  ok = sum(r.status == OK for r in results)
+  print(f'{ok}/{len(results)} jobs ok in {elapsed:.1f}s on {len(FLAGS.endpoints)} endpoints')
+
+
+if __name__ == '__main__':
+  app.run(main)
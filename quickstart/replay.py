@@ -0,0 +1,208 @@
+"""
+Replay recorded frames without a CARLA server.
+
+`ReplayWorld` and `ReplayCamera` have the same `tick()`/`listen()` surface as
+`carla.World` and a camera sensor, and the frames they hand out look like
+`carla.Image` (`raw_data` BGRA, `width`, `height`, `frame`, `timestamp`). So the
+display, recording and YOLO stages run on a laptop or a CI box, from a folder of
+images (e.g. `data/finetune_yolo/images`), a video (e.g. `out/*.mp4`) or a
+`frame_store` recording.
+
+  world, camera = open_replay('../out/show_by_opencv_offline.mp4', rate=25)
+  camera.listen(show_image)
+  while True:
+    world.tick()
+
+`rate=None` replays as fast as the consumer goes, for benchmarks. Run it to
+check a recording through the `TickDriver`:
+
+  python replay.py ../out/show_by_opencv_offline.mp4 [rate]
+"""
+
+import glob
+import os
+import queue
+import threading
+import time
+import types
+
+import cv2
+import numpy as np
+from absl import app
+
+from frame_store import FrameStoreReader
+from tick_driver import TickDriver
+
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.bmp')
+
+
+class ReplayExhausted(Exception):
+  """All frames were replayed and `loop` is off."""
+
+
+def load_frames(source, size=None, max_frames=None):
+  """Decode a folder of images or a video into BGRA frames, all in memory.
+
+  A `frame_store` recording of BGRA frames is memory-mapped instead, nothing is
+  decoded. `size` is (width, height) to resize to, like `image_size_x`/`image_size_y`.
+  """
+  if os.path.isfile(os.path.join(source, 'meta.json')):
+    store = FrameStoreReader(source)
+    frames = [store[i] for i in range(len(store))[:max_frames]]
+    if size is not None and store.shape[:2] != (size[1], size[0]):
+      frames = [cv2.resize(f, tuple(size), interpolation=cv2.INTER_AREA) for f in frames]
+    return frames
+
+  frames = []
+
+  def add(bgr):
+    if size is not None and (bgr.shape[1], bgr.shape[0]) != tuple(size):
+      bgr = cv2.resize(bgr, tuple(size), interpolation=cv2.INTER_AREA)
+    frames.append(cv2.cvtColor(bgr, cv2.COLOR_BGR2BGRA))
+
+  if os.path.isdir(source):
+    paths = sorted(p for p in glob.glob(os.path.join(source, '*'))
+                   if p.lower().endswith(IMAGE_SUFFIXES))
+    for path in paths[:max_frames]:
+      add(cv2.imread(path, cv2.IMREAD_COLOR))
+  else:
+    cap = cv2.VideoCapture(source)
+    try:
+      while max_frames is None or len(frames) < max_frames:
+        ok, bgr = cap.read()
+        if not ok:
+          break
+        add(bgr)
+    finally:
+      cap.release()
+  if not frames:
+    raise ValueError(f'No frames found in {source}')
+  return frames
+
+
+class ReplayImage:
+  """The part of `carla.Image` the pipelines use."""
+
+  def __init__(self, bgra, frame, timestamp):
+    self.height, self.width = bgra.shape[:2]
+    self.fov = 90.0
+    self.frame = frame
+    self.timestamp = timestamp
+    self.raw_data = memoryview(bgra).cast('B')
+
+  def save_to_disk(self, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    cv2.imwrite(path, np.frombuffer(self.raw_data, np.uint8).reshape(self.height, self.width, 4))
+
+
+class ReplayCamera:
+  """A camera sensor whose callback runs on its own thread, as in CARLA."""
+
+  type_id = 'sensor.camera.rgb'
+
+  def __init__(self, frames):
+    self.frames = frames
+    self._callback = None
+    self._inbox = queue.Queue()
+    self._thread = None
+
+  def listen(self, callback):
+    self._callback = callback
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._run, name='ReplayCamera', daemon=True)
+      self._thread.start()
+
+  def _run(self):
+    while True:
+      item = self._inbox.get()
+      if item is None:
+        break
+      callback = self._callback
+      if callback is not None:
+        callback(ReplayImage(*item))
+
+  def _deliver(self, index, frame, timestamp):
+    if self._callback is not None:
+      self._inbox.put((self.frames[index % len(self.frames)], frame, timestamp))
+
+  def is_listening(self):
+    return self._callback is not None
+
+  def stop(self):
+    self._callback = None
+
+  def destroy(self):
+    self.stop()
+    if self._thread is not None:
+      self._inbox.put(None)
+      self._thread.join()
+      self._thread = None
+
+
+class ReplayWorld:
+  """Ticks the replay, every tick sends the next frame to all cameras."""
+
+  def __init__(self, cameras, rate=25.0, fixed_delta_seconds=0.04, loop=True):
+    self.cameras = list(cameras)
+    self.rate = rate
+    self.fixed_delta_seconds = fixed_delta_seconds
+    self.loop = loop
+    self.frame = 0
+    self._start = None
+
+  @property
+  def num_frames(self):
+    return min(len(c.frames) for c in self.cameras)
+
+  def tick(self, seconds=None):
+    """Send the next frame to every camera, paced to `rate` if it is set."""
+    if not self.loop and self.frame >= self.num_frames:
+      raise ReplayExhausted(f'Replayed all {self.num_frames} frames')
+    if self.rate:
+      if self._start is None:
+        self._start = time.perf_counter()
+      delay = self._start + self.frame / self.rate - time.perf_counter()
+      if delay > 0:
+        time.sleep(delay)
+    index = self.frame
+    self.frame += 1
+    for camera in self.cameras:
+      camera._deliver(index, self.frame, self.frame * self.fixed_delta_seconds)
+    return self.frame
+
+  def get_snapshot(self):
+    timestamp = types.SimpleNamespace(frame=self.frame,
+                                      elapsed_seconds=self.frame * self.fixed_delta_seconds)
+    return types.SimpleNamespace(frame=self.frame, timestamp=timestamp)
+
+  def destroy(self):
+    for camera in self.cameras:
+      camera.destroy()
+
+
+def open_replay(source, rate=25.0, size=(800, 600), max_frames=None, loop=True):
+  """A `(world, camera)` pair replaying `source`, a folder of images or a video."""
+  camera = ReplayCamera(load_frames(source, size, max_frames))
+  return ReplayWorld([camera], rate=rate, loop=loop), camera
+
+
+def main(argv):
+  source = argv[1] if len(argv) > 1 else '../out/show_by_opencv_offline.mp4'
+  rate = float(argv[2]) if len(argv) > 2 else None
+  world, camera = open_replay(source, rate=rate, loop=False)
+  driver = TickDriver(world)
+  driver.add_sensor('rgb', camera)
+  start = time.perf_counter()
+  try:
+    driver.run(lambda bundle: None)
+  except ReplayExhausted:
+    pass
+  finally:
+    world.destroy()
+  elapsed = time.perf_counter() - start
+  print(f'Replayed {driver.tick_count} frames in {elapsed:.2f}s '
+        f'({driver.tick_count / elapsed:.1f} FPS), {driver.missed_count} missed')
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,275 @@
+"""
+Record a long run and post-process it chunk by chunk, resumable after a crash.
+
+Frames go into a `frame_store` and every time a chunk is complete it is handed
+to a background worker, while the simulation goes on. For each chunk the worker
+runs these stages, all on the same frames read once from the store:
+
+  * 'video'           encode the raw video segment
+  * 'detect:<model>'  run a YOLO model, save its detections and an annotated
+                      segment, every model on its own thread at the same time
+
+With `detect_every` N > 1 a model only runs on every Nth frame, an
+`object_tracker.Tracker` per model carries the boxes over the frames between and
+gives them ids that hold across chunks, unique within the run even when it
+is resumed; `load_trajectories()` reads them back.
+
+Each finished stage is checkpointed in `progress.json`, so after an
+interruption a new `ResumableRun` on the same directory continues the
+recording after the last complete chunk and only redoes the missing stages.
+`close()` finishes the last chunk and joins the segments into one video each.
+
+  <run_dir>/frames/             the frame store
+  <run_dir>/segments/<stage>/   one video segment per chunk and stage
+  <run_dir>/detections/<model>/ chunk_NNNNN.npz with frame ids and boxes (and track ids)
+  <run_dir>/<stage>.mp4         the joined videos
+"""
+
+import concurrent.futures
+import glob
+import json
+import os
+import shutil
+import subprocess
+import threading
+
+import cv2
+import numpy as np
+
+from frame_pipeline import BLOCK, FrameQueue, FrameWorker
+from frame_store import FrameStoreReader, FrameStoreWriter
+from object_tracker import Tracker, group_trajectories
+from video_recorder import VideoRecorder
+from yolo_worker import yolov5_xyxy
+
+RAW_STAGE = 'video'
+# The track ids of a tracker started on chunk N begin at N * ID_STRIDE, so a
+# tracker started again after a resume or a failed chunk never reuses the ids
+# of another one (as long as fewer than ID_STRIDE objects appear per chunk).
+ID_STRIDE = 1000000
+
+
+def draw_boxes(bgr, det, names=None, color=(0, 255, 0)):
+  """Draw (N, 6) x1, y1, x2, y2, conf, class detections on `bgr` in place.
+
+  A 7th column is a track id, shown as '#id'.
+  """
+  for row in det:
+    x1, y1, x2, y2, conf, cls = row[:6]
+    label = f'{names[int(cls)] if names else int(cls)} {conf:.2f}'
+    if len(row) > 6:
+      label += f' #{int(row[6])}'
+    cv2.rectangle(bgr, (int(x1), int(y1)), (int(x2), int(y2)), color, 2)
+    cv2.putText(bgr, label, (int(x1), int(y1) - 4), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+  return bgr
+
+
+def concat_videos(segments, out_path):
+  """Join video segments of the same size, without re-encoding if ffmpeg is there."""
+  if not segments:
+    return
+  if shutil.which('ffmpeg'):
+    list_path = out_path + '.txt'
+    with open(list_path, 'w') as f:
+      f.writelines(f"file '{os.path.abspath(s)}'\n" for s in segments)
+    subprocess.check_call(['ffmpeg', '-loglevel', 'error', '-y', '-f', 'concat', '-safe', '0',
+                           '-i', list_path, '-c', 'copy', out_path])
+    os.remove(list_path)
+    return
+  writer = None
+  for segment in segments:
+    cap = cv2.VideoCapture(segment)
+    while True:
+      ok, frame = cap.read()
+      if not ok:
+        break
+      if writer is None:
+        writer = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*'mp4v'),
+                                 cap.get(cv2.CAP_PROP_FPS), (frame.shape[1], frame.shape[0]))
+      writer.write(frame)
+    cap.release()
+  if writer is not None:
+    writer.release()
+
+
+class ResumableRun:
+  """Records frames into chunks and post-processes every finished chunk."""
+
+  def __init__(self, run_dir, shape, models=None, fps=25, chunk_frames=250, batch_size=8,
+               use_cuda=False, detect_every=1):
+    """`shape` is (height, width, 4) BGRA, `models` maps a name to a YOLOv5 AutoShape model.
+
+    `detect_every` > 1 runs the models on every Nth frame and tracks in between.
+    """
+    self.run_dir = run_dir
+    self.shape = tuple(shape)
+    self.models = dict(models or {})
+    self.fps = fps
+    self.batch_size = batch_size
+    self.use_cuda = use_cuda
+    self.detect_every = detect_every
+    self._trackers = {}  # model -> (Tracker, last chunk it saw)
+    self.store = FrameStoreWriter(os.path.join(run_dir, 'frames'), shape,
+                                  chunk_frames=chunk_frames, resume=True)
+    self._progress_path = os.path.join(run_dir, 'progress.json')
+    self._lock = threading.Lock()
+    self._progress = self._load_progress()
+    self.queue = FrameQueue(maxsize=2, policy=BLOCK)
+    self._worker = FrameWorker(self.queue, self._process_chunk, name='ResumableRun')
+    self._worker.start()
+    # Finish what an interrupted run left behind.
+    for chunk in range(self.store.num_complete_chunks):
+      if self._missing_stages(chunk):
+        self.queue.put(chunk)
+    if len(self.store):
+      print(f'Resuming {run_dir} after {len(self.store)} recorded frames.')
+
+  @property
+  def stages(self):
+    return [RAW_STAGE] + [f'detect:{name}' for name in self.models]
+
+  def __len__(self):
+    return len(self.store)
+
+  def _load_progress(self):
+    if not os.path.isfile(self._progress_path):
+      return {}
+    with open(self._progress_path) as f:
+      progress = json.load(f)
+    # A chunk that was not complete will be recorded again, forget its stages.
+    return {c: s for c, s in progress.items() if int(c) < self.store.num_complete_chunks}
+
+  def _mark_done(self, chunk, stage):
+    with self._lock:
+      self._progress.setdefault(str(chunk), []).append(stage)
+      tmp_path = self._progress_path + '.tmp'
+      with open(tmp_path, 'w') as f:
+        json.dump(self._progress, f)
+      os.replace(tmp_path, self._progress_path)
+
+  def _missing_stages(self, chunk):
+    with self._lock:
+      done = set(self._progress.get(str(chunk), []))
+    return [s for s in self.stages if s not in done]
+
+  def append(self, frame, frame_id, timestamp=0.0, ego_transform=None):
+    """Record one BGRA frame, a finished chunk is queued for post-processing."""
+    chunk = self.store.append(frame, frame_id, timestamp, ego_transform)
+    if chunk is not None:
+      self.queue.put(chunk)
+
+  def _segment_path(self, stage, chunk):
+    return os.path.join(self.run_dir, 'segments', stage.replace(':', '_'), f'{chunk:05}.mp4')
+
+  def _process_chunk(self, chunk):
+    stages = self._missing_stages(chunk)
+    if not stages:
+      return
+    reader = FrameStoreReader(self.store.path)
+    ids = np.flatnonzero(reader.index['chunk'] == chunk)
+    frames = [reader[i] for i in ids]  # Zero-copy views, shared by every stage.
+    frame_ids = reader.index['frame'][ids]
+    with concurrent.futures.ThreadPoolExecutor(len(stages)) as pool:
+      futures = {}
+      for stage in stages:
+        if stage == RAW_STAGE:
+          futures[pool.submit(self._encode, chunk, frames)] = stage
+        else:
+          name = stage.split(':', 1)[1]
+          futures[pool.submit(self._detect, chunk, name, frames, frame_ids)] = stage
+      for future in concurrent.futures.as_completed(futures):
+        if future.exception() is not None:
+          # Not checkpointed, so it is redone on the next resume.
+          print(f'Chunk {chunk} {futures[future]} failed: {future.exception()!r}')
+          continue
+        self._mark_done(chunk, futures[future])
+    print(f'Chunk {chunk} processed: {stages}')
+
+  def _encode(self, chunk, frames):
+    with VideoRecorder(self._segment_path(RAW_STAGE, chunk), self.shape[1], self.shape[0],
+                       fps=self.fps, pix_fmt='bgra', use_cuda=self.use_cuda) as recorder:
+      for frame in frames:
+        recorder.write(frame)
+
+  def _tracker(self, name, chunk):
+    """The tracker of `name`, a new one if the previous chunk was not the one before."""
+    tracker, last_chunk = self._trackers.get(name, (None, None))
+    if tracker is None or last_chunk != chunk - 1:
+      tracker = Tracker(detect_every=self.detect_every, keep_history=False,
+                        first_id=chunk * ID_STRIDE)
+    self._trackers[name] = (tracker, chunk)
+    return tracker
+
+  def _run_model(self, model, frames):
+    """(N, 6) detections of every frame, in batches."""
+    detections = []
+    for start in range(0, len(frames), self.batch_size):
+      batch = frames[start:start + self.batch_size]
+      rgb = [cv2.cvtColor(f, cv2.COLOR_BGRA2RGB) for f in batch]
+      detections.extend(yolov5_xyxy(model(rgb)))
+    return detections
+
+  def _detect(self, chunk, name, frames, frame_ids):
+    model = self.models[name]
+    stage = f'detect:{name}'
+    if self.detect_every > 1:
+      # Chunks are a whole number of detection rounds only if chunk_frames is
+      # a multiple of detect_every, else the round restarts with each chunk.
+      keyframes = range(0, len(frames), self.detect_every)
+      detected = dict(zip(keyframes, self._run_model(model, [frames[i] for i in keyframes])))
+      tracker = self._tracker(name, chunk)
+      detections = [tracker.step(frame_id, detected.get(i))
+                    for i, frame_id in enumerate(frame_ids)]
+    else:
+      detections = self._run_model(model, frames)
+    with VideoRecorder(self._segment_path(stage, chunk), self.shape[1], self.shape[0],
+                       fps=self.fps, pix_fmt='bgr24', use_cuda=self.use_cuda) as recorder:
+      for frame, det in zip(frames, detections):
+        recorder.write(draw_boxes(cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR), det,
+                                  getattr(model, 'names', None)))
+    out_dir = os.path.join(self.run_dir, 'detections', name)
+    os.makedirs(out_dir, exist_ok=True)
+    np.savez(os.path.join(out_dir, f'chunk_{chunk:05}.npz'), frame_ids=frame_ids,
+             counts=np.array([len(d) for d in detections]),
+             boxes=np.concatenate(detections) if detections else np.zeros((0, 6)))
+
+  def missing(self):
+    """{chunk: stages not done yet} of every recorded chunk, the partial one too."""
+    num_chunks = -(-len(self.store) // self.store.chunk_frames)
+    missing = {chunk: self._missing_stages(chunk) for chunk in range(num_chunks)}
+    return {chunk: stages for chunk, stages in missing.items() if stages}
+
+  def close(self):
+    """Post-process the last (partial) chunk and join all segments.
+
+    Raises RuntimeError, without joining, if a stage of some chunk failed.
+    """
+    partial = len(self.store) % self.store.chunk_frames
+    self.store.close()
+    if partial:
+      self.queue.put(self.store.num_complete_chunks)
+    self._worker.stop()
+    missing = self.missing()
+    if missing:
+      # A joined video would silently skip these chunks. A new `ResumableRun` on
+      # the same directory redoes them (a partial last chunk is recorded again).
+      gaps = ', '.join(f'chunk {c}: {stages}' for c, stages in missing.items())
+      raise RuntimeError(f'Not joining the segments of {self.run_dir}, stages failed: {gaps}')
+    for stage in self.stages:
+      segments = sorted(glob.glob(os.path.join(self.run_dir, 'segments',
+                                               stage.replace(':', '_'), '*.mp4')))
+      concat_videos(segments, os.path.join(self.run_dir, f'{stage.replace(":", "_")}.mp4'))
+    print(f'{len(self.store)} frames recorded and processed in {self.run_dir}')
+
+
+def load_trajectories(run_dir, name, min_length=2):
+  """id -> (L, 5) frame, x1, y1, x2, y2 of the tracks of model `name` in a run."""
+  rows = []
+  for path in sorted(glob.glob(os.path.join(run_dir, 'detections', name, 'chunk_*.npz'))):
+    with np.load(path) as chunk:
+      boxes = chunk['boxes']
+      if boxes.shape[1] < 7:
+        continue  # Detected on every frame, no track ids.
+      frames = np.repeat(chunk['frame_ids'], chunk['counts'])
+      rows.append(np.concatenate([frames[:, None], boxes[:, 6:7], boxes[:, :4]], axis=1))
+  return group_trajectories(np.concatenate(rows) if rows else np.zeros((0, 6)), min_length)
@@ -0,0 +1,133 @@
+"""
+A rig of sensors on one vehicle, declared once and served by one worker pool.
+
+Each sensor is a `SensorSpec` (blueprint, attributes, transform relative to the
+vehicle). `SensorRig.spawn()` spawns them all in one batch, and their frames go
+into one bounded `FrameQueue` served by a small pool of worker threads, instead
+of N callbacks doing the work on their own and fighting for the GIL.
+
+  rig = SensorRig(SURROUND_RIG, handler=lambda name, image: ..., num_workers=2)
+  actors.track(rig.spawn(client, world, main_vehicle))  # an ActorRegistry
+  ...
+  print(rig.stats())
+  rig.stop()
+
+NOTE: With more than one worker, frames of one camera may be handled out of
+order, use `num_workers=1` or the `TickDriver` if the order matters.
+"""
+
+import collections
+import threading
+import time
+
+import carla
+
+from frame_pipeline import DROP_OLDEST, FrameQueue, FrameWorker
+
+# `transform` is (x, y, z, pitch, yaw, roll) relative to the vehicle, in meters
+# and degrees. The vehicle model towards positive "x". Positive "z" is upward.
+SensorSpec = collections.namedtuple('SensorSpec', ['name', 'blueprint', 'attributes', 'transform'])
+
+_RGB_800x600 = {'image_size_x': '800', 'image_size_y': '600'}
+
+# Front, front sides, sides and rear, what we use for perception data collection.
+SURROUND_RIG = (
+    SensorSpec('front', 'sensor.camera.rgb', _RGB_800x600, (1.2, 0.0, 1.2, 0.0, 0.0, 0.0)),
+    SensorSpec('front_left', 'sensor.camera.rgb', _RGB_800x600, (1.0, -0.5, 1.2, 0.0, -55.0, 0.0)),
+    SensorSpec('front_right', 'sensor.camera.rgb', _RGB_800x600, (1.0, 0.5, 1.2, 0.0, 55.0, 0.0)),
+    SensorSpec('left', 'sensor.camera.rgb', _RGB_800x600, (0.0, -0.9, 1.2, 0.0, -110.0, 0.0)),
+    SensorSpec('right', 'sensor.camera.rgb', _RGB_800x600, (0.0, 0.9, 1.2, 0.0, 110.0, 0.0)),
+    SensorSpec('rear', 'sensor.camera.rgb', _RGB_800x600, (-2.2, 0.0, 1.2, 0.0, 180.0, 0.0)),
+)
+
+
+def to_transform(transform):
+  """(x, y, z, pitch, yaw, roll) -> carla.Transform."""
+  x, y, z, pitch, yaw, roll = transform
+  return carla.Transform(carla.Location(x=x, y=y, z=z),
+                         carla.Rotation(pitch=pitch, yaw=yaw, roll=roll))
+
+
+class SensorRig:
+  """Spawns the sensors of `specs` and routes their data to `handler(name, data)`."""
+
+  def __init__(self, specs, handler, num_workers=2, queue_size=None, policy=DROP_OLDEST):
+    names = [spec.name for spec in specs]
+    if len(set(names)) != len(names):
+      raise ValueError(f'Sensor names must be unique, got {names}')
+    self.specs = list(specs)
+    self.handler = handler
+    self.sensors = {}  # name -> carla sensor actor
+    # Two frames per sensor by default, a slow pool drops instead of piling up.
+    self.queue = FrameQueue(maxsize=queue_size or 2 * len(specs), policy=policy,
+                            on_drop=self._on_drop)
+    self._lock = threading.Lock()
+    self._received = collections.Counter()
+    self._processed = collections.Counter()
+    self._dropped = collections.Counter()
+    self._started = None
+    self._workers = [FrameWorker(self.queue, self._process, name=f'SensorRig-{i}')
+                     for i in range(num_workers)]
+
+  def spawn(self, client, world, parent):
+    """Spawn all sensors attached to `parent` in one batch, start listening.
+
+    Returns the spawned actors, so they can be destroyed with the others.
+    """
+    library = world.get_blueprint_library()
+    batch = []
+    for spec in self.specs:
+      bp = library.find(spec.blueprint)
+      for key, value in spec.attributes.items():
+        bp.set_attribute(key, str(value))
+      batch.append(carla.command.SpawnActor(bp, to_transform(spec.transform), parent))
+
+    for spec, response in zip(self.specs, client.apply_batch_sync(batch)):
+      if response.error:
+        print(f'Sensor {spec.name} failed: {response.error}')
+      else:
+        self.sensors[spec.name] = world.get_actor(response.actor_id)
+    print(f'Spawned {len(self.sensors)}/{len(self.specs)} sensors.')
+
+    self._started = time.perf_counter()
+    for worker in self._workers:
+      worker.start()
+    for name, sensor in self.sensors.items():
+      sensor.listen(lambda data, name=name: self._on_data(name, data))
+    return list(self.sensors.values())
+
+  def _on_data(self, name, data):
+    with self._lock:
+      self._received[name] += 1
+    self.queue.put((name, data))
+
+  def _on_drop(self, item):
+    with self._lock:
+      self._dropped[item[0]] += 1
+
+  def _process(self, item):
+    name, data = item
+    self.handler(name, data)
+    with self._lock:
+      self._processed[name] += 1
+
+  def stats(self):
+    """Per sensor counters and processed frames/sec, plus the shared queue."""
+    elapsed = time.perf_counter() - self._started if self._started else 0.0
+    with self._lock:
+      per_sensor = {
+          name: {
+              'received': self._received[name],
+              'processed': self._processed[name],
+              'dropped': self._dropped[name],
+              'fps': self._processed[name] / elapsed if elapsed else 0.0,
+          } for name in self.sensors
+      }
+    return {'sensors': per_sensor, 'queue': self.queue.stats()}
+
+  def stop(self):
+    """Stop listening and let the workers finish what is queued."""
+    for sensor in self.sensors.values():
+      sensor.stop()
+    for worker in self._workers:
+      worker.stop()
@@ -0,0 +1,156 @@
+"""
+Process frames on a pool of worker processes through shared memory.
+
+`cv2.cvtColor`, PNG encoding and YOLO pre-processing all hold the GIL in the
+CARLA client process. `ProcessFramePool` copies every frame once into a slot of
+a `SharedFrameRing` (a `multiprocessing.shared_memory` block sized from the
+camera width/height/channels) and only sends the slot index to the workers, so
+no 1.9 MB array is pickled per frame. The slot is recycled once the worker is
+done with it.
+
+  pool = ProcessFramePool(functools.partial(save_png, folder='../tmp'),
+                          shape=(600, 800, 4), num_workers=4)
+  camera.listen(lambda img: pool.submit(bgra_view(img), img.frame))
+  ...
+  pool.close()
+
+`fn(frame, frame_id)` runs in the workers, it has to be picklable (a module
+level function or a `functools.partial` of one) and must not keep `frame`
+around, the slot is reused right after it returns.
+"""
+
+import multiprocessing
+import os
+import queue
+import threading
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+
+class SharedFrameRing:
+  """`num_slots` frames of `shape` in one shared memory block."""
+
+  def __init__(self, num_slots, shape, dtype=np.uint8, name=None):
+    self.num_slots = num_slots
+    self.shape = tuple(shape)
+    self.dtype = np.dtype(dtype)
+    self.slot_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+    self._owner = name is None
+    if self._owner:
+      self.shm = shared_memory.SharedMemory(create=True, size=num_slots * self.slot_bytes)
+    else:
+      self.shm = shared_memory.SharedMemory(name=name)
+    self.frames = np.ndarray((num_slots,) + self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+  @property
+  def name(self):
+    return self.shm.name
+
+  def close(self):
+    """Detach, the owner also frees the block."""
+    del self.frames  # No view may outlive the buffer.
+    self.shm.close()
+    if self._owner:
+      self.shm.unlink()
+
+
+def save_png(frame, frame_id, folder):
+  """A pool function, the `save_to_disk()` of the scripts off the GIL."""
+  cv2.imwrite(os.path.join(folder, f'{frame_id:06}.png'), frame)
+
+
+def _worker_main(ring_name, num_slots, shape, dtype, fn, tasks, results):
+  ring = SharedFrameRing(num_slots, shape, dtype, name=ring_name)
+  try:
+    while True:
+      task = tasks.get()
+      if task is None:
+        break
+      slot, frame_id = task
+      try:
+        result = fn(ring.frames[slot], frame_id)
+      except Exception as e:
+        result = e
+      results.put((slot, frame_id, result))
+  finally:
+    ring.close()
+
+
+class ProcessFramePool:
+  """Runs `fn(frame, frame_id)` on worker processes, frames go through shared memory."""
+
+  def __init__(self, fn, shape, dtype=np.uint8, num_workers=None, num_slots=None,
+               on_result=None, block=False):
+    num_workers = num_workers or max(1, (os.cpu_count() or 2) - 1)
+    self.ring = SharedFrameRing(num_slots or 2 * num_workers, shape, dtype)
+    self.on_result = on_result
+    self.block = block  # Wait for a free slot instead of dropping the frame.
+    self._free = queue.Queue()
+    for slot in range(self.ring.num_slots):
+      self._free.put(slot)
+    # Counters, only for reading.
+    self.submitted_count = 0
+    self.dropped_count = 0
+    self.done_count = 0
+    self.error_count = 0
+
+    ctx = multiprocessing.get_context()
+    self._tasks = ctx.Queue()
+    self._results = ctx.Queue()
+    self._workers = [
+        ctx.Process(target=_worker_main, name=f'ProcessFramePool-{i}', daemon=True,
+                    args=(self.ring.name, self.ring.num_slots, self.ring.shape,
+                          self.ring.dtype.str, fn, self._tasks, self._results))
+        for i in range(num_workers)
+    ]
+    for worker in self._workers:
+      worker.start()
+    self._collector = threading.Thread(target=self._collect, name='ProcessFramePool', daemon=True)
+    self._collector.start()
+
+  def submit(self, frame, frame_id):
+    """Copy `frame` into a free slot and queue it, False if it was dropped."""
+    try:
+      slot = self._free.get(block=self.block)
+    except queue.Empty:
+      self.dropped_count += 1
+      return False
+    np.copyto(self.ring.frames[slot], frame)
+    self.submitted_count += 1
+    self._tasks.put((slot, frame_id))
+    return True
+
+  def _collect(self):
+    while True:
+      item = self._results.get()
+      if item is None:
+        break
+      slot, frame_id, result = item
+      self._free.put(slot)
+      self.done_count += 1
+      if isinstance(result, Exception):
+        self.error_count += 1
+        print(f'Frame {frame_id} failed in the pool: {result!r}')
+      elif self.on_result is not None:
+        self.on_result(frame_id, result)
+
+  def stats(self):
+    return {
+        'submitted': self.submitted_count,
+        'done': self.done_count,
+        'dropped': self.dropped_count,
+        'errors': self.error_count,
+        'free_slots': self._free.qsize(),
+    }
+
+  def close(self):
+    """Finish the queued frames, stop the workers and free the shared memory."""
+    for _ in self._workers:
+      self._tasks.put(None)
+    for worker in self._workers:
+      worker.join()
+    self._results.put(None)
+    self._collector.join()
+    self.ring.close()
@@ -2,46 +2,64 @@
 1. Create a main_vehicle
 2. Create a camera and attach to main_vehicle
 3. Streaming in cv2.imshow().
+
+The listener only hands frames to the `Viewer`, which owns the window on the
+main thread and shows the latest frame at the pace of `fixed_delta_seconds`.
+The world is ticked on another thread, so a slow imshow can't back up the tick loop.
 """
 
 import random
+import threading
+import time
 
 import cv2
-import numpy as np
 from absl import app
 
 import carla
 
+from actor_registry import ActorRegistry
+from instrumentation import Profiler
+from viewer import Viewer
+
 synchronous_master=True
+VIEW_SCALE=1.0 # Downscale the window, e.g. 0.5
+PROFILE_OUT='' # e.g. '../out/show_by_opencv_profile.json' to time every stage
 
-def show_image(carla_img):
-  """Stream the view from camera."""
-  #TODO: It is stuttering, need to make it smoother.
-  np_img = np.array(carla_img.raw_data, dtype=np.uint8).reshape((600, 800, 4))[:,:,:3]
-  cv2.imshow("Stream", np_img)
-  cv2.waitKey(1)
-
-def main(argv):
-  actor_list = []
+profiler = Profiler(enabled=bool(PROFILE_OUT))
 
+def tick_forever(world, stop):
+  """Tick the world until `stop` is set, runs on its own thread."""
   try:
-    # First of all, we need to create the client that will send the requests
-    # to the simulator. Here we'll assume the simulator is accepting
-    # requests in the localhost at port 2000.
-#     host_ip = os.environ['host_ip']
-    host_ip = '127.0.0.1'
-    client = carla.Client(host_ip, 2000)
-    client.set_timeout(5.0)
+    while not stop.is_set():
+      issued = time.perf_counter()
+      frame = world.tick()
+      # The latencies of the frame ('tick->callback') start at the tick.
+      profiler.mark(frame, 'tick', issued)
+  finally:
+    stop.set()  # If the tick fails, the viewer stops too.
 
+def main(argv):
+  # First of all, we need to create the client that will send the requests
+  # to the simulator. Here we'll assume the simulator is accepting
+  # requests in the localhost at port 2000.
+#   host_ip = os.environ['host_ip']
+  host_ip = '127.0.0.1'
+  client = carla.Client(host_ip, 2000)
+  client.set_timeout(5.0)
+
+  # Every actor is spawned through the registry. Leaving this block, also with
+  # an exception, destroys them all and gets the server back to the async mode.
+  with ActorRegistry(client, endpoint=f'{host_ip}:2000') as actors:
     # Once we have a client we can retrieve the world that is currently running.
-    world = client.get_world()
+    world = actors.world
     tm = client.get_trafficmanager()
 
-    settings = world.get_settings()
-    settings.fixed_delta_seconds = 0.04
-    settings.synchronous_mode = True  # (Required) Enables synchronous mode on world
-    tm.set_synchronous_mode(True)  # (Required) Enables synchronous mode on traffic manager
-    world.apply_settings(settings)
+    fixed_delta_seconds = 0.04
+    if synchronous_master:
+      # Because in sync mode, server will wait for the tick from client,
+      # the registry takes it back to the async mode when we leave.
+      # WARNING: It works only for single client mode!
+      actors.enable_sync(fixed_delta_seconds, tm)
 
     # The world contains the list blueprints that we can use for adding new
     # actors into the simulation.
@@ -61,17 +79,13 @@ def main(argv):
     # Now we need to give an initial transform to the vehicle. We choose a
     # random transform from the list of recommended spawn points of the map.
     init_main_transform = random.choice(world.get_map().get_spawn_points())
-    # So let's tell the world to spawn the vehicle.
-    main_vehicle = world.spawn_actor(bp, init_main_transform)
+    # So let's tell the world to spawn the vehicle. It is important to note
+    # that the actors we create won't be destroyed unless we call their
+    # "destroy" function, so the registry keeps every actor it spawns and
+    # destroys them afterwards.
+    main_vehicle = actors.spawn(bp, init_main_transform)
     # Let's put the vehicle to drive around.
     main_vehicle.set_autopilot(True)
-    
-    # It is important to note that the actors we create won't be destroyed
-    # unless we call their "destroy" function. If we fail to call "destroy"
-    # they will stay in the simulation even after we quit the Python script.
-    # For that reason, we are storing all the actors we create so we can
-    # destroy them afterwards.
-    actor_list.append(main_vehicle)
     print('created %s' % main_vehicle.type_id)
 
     # Let's add now a "depth" camera attached to the vehicle. Note that the
@@ -81,32 +95,34 @@ def main(argv):
     camera_bp.set_attribute('image_size_y', '600')
     # The vehicle model towards positive "x". Positive "z" is upward. 
     camera_transform = carla.Transform(carla.Location(x=1.2, z=1.2))
-    camera = world.spawn_actor(camera_bp, camera_transform, attach_to=main_vehicle)
-    actor_list.append(camera)
+    camera = actors.spawn(camera_bp, camera_transform, attach_to=main_vehicle)
     print('created %s' % camera.type_id)
 
-    # When sensor gets data, it will process with `show_image()`
-    camera.listen(lambda data: show_image(data))
-    
-    while True:
-      world.tick()
-    
-  finally:
-    print('Disconnecting from server...')
-    # Because in sync mode, server will wait for the tick from client,
-    # but after the client is interrupted, we don't have anyone can send
-    # the tick, that's why we need to get it back to the acsync mode.
-    # WARNING: It works only for single client mode!
-    if synchronous_master:
-      settings = world.get_settings()
-      settings.synchronous_mode = False
-      settings.fixed_delta_seconds = None
-      world.apply_settings(settings)
-    print('Destroying actors')
-    cv2.destroyAllWindows()
-    camera.destroy()
-    client.apply_batch([carla.command.DestroyActor(x) for x in actor_list])
-    print('Done.')
+    # When sensor gets data, it is only handed to the viewer here, it will
+    # be shown on the main thread.
+    viewer = Viewer('Stream', fixed_delta_seconds=fixed_delta_seconds,
+                    scale=VIEW_SCALE, profiler=profiler)
+    actors.on_close(cv2.destroyAllWindows)
+    def on_image(carla_img):
+      profiler.mark(carla_img.frame, 'callback')
+      viewer.submit(carla_img)
+    camera.listen(on_image)
+
+    stop = threading.Event()
+    ticker = threading.Thread(target=tick_forever, args=(world, stop), daemon=True)
+    def stop_ticker():
+      # Let the ticker finish its tick before leaving the synchronous mode.
+      stop.set()
+      ticker.join()
+    actors.on_close(stop_ticker)
+    ticker.start()
+    try:
+      viewer.run(stop.is_set)  # Until 'q', ESC or the window is closed
+    finally:
+      print('Viewer: %s' % viewer.stats())
+      profiler.dump(PROFILE_OUT)
+      print('Disconnecting from server...')
+  print('Done.')
 
 if __name__ == '__main__':
   app.run(main)
@@ -6,53 +6,65 @@
 
 Conclusion is, offline video is very smooth as you have in ../out folder. So the problem
 is on the listener, the callback seems not realtime or near realtime.
+
+Frames are streamed into the video by `VideoRecorder` on a background thread, there
+is no PNG dump in ../tmp and no ffmpeg pass after the run anymore.
 """
 
 import random
-import subprocess
 
-import cv2
-import numpy as np
 from absl import app
 
 import carla
 
+from actor_registry import ActorRegistry
+from image_utils import to_bgr
+from instrumentation import Profiler
+from tick_driver import TickDriver
+from video_recorder import VideoRecorder
+
 RECORD_FRAME_NUM=150 # how many frames do you want to record
 USE_CUDA_IN_FFMPEG=True # if you have cuda, accelerate with it
 SYNC_MASTER=True
-IMAGE_FOLDER='../tmp'
+IMAGE_WIDTH=800
+IMAGE_HEIGHT=600
 OUT_VIDEO='../out/show_by_opencv_offline.mp4'
-
-saved_frame_count=0
-
-def show_image(carla_img):
-  """Stream the view from camera."""
-  global saved_frame_count
-  carla_img.save_to_disk(f'{IMAGE_FOLDER}/{saved_frame_count:03}.png')
-  saved_frame_count += 1
+PROFILE_OUT='' # e.g. '../out/show_by_opencv_offline_profile.json' to time every stage
+
+profiler = Profiler(enabled=bool(PROFILE_OUT))
+
+def show_image(bundle, recorder):
+  """Stream the view from camera, `bundle` is the aligned data of one tick."""
+  carla_img = bundle.data['rgb']
+  if carla_img is None:
+    return
+  # A copy, the recorder thread encodes it after `carla_img` may be gone.
+  recorder.write(to_bgr(carla_img))
+  profiler.mark(bundle.frame, 'write')
+  saved_frame_count = recorder.queue.put_count
   if saved_frame_count % 100 == 0:
     print(f'{saved_frame_count} pieces of image have been saved.')
 
 def main(argv):
-  actor_list = []
-
-  try:
-    # First of all, we need to create the client that will send the requests
-    # to the simulator. Here we'll assume the simulator is accepting
-    # requests in the localhost at port 2000.
-    host_ip = '127.0.0.1'
-    client = carla.Client(host_ip, 2000)
-    client.set_timeout(5.0)
-
+  # First of all, we need to create the client that will send the requests
+  # to the simulator. Here we'll assume the simulator is accepting
+  # requests in the localhost at port 2000.
+  host_ip = '127.0.0.1'
+  client = carla.Client(host_ip, 2000)
+  client.set_timeout(5.0)
+
+  # Every actor is spawned through the registry. Leaving this block, also with
+  # an exception, destroys them all and gets the server back to the async mode.
+  with ActorRegistry(client, endpoint=f'{host_ip}:2000') as actors:
     # Once we have a client we can retrieve the world that is currently running.
-    world = client.get_world()
+    world = actors.world
     tm = client.get_trafficmanager()
 
-    settings = world.get_settings()
-    settings.fixed_delta_seconds = 0.04
-    settings.synchronous_mode = True  # (Required) Enables synchronous mode on world
-    tm.set_synchronous_mode(True)  # (Required) Enables synchronous mode on traffic manager
-    world.apply_settings(settings)
+    if SYNC_MASTER:
+      # Because in sync mode, server will wait for the tick from client,
+      # the registry takes it back to the async mode when we leave.
+      # WARNING: It works only for single client mode!
+      actors.enable_sync(0.04, tm)
 
     # The world contains the list blueprints that we can use for adding new
     # actors into the simulation.
@@ -72,57 +84,38 @@ def main(argv):
     # Now we need to give an initial transform to the vehicle. We choose a
     # random transform from the list of recommended spawn points of the map.
     init_main_transform = random.choice(world.get_map().get_spawn_points())
-    # So let's tell the world to spawn the vehicle.
-    main_vehicle = world.spawn_actor(bp, init_main_transform)
+    # So let's tell the world to spawn the vehicle. It is important to note
+    # that the actors we create won't be destroyed unless we call their
+    # "destroy" function, so the registry keeps every actor it spawns and
+    # destroys them afterwards.
+    main_vehicle = actors.spawn(bp, init_main_transform)
     # Let's put the vehicle to drive around.
     main_vehicle.set_autopilot(True)
-    
-    # It is important to note that the actors we create won't be destroyed
-    # unless we call their "destroy" function. If we fail to call "destroy"
-    # they will stay in the simulation even after we quit the Python script.
-    # For that reason, we are storing all the actors we create so we can
-    # destroy them afterwards.
-    actor_list.append(main_vehicle)
     print('created %s' % main_vehicle.type_id)
 
     # Let's add now a "depth" camera attached to the vehicle. Note that the
     # transform we give here is now relative to the vehicle.
     camera_bp = blueprint_library.find('sensor.camera.rgb')
-    camera_bp.set_attribute('image_size_x', '800')
-    camera_bp.set_attribute('image_size_y', '600')
+    camera_bp.set_attribute('image_size_x', str(IMAGE_WIDTH))
+    camera_bp.set_attribute('image_size_y', str(IMAGE_HEIGHT))
     # The vehicle model towards positive "x". Positive "z" is upward. 
     camera_transform = carla.Transform(carla.Location(x=1.2, z=1.2))
-    camera = world.spawn_actor(camera_bp, camera_transform, attach_to=main_vehicle)
-    actor_list.append(camera)
+    camera = actors.spawn(camera_bp, camera_transform, attach_to=main_vehicle)
     print('created %s' % camera.type_id)
 
-    # When sensor gets data, it will process with `show_image()`
-    camera.listen(lambda data: show_image(data))
-    
-    while True:
-      if saved_frame_count < RECORD_FRAME_NUM:
-        world.tick()
-      else:
-        break
-    
-  finally:
+    recorder = VideoRecorder(OUT_VIDEO, IMAGE_WIDTH, IMAGE_HEIGHT, fps=25, pix_fmt='bgr24',
+                             use_cuda=USE_CUDA_IN_FFMPEG, profiler=profiler)
+    # Flush the queued frames and finish the video, also if the run fails.
+    actors.on_close(recorder.close)
+    # Every tick waits for the camera frame of that tick, then hands it to
+    # `show_image()`, so no frame is lost or out of order.
+    driver = TickDriver(world, profiler=profiler)
+    driver.add_sensor('rgb', camera)
+    driver.run(lambda bundle: show_image(bundle, recorder), max_ticks=RECORD_FRAME_NUM)
     print('Disconnecting from server...')
-    # Because in sync mode, server will wait for the tick from client,
-    # but after the client is interrupted, we don't have anyone can send
-    # the tick, that's why we need to get it back to the acsync mode.
-    # WARNING: It works only for single client mode!
-    if SYNC_MASTER:
-      settings = world.get_settings()
-      settings.synchronous_mode = False
-      settings.fixed_delta_seconds = None
-      world.apply_settings(settings)
-    print('Destroying actors')
-    cv2.destroyAllWindows()
-    camera.destroy()
-    client.apply_batch([carla.command.DestroyActor(x) for x in actor_list])
-    print('Done.')
-
-  subprocess.call(f'ffmpeg {"-hwaccel cuda" if USE_CUDA_IN_FFMPEG else ""} -y -r 25 -s 800x600 -i {IMAGE_FOLDER}/%03d.png -vcodec libx264 -crf 25 -pix_fmt yuv420p {OUT_VIDEO}', shell=True)
+
+  profiler.dump(PROFILE_OUT)
+  print('Done.')
 
 if __name__ == '__main__':
   app.run(main)
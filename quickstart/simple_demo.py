@@ -3,6 +3,7 @@
 2. Create a camera and attach to main_vehicle
 3. Create some npc_vehicles
 4. Keep spectator as the camera.
+5. Print the distance straight ahead, from the depth camera.
 """
 
 # Modified from https://github.com/carla-simulator/carla/blob/master/PythonAPI/examples/tutorial.py
@@ -10,30 +11,32 @@
 import os
 import random
 
+import numpy as np
 from absl import app
 
 import carla
 
-def main(argv):
-  actor_list = []
-
-  try:
-    # First of all, we need to create the client that will send the requests
-    # to the simulator. Here we'll assume the simulator is accepting
-    # requests in the localhost at port 2000.
-    host_ip = '127.0.0.1'
-    client = carla.Client(host_ip, 2000)
-    client.set_timeout(2.0)
+from actor_registry import ActorRegistry
+from depth_utils import DepthDecoder
+from traffic import spawn_npcs
 
+def main(argv):
+  # First of all, we need to create the client that will send the requests
+  # to the simulator. Here we'll assume the simulator is accepting
+  # requests in the localhost at port 2000.
+  host_ip = '127.0.0.1'
+  client = carla.Client(host_ip, 2000)
+  client.set_timeout(2.0)
+
+  # Every actor is spawned through the registry. Leaving this block, also with
+  # an exception (e.g. Ctrl-C), destroys them all in one batch and gets the
+  # server back to the async mode.
+  with ActorRegistry(client, endpoint=f'{host_ip}:2000') as actors:
     # Once we have a client we can retrieve the world that is currently running.
-    world = client.get_world()
+    world = actors.world
     tm = client.get_trafficmanager()
 
-    settings = world.get_settings()
-    settings.fixed_delta_seconds = 0.04
-    settings.synchronous_mode = True  # (Required) Enables synchronous mode on world
-    tm.set_synchronous_mode(True)  # (Required) Enables synchronous mode on traffic manager
-    world.apply_settings(settings)
+    actors.enable_sync(0.04, tm)
 
     # The world contains the list blueprints that we can use for adding new
     # actors into the simulation.
@@ -54,16 +57,15 @@ def main(argv):
     # random transform from the list of recommended spawn points of the map.
     init_main_transform = random.choice(world.get_map().get_spawn_points())
     # So let's tell the world to spawn the vehicle.
-    main_vehicle = world.spawn_actor(bp, init_main_transform)
+    main_vehicle = actors.spawn(bp, init_main_transform)
     # Let's put the vehicle to drive around.
     main_vehicle.set_autopilot(True)
     
     # It is important to note that the actors we create won't be destroyed
     # unless we call their "destroy" function. If we fail to call "destroy"
     # they will stay in the simulation even after we quit the Python script.
-    # For that reason, we are storing all the actors we create so we can
+    # For that reason, the registry keeps all the actors it spawns so it can
     # destroy them afterwards.
-    actor_list.append(main_vehicle)
     print('created %s' % main_vehicle.type_id)
 
     # Let's add now a "depth" camera attached to the vehicle. Note that the
@@ -71,29 +73,31 @@ def main(argv):
     camera_bp = blueprint_library.find('sensor.camera.depth')
     # The vehicle model towards positive "x". Positive "z" is upward. 
     camera_transform = carla.Transform(carla.Location(x=1.2, z=1.2))
-    camera = world.spawn_actor(camera_bp, camera_transform, attach_to=main_vehicle)
-    actor_list.append(camera)
+    camera = actors.spawn(camera_bp, camera_transform, attach_to=main_vehicle)
     print('created %s' % camera.type_id)
 
-    # But the city now is probably quite empty, let's add some vehicles
-    # `get_spawn_points()` will get you the recommended spawn points, avoid
-    # getting vehicles in sidewalk, or in the building.
-    spawn_points = world.get_map().get_spawn_points()
-    
-    # Create vehicles in random spawn points
+    # The depth frames come as 24-bit RGB, `DepthDecoder` turns them into meters.
+    decoder = DepthDecoder(int(camera.attributes['image_size_x']),
+                           int(camera.attributes['image_size_y']),
+                           float(camera.attributes['fov']))
+
+    def show_distance(depth_img):
+      if depth_img.frame % 25:
+        return
+      depth = decoder.decode(depth_img)
+      h, w = depth.shape
+      ahead = np.median(depth[h // 2 - 10:h // 2 + 10, w // 2 - 10:w // 2 + 10])
+      print(f'frame {depth_img.frame}: {ahead:.1f} m ahead')
+
+    camera.listen(show_distance)
+
+    # But the city now is probably quite empty, let's add some vehicles.
+    # `spawn_npcs()` picks from the recommended spawn points, avoid getting
+    # vehicles in sidewalk, or in the building, never uses one spot twice and
+    # spawns them all (with autopilot) in a single batch.
     NUM_OF_VEHS = 30
-    for i in range(0, NUM_OF_VEHS):
-      # randomly pick a car and its position in the map
-      bp = random.choice(blueprint_library.filter('vehicle'))
-      init_main_transform = random.choice(spawn_points)
-
-      # This time we are using `try_spawn_actor()`. If the spot is already
-      # occupied by another object, the function will return None.
-      npc = world.try_spawn_actor(bp, init_main_transform)
-      if npc is not None:
-        actor_list.append(npc)
-        npc.set_autopilot(True)
-        print('created %s' % npc.type_id)
+    actors.track(spawn_npcs(client, world, NUM_OF_VEHS, tm_port=tm.get_port(),
+                            exclude=[init_main_transform]))
 
     # In synchronous_mode, server will sync with client, i.e. wait for
     # clients computation complete and tell server it is ready. So world.tick()
@@ -102,11 +106,7 @@ def main(argv):
       # world.get_spectator().set_transform(camera.get_transform())
       world.tick()
 
-  finally:
-      print('destroying actors')
-      camera.destroy()
-      client.apply_batch([carla.command.DestroyActor(x) for x in actor_list])
-      print('done.')
+  print('done.')
 
 if __name__ == '__main__':
   app.run(main)
@@ -0,0 +1,77 @@
+"""
+Track ids of a resumed `ResumableRun` must not collide with the ones before,
+and a failed stage must keep `close()` from joining a video with a gap.
+
+  python -m pytest test_resumable_run.py
+"""
+
+import types
+
+import numpy as np
+import pytest
+
+from resumable_run import ResumableRun, load_trajectories
+
+SHAPE = (60, 160, 4)
+
+
+class FakeModel:
+  """Finds one box wherever the frame has its red channel set."""
+
+  names = {0: 'car'}
+
+  def __call__(self, rgb):
+    detections = []
+    for img in rgb:
+      ys, xs = np.nonzero(img[:, :, 0])
+      det = np.zeros((0, 6), dtype=np.float32)
+      if len(xs):
+        det = np.array([[xs.min(), ys.min(), xs.max() + 1, ys.max() + 1, 0.9, 0]], np.float32)
+      detections.append(det)
+    return types.SimpleNamespace(xyxy=[types.SimpleNamespace(
+        cpu=lambda d=d: types.SimpleNamespace(numpy=lambda d=d: d)) for d in detections])
+
+
+def frame_with_box(x):
+  frame = np.zeros(SHAPE, dtype=np.uint8)
+  frame[20:40, x:x + 20, 2] = 255  # BGRA, so this is red
+  return frame
+
+
+def test_resumed_run_gives_new_track_ids(tmp_path):
+  run_dir = str(tmp_path / 'run')
+  run = ResumableRun(run_dir, SHAPE, {'fake': FakeModel()}, chunk_frames=10, detect_every=5)
+  for i in range(20):  # Chunks 0 and 1: a car on the left.
+    run.append(frame_with_box(10 + i), i)
+  run._worker.stop()  # Interrupted, without close().
+
+  run = ResumableRun(run_dir, SHAPE, {'fake': FakeModel()}, chunk_frames=10, detect_every=5)
+  assert len(run) == 20
+  for i in range(20, 30):  # Chunk 2: another car on the right.
+    run.append(frame_with_box(120), i)
+  run.close()
+
+  trajectories = load_trajectories(run_dir, 'fake')
+  assert len(trajectories) == 2
+  frames = sorted((t[0, 0], t[-1, 0]) for t in trajectories.values())
+  assert frames[0][1] < 20 <= frames[1][0]  # Each car is its own track.
+
+
+class FailingModel(FakeModel):
+  """Fails on the frames of the second chunk."""
+
+  def __call__(self, rgb):
+    if any(20 <= np.nonzero(img[:, :, 0])[1].min() < 30 for img in rgb):
+      raise RuntimeError('model failed')
+    return super().__call__(rgb)
+
+
+def test_close_does_not_join_with_failed_chunks(tmp_path):
+  run_dir = str(tmp_path / 'run')
+  run = ResumableRun(run_dir, SHAPE, {'fake': FailingModel()}, chunk_frames=10)
+  for i in range(25):
+    run.append(frame_with_box(10 + i), i)
+  with pytest.raises(RuntimeError, match='chunk 1'):
+    run.close()
+  assert run.missing() == {1: ['detect:fake']}
+  assert not (tmp_path / 'run' / 'video.mp4').exists()
@@ -0,0 +1,118 @@
+"""
+Drive `world.tick()` in synchronous mode and match the sensor frames to it.
+
+Sensor callbacks arrive on another thread, so with a bare `while True:
+world.tick()` nothing says frame N's image was handled before tick N+1. The
+`TickDriver` collects the data of every registered sensor by frame id, and after
+each tick waits (with a timeout) until all sensors delivered that frame. The
+consumer then gets one `TickBundle` with all of them, on the main thread.
+
+  driver = TickDriver(world)
+  driver.add_sensor('rgb', camera)
+  driver.run(lambda bundle: print(bundle.frame, bundle.data['rgb']), max_ticks=100)
+"""
+
+import collections
+import threading
+import time
+
+import instrumentation
+
+# `data` maps sensor name to its data of this frame (None if it never came,
+# then the name is also in `missing`). `timing` is in seconds:
+#   server_step      world.tick() round trip
+#   callback_latency tick issued -> last sensor callback of this frame
+#   wait             tick returned -> all sensors in (or timeout)
+#   consumer         time spent in the consumer of `run()`
+TickBundle = collections.namedtuple('TickBundle', ['frame', 'timestamp', 'data', 'missing', 'timing'])
+
+
+class TickDriver:
+  """Ticks the world and hands out the sensor data aligned by frame id."""
+
+  def __init__(self, world, timeout=2.0, profiler=None):
+    self.world = world
+    self.timeout = timeout
+    self.profiler = profiler or instrumentation.DISABLED
+    self._sensors = {}
+    self._pending = {}  # name -> {frame: (data, arrival time)}
+    self._cond = threading.Condition()
+    # Counters, only for reading.
+    self.tick_count = 0
+    self.missed_count = 0  # Sensor frames that did not come before the timeout.
+
+  def add_sensor(self, name, sensor):
+    """Register `sensor` under `name`, this takes over its `listen()`."""
+    if name in self._sensors:
+      raise ValueError(f'Sensor {name!r} is already registered')
+    self._sensors[name] = sensor
+    self._pending[name] = {}
+    sensor.listen(lambda data: self._on_data(name, data))
+
+  def _on_data(self, name, data):
+    arrival = time.perf_counter()
+    with self._cond:
+      self._pending[name][data.frame] = (data, arrival)
+      self._cond.notify_all()
+
+  def tick(self):
+    """Tick once and wait for all sensors, returns the `TickBundle` of the frame."""
+    issued = time.perf_counter()
+    frame = self.world.tick(self.timeout)
+    stepped = time.perf_counter()
+    with self._cond:
+      self._cond.wait_for(
+          lambda: all(frame in pending for pending in self._pending.values()),
+          self.timeout)
+      data = {}
+      arrivals = []
+      missing = []
+      for name, pending in self._pending.items():
+        item = pending.pop(frame, None)
+        if item is None:
+          data[name] = None
+          missing.append(name)
+        else:
+          data[name] = item[0]
+          arrivals.append(item[1])
+        # Anything older than this frame came too late, nobody will ask for it.
+        for old in [f for f in pending if f < frame]:
+          del pending[old]
+    done = time.perf_counter()
+
+    self.profiler.mark(frame, 'tick', issued)
+    for arrival in arrivals:
+      self.profiler.mark(frame, 'callback', arrival)
+    self.profiler.record('server_step', stepped - issued)
+
+    self.tick_count += 1
+    self.missed_count += len(missing)
+    if missing:
+      print(f'Frame {frame}: no data from {missing} after {self.timeout}s')
+    timing = {
+        'server_step': stepped - issued,
+        'callback_latency': max(arrivals) - issued if arrivals else None,
+        'wait': done - stepped,
+        'consumer': None,
+    }
+    timestamp = self.world.get_snapshot().timestamp.elapsed_seconds
+    return TickBundle(frame, timestamp, data, missing, timing)
+
+  def run(self, consumer, max_ticks=None):
+    """Tick and call `consumer(bundle)` until `max_ticks`, or it returns False."""
+    ticks = 0
+    while max_ticks is None or ticks < max_ticks:
+      bundle = self.tick()
+      start = time.perf_counter()
+      keep_going = consumer(bundle)
+      bundle.timing['consumer'] = time.perf_counter() - start
+      self.profiler.record('consumer', bundle.timing['consumer'])
+      ticks += 1
+      if keep_going is False:
+        break
+    return ticks
+
+  def stop(self):
+    """Stop listening on all registered sensors."""
+    for sensor in self._sensors.values():
+      sensor.stop()
@@ -0,0 +1,57 @@
+"""
+Populate the map with NPC vehicles in one round trip.
+
+Instead of `random.choice(blueprint_library.filter('vehicle'))` and
+`world.try_spawn_actor()` per vehicle, the blueprints are filtered once, the
+spawn points are sampled without replacement (no two NPCs on the same spot),
+and everything is spawned with its autopilot on by one `apply_batch_sync()`.
+
+  npcs = spawn_npcs(client, world, 100, tm_port=tm.get_port())
+  actors.track(npcs)  # an ActorRegistry
+"""
+
+import random
+
+import carla
+
+
+def spawn_npcs(client, world, num, blueprint_filter='vehicle', autopilot=True,
+               tm_port=8000, do_tick=False, exclude=(), rng=random):
+  """Spawn up to `num` NPCs, returns the spawned actors.
+
+  `exclude` are spawn points already taken (e.g. by the main vehicle), `rng`
+  lets the caller make the choice of blueprints and spots deterministic.
+  `do_tick` ticks the world after the batch, as the synchronous master.
+  """
+  blueprints = list(world.get_blueprint_library().filter(blueprint_filter))
+  taken = {(t.location.x, t.location.y, t.location.z) for t in exclude}
+  spawn_points = [t for t in world.get_map().get_spawn_points()
+                  if (t.location.x, t.location.y, t.location.z) not in taken]
+  if num > len(spawn_points):
+    print(f'Only {len(spawn_points)} spawn points for {num} NPCs.')
+  transforms = rng.sample(spawn_points, min(num, len(spawn_points)))
+
+  batch = []
+  for transform in transforms:
+    bp = rng.choice(blueprints)
+    if bp.has_attribute('color'):
+      bp.set_attribute('color', rng.choice(bp.get_attribute('color').recommended_values))
+    bp.set_attribute('role_name', 'autopilot' if autopilot else 'npc')
+    # Put the autopilot on right after the actor is spawned, in the same batch.
+    command = carla.command.SpawnActor(bp, transform)
+    if autopilot:
+      command = command.then(
+          carla.command.SetAutopilot(carla.command.FutureActor, True, tm_port))
+    batch.append(command)
+
+  actor_ids = []
+  errors = {}
+  for response in client.apply_batch_sync(batch, do_tick):
+    if response.error:
+      errors[response.error] = errors.get(response.error, 0) + 1
+    else:
+      actor_ids.append(response.actor_id)
+  for error, n in errors.items():
+    print(f'{n} NPCs failed: {error}')
+  print(f'Spawned {len(actor_ids)}/{len(batch)} NPCs.')
+  return list(world.get_actors(actor_ids))
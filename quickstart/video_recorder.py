@@ -0,0 +1,160 @@
+"""
+Record frames straight into a video, without the PNG dump + ffmpeg post-pass.
+
+Frames are queued from the sensor callback and a background thread pipes them as
+raw pixels into one ffmpeg process (through its stdin), or into
+`cv2.VideoWriter` if ffmpeg is not there. The queue blocks when the encoder
+falls behind (backpressure, no frame is lost), and `close()` flushes everything
+so the video is complete once the sim loop exits.
+
+  with VideoRecorder('../out/run.mp4', 800, 600, pix_fmt='bgr24') as recorder:
+    camera.listen(lambda img: recorder.write(to_bgr(img)))
+    ...
+
+The frame is encoded after `write()` returned, so it must own its memory: a
+copy like `to_bgr(img)`, not a `bgra_view(img)` of a `carla.Image` that may be
+freed by then.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+import cv2
+import numpy as np
+
+import instrumentation
+from frame_pipeline import BLOCK, FrameQueue, FrameWorker
+
+FFMPEG = 'ffmpeg'
+OPENCV = 'opencv'
+
+_nvenc = None  # Whether ffmpeg can encode with NVENC here, probed once
+
+
+def has_nvenc():
+  """Whether ffmpeg can encode a frame with `h264_nvenc`, e.g. not without a GPU."""
+  global _nvenc
+  if _nvenc is None:
+    cmd = ['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', 'color=size=256x256',
+           '-frames:v', '1', '-vcodec', 'h264_nvenc', '-f', 'null', '-']
+    try:
+      _nvenc = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL, timeout=30).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+      _nvenc = False
+  return _nvenc
+
+
+class VideoRecorder:
+  """Streams BGR or BGRA frames of a fixed size into a video file."""
+
+  def __init__(self, path, width, height, fps=25, pix_fmt='bgra', backend=None,
+               use_cuda=False, crf=25, queue_size=32, put_timeout=None, profiler=None):
+    if pix_fmt not in ('bgr24', 'bgra'):
+      raise ValueError(f'pix_fmt must be bgr24 or bgra, got {pix_fmt!r}')
+    if backend is None:
+      backend = FFMPEG if shutil.which('ffmpeg') else OPENCV
+    self.path = path
+    self.width = width
+    self.height = height
+    self.fps = fps
+    self.pix_fmt = pix_fmt
+    self.backend = backend
+    self.profiler = profiler or instrumentation.DISABLED
+    self.frame_count = 0
+    self._error = None  # Why ffmpeg stopped taking frames, raised by `write()` and `close()`
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if backend == FFMPEG:
+      if use_cuda and not has_nvenc():
+        print('ffmpeg can not encode with h264_nvenc here, using libx264')
+        use_cuda = False
+      codec = ['-vcodec', 'h264_nvenc'] if use_cuda else ['-vcodec', 'libx264', '-crf', str(crf)]
+      cmd = [
+          'ffmpeg', '-loglevel', 'error', '-y',
+          '-f', 'rawvideo', '-pix_fmt', pix_fmt, '-s', f'{width}x{height}',
+          '-r', str(fps), '-i', '-',
+          *codec, '-pix_fmt', 'yuv420p', path,
+      ]
+      # A file, not a pipe, nobody reads stderr before ffmpeg exits.
+      self._stderr = tempfile.TemporaryFile()
+      self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=self._stderr)
+      self._writer = None
+    elif backend == OPENCV:
+      self._proc = None
+      self._writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                                     (width, height))
+      if not self._writer.isOpened():
+        raise RuntimeError(f'cv2.VideoWriter can not open {path}')
+    else:
+      raise ValueError(f'Unknown backend {backend!r}')
+
+    self.queue = FrameQueue(maxsize=queue_size, policy=BLOCK, put_timeout=put_timeout)
+    self._worker = FrameWorker(self.queue, self._encode, name='VideoRecorder')
+    self._worker.start()
+
+  def write(self, frame):
+    """Queue a (height, width, 3 or 4) uint8 frame, blocks if the encoder is behind.
+
+    The frame is read later on the recorder thread, don't reuse its buffer and
+    don't pass a view of a `carla.Image` (see `image_utils`). Raises
+    RuntimeError with ffmpeg's errors once it failed.
+    """
+    if self._error is not None:
+      raise self._error
+    return self.queue.put(frame)
+
+  def _encode(self, frame):
+    if self._error is not None:
+      return  # ffmpeg is gone, only drain the queue.
+    with self.profiler.timed('encode'):
+      if self._proc is not None:
+        try:
+          # Raw pixels, the views from `image_utils` may be strided.
+          self._proc.stdin.write(np.ascontiguousarray(frame).data)
+        except OSError:  # Broken pipe, ffmpeg exited
+          self._error = self._ffmpeg_error() or RuntimeError(
+              f'ffmpeg stopped reading frames for {self.path}')
+          print(f'VideoRecorder: {self._error}')
+          return
+      else:
+        if frame.shape[2] == 4:
+          frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+        self._writer.write(frame)
+    self.frame_count += 1
+
+  def close(self):
+    """Encode what is still queued and finish the video file.
+
+    Raises RuntimeError with ffmpeg's errors if it failed.
+    """
+    self._worker.stop()
+    if self._proc is not None:
+      try:
+        self._proc.stdin.close()
+      except BrokenPipeError:  # ffmpeg already exited, its return code tells why
+        pass
+      self._error = self._error or self._ffmpeg_error()
+      self._stderr.close()
+      if self._error is not None:
+        raise self._error
+    else:
+      self._writer.release()
+    print(f'Recorded {self.frame_count} frames into {self.path}, queue: {self.queue.stats()}')
+
+  def _ffmpeg_error(self):
+    """Waits for ffmpeg to exit, a RuntimeError with its stderr if it failed."""
+    returncode = self._proc.wait()
+    if returncode == 0:
+      return None
+    self._stderr.seek(0)
+    errors = self._stderr.read().decode(errors='replace').strip()
+    return RuntimeError(f'ffmpeg exited with {returncode} writing {self.path}: {errors}')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
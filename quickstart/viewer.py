@@ -0,0 +1,105 @@
+"""
+A smooth real-time viewer, the window is owned by the main thread.
+
+HighGUI is not meant to be pumped from the CARLA sensor thread. The camera only
+`submit()`s frames, the `Viewer` keeps the latest one (older ones are skipped)
+and `run()` renders it on the main thread, paced to a target FPS, by default
+the one of `fixed_delta_seconds` (0.04 -> 25 Hz). Frames can be downscaled and
+get an FPS/latency overlay.
+
+  viewer = Viewer('Stream', fixed_delta_seconds=settings.fixed_delta_seconds)
+  camera.listen(viewer.submit)
+  ...  # tick the world on another thread
+  viewer.run()  # until 'q', ESC or the window is closed
+"""
+
+import time
+
+import cv2
+
+import instrumentation
+from frame_pipeline import DROP_OLDEST, FrameQueue
+from image_utils import bgr_view
+
+
+class Viewer:
+  """Shows the latest submitted frame at a steady pace."""
+
+  def __init__(self, name='Stream', fps=None, fixed_delta_seconds=0.04, scale=1.0,
+               overlay=True, profiler=None):
+    self.name = name
+    self.fps = fps or 1.0 / fixed_delta_seconds
+    self.scale = scale
+    self.overlay = overlay
+    self.profiler = profiler or instrumentation.DISABLED
+    # Only the latest frame matters, a new one replaces what was not shown yet.
+    self.queue = FrameQueue(maxsize=1, policy=DROP_OLDEST)
+    self.rendered_count = 0
+    self._shown_fps = 0.0
+    self._last_render = None
+    self._window_open = False
+
+  def submit(self, frame):
+    """Hand a `carla.Image` or a BGR array to the viewer, from any thread."""
+    return self.queue.put((time.perf_counter(), frame))
+
+  def run(self, should_stop=lambda: False):
+    """Render on the calling (main) thread until `should_stop()`, 'q' or ESC."""
+    period = 1.0 / self.fps
+    next_render = time.perf_counter()
+    try:
+      while not should_stop():
+        if not self._window_open:
+          # Without a window waitKey() returns at once, block on the queue
+          # until the first frame instead of spinning.
+          item = self.queue.get(timeout=period)
+          if item is not None:
+            next_render = time.perf_counter() + period
+            self._render(*item)
+          continue
+        # waitKey() is our sleep, the window stays responsive while waiting.
+        delay_ms = max(1, int((next_render - time.perf_counter()) * 1000))
+        if (cv2.waitKey(delay_ms) & 0xFF) in (ord('q'), 27):
+          break
+        if self._window_open and cv2.getWindowProperty(self.name, cv2.WND_PROP_VISIBLE) < 1:
+          break
+        now = time.perf_counter()
+        if now < next_render:
+          continue
+        item = self.queue.get(timeout=0)
+        if item is None:
+          continue  # Nothing new, the last frame stays on screen.
+        # Keep the pace, but don't try to catch up after a slow frame.
+        next_render = max(next_render + period, now)
+        self._render(*item)
+    finally:
+      self.queue.close()
+      if self._window_open:
+        cv2.destroyWindow(self.name)
+        self._window_open = False
+
+  def _render(self, submitted, frame):
+    with self.profiler.timed('convert'):
+      img = bgr_view(frame) if hasattr(frame, 'raw_data') else frame
+      if self.scale != 1.0:
+        img = cv2.resize(img, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+    with self.profiler.timed('display'):
+      now = time.perf_counter()
+      if self._last_render is not None:
+        # Smoothed, so the number is readable.
+        self._shown_fps = 0.9 * self._shown_fps + 0.1 / max(now - self._last_render, 1e-6)
+      self._last_render = now
+      if self.overlay:
+        if not img.flags.writeable or img.base is not None:
+          img = img.copy()  # Never draw into the camera buffer.
+        text = f'{self._shown_fps:5.1f} FPS  {(now - submitted) * 1e3:5.1f} ms'
+        cv2.putText(img, text, (10, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+      cv2.imshow(self.name, img)
+      self._window_open = True
+      self.rendered_count += 1
+
+  def stats(self):
+    stats = self.queue.stats()
+    stats['rendered'] = self.rendered_count
+    stats['fps'] = self._shown_fps
+    return stats
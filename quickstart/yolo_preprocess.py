@@ -0,0 +1,186 @@
+"""
+Letterbox camera frames straight into a reused NCHW float batch for YOLOv5.
+
+Given a list of frames, the AutoShape wrapper (`model(list_of_rgb)`) letterboxes
+each one with new arrays, stacks them, transposes, converts to float and divides
+by 255, all of it allocated again on every call, which on a CPU-only box takes
+about as long as a small model. `Preprocessor` does it in one pass per
+frame: the BGRA (or BGR) frame is resized as it is, and the three color planes
+are written scaled and in RGB order into their place in a preallocated batch.
+The gray padding is filled once, when the buffer is allocated, since the
+frames keep the same size.
+
+  pre = Preprocessor(800, 600, size=640)
+  batch = pre([bgra_view(img) for img in images])  # (N, 3, 512, 640) view
+  det = pre.scale_boxes(det)  # letterboxed pixels -> camera pixels
+
+`LetterboxModel` puts it in front of the raw network of an AutoShape model,
+with NMS after it, and can replace the model of a `BatchedDetector`:
+
+  model = LetterboxModel(load_yolo('yolov5l6'), 800, 600)
+  detector = BatchedDetector(model, postprocess=list)
+  detector.submit(to_bgr(img), img.frame)  # BGR or BGRA, no RGB copy needed
+  detector.submit(to_bgr(img), img.frame, scale=0.5)  # On a 320 letterbox
+"""
+
+import cv2
+import numpy as np
+
+PAD_VALUE = 114  # The gray of YOLOv5 letterboxing
+_INV_255 = np.float32(1 / 255.0)
+
+
+def letterbox_shape(width, height, size=640, stride=64):
+  """(scale, (new_w, new_h), (left, top), (batch_w, batch_h)) of letterboxing.
+
+  The longer side becomes `size`, the shorter one is padded to a multiple of
+  `stride`, like the rectangular inference of YOLOv5.
+  """
+  scale = min(size / width, size / height)
+  new_w, new_h = int(round(width * scale)), int(round(height * scale))
+  batch_w = int(np.ceil(new_w / stride) * stride)
+  batch_h = int(np.ceil(new_h / stride) * stride)
+  return scale, (new_w, new_h), ((batch_w - new_w) // 2, (batch_h - new_h) // 2), (batch_w, batch_h)
+
+
+class Preprocessor:
+  """Writes frames of one size into a letterboxed, normalized NCHW batch buffer.
+
+  The returned batch is a view of the buffer, valid until the next call. Not
+  for use from several threads at once, and one size only: to change the size
+  per batch (like `LetterboxModel`) keep one `Preprocessor` per size, used from
+  the thread that runs the model, and pass the size with each call instead of
+  setting it from another thread between batches.
+  """
+
+  def __init__(self, width, height, size=640, stride=64, max_batch_size=8,
+               pin_memory=False):
+    """`pin_memory` allocates the buffer in page-locked memory (needs torch),
+    for faster copies to a CUDA device."""
+    self.width = width
+    self.height = height
+    self.scale, self.new_size, self.pad, self.batch_size = letterbox_shape(
+        width, height, size, stride)
+    batch_w, batch_h = self.batch_size
+    shape = (max_batch_size, 3, batch_h, batch_w)
+    if pin_memory:
+      import torch  # Only needed for pinned buffers
+      self._tensor = torch.empty(shape, dtype=torch.float32).pin_memory()
+      self.buffer = self._tensor.numpy()
+    else:
+      self._tensor = None
+      self.buffer = np.empty(shape, dtype=np.float32)
+    self.buffer.fill(PAD_VALUE / 255.0)
+    new_w, new_h = self.new_size
+    left, top = self.pad
+    self._content = self.buffer[:, :, top:top + new_h, left:left + new_w]
+    self._resized = {c: np.empty((new_h, new_w, c), dtype=np.uint8) for c in (3, 4)}
+    # Counters, only for reading.
+    self.frame_count = 0
+
+  def __call__(self, frames):
+    """(N, 3, H, W) float32 RGB batch in [0, 1] of BGRA or BGR `frames`."""
+    if len(frames) > len(self.buffer):
+      raise ValueError(f'{len(frames)} frames, the buffer holds {len(self.buffer)}')
+    for i, frame in enumerate(frames):
+      if frame.shape[:2] != (self.height, self.width):
+        raise ValueError(f'Frame of {frame.shape[1]}x{frame.shape[0]}, '
+                         f'expected {self.width}x{self.height}')
+      resized = self._resized[frame.shape[2]]
+      cv2.resize(frame, self.new_size, dst=resized, interpolation=cv2.INTER_LINEAR)
+      # B, G, R are the first channels of BGRA and BGR alike, read backwards.
+      for c in range(3):
+        np.multiply(resized[:, :, 2 - c], _INV_255, out=self._content[i, c])
+    self.frame_count += len(frames)
+    return self.buffer[:len(frames)]
+
+  def tensor(self, n):
+    """The first `n` frames of the buffer as a torch tensor, no copy."""
+    if self._tensor is not None:
+      return self._tensor[:n]
+    import torch  # Only needed here
+    return torch.from_numpy(self.buffer[:n])
+
+  def scale_boxes(self, det):
+    """(N, 6) detections from letterboxed to camera pixels, in place."""
+    left, top = self.pad
+    det[:, [0, 2]] = np.clip((det[:, [0, 2]] - left) / self.scale, 0, self.width)
+    det[:, [1, 3]] = np.clip((det[:, [1, 3]] - top) / self.scale, 0, self.height)
+    return det
+
+
+def nms(pred, conf_thres=0.25, iou_thres=0.45, classes=None, max_det=1000):
+  """(N, 6) x1, y1, x2, y2, conf, class per image of raw YOLOv5 output.
+
+  `pred` is (B, anchors, 5 + classes), boxes as cx, cy, w, h, scores are
+  objectness times class probability, as in yolov5 `non_max_suppression`.
+  """
+  from torchvision.ops import batched_nms  # torch is only needed here
+  output = []
+  for x in pred:
+    x = x[x[:, 4] > conf_thres]
+    scores, cls = (x[:, 5:] * x[:, 4:5]).max(1)
+    keep = scores > conf_thres
+    if classes is not None:
+      keep &= (cls[:, None] == cls.new_tensor(classes)).any(1)
+    x, scores, cls = x[keep], scores[keep], cls[keep]
+    boxes = x[:, :4].clone()
+    boxes[:, :2] = x[:, :2] - x[:, 2:4] / 2
+    boxes[:, 2:] = x[:, :2] + x[:, 2:4] / 2
+    i = batched_nms(boxes, scores, cls, iou_thres)[:max_det]
+    det = np.empty((len(i), 6), dtype=np.float32)
+    det[:, :4] = boxes[i].float().cpu().numpy()
+    det[:, 4] = scores[i].float().cpu().numpy()
+    det[:, 5] = cls[i].float().cpu().numpy()
+    output.append(det)
+  return output
+
+
+class LetterboxModel:
+  """An AutoShape model with its preprocessing done by a `Preprocessor`.
+
+  Called with a list of BGRA or BGR frames (and the `scale` of the letterbox
+  size for them), returns one (N, 6) array of x1, y1, x2, y2, conf, class in
+  camera pixels per frame. `conf`, `iou`, `classes` and `max_det` of the
+  AutoShape model are used for NMS.
+  """
+
+  def __init__(self, model, width, height, size=640, max_batch_size=8):
+    import torch  # Only needed here
+    self.model = model
+    self.names = model.names
+    try:
+      device = next(model.parameters()).device
+    except StopIteration:  # An exported model without torch parameters
+      device = torch.device('cpu')
+    self.device = device
+    self.width = width
+    self.height = height
+    self.size = size
+    self.max_batch_size = max_batch_size
+    self.stride = int(max(getattr(model, 'stride', [64])))
+    self._preprocessors = {}  # Letterbox size -> Preprocessor, one per scale used
+
+  def _preprocessor(self, scale):
+    size = max(self.stride, int(round(self.size * scale / self.stride)) * self.stride)
+    if size not in self._preprocessors:
+      self._preprocessors[size] = Preprocessor(
+          self.width, self.height, size, self.stride, self.max_batch_size,
+          pin_memory=self.device.type == 'cuda')
+    return self._preprocessors[size]
+
+  def __call__(self, frames, scale=1.0):
+    """`scale` times the letterbox size, e.g. 0.5 when inference falls behind."""
+    import torch  # Only needed here
+    preprocessor = self._preprocessor(scale)
+    preprocessor(frames)
+    batch = preprocessor.tensor(len(frames)).to(self.device, non_blocking=True)
+    with torch.no_grad():
+      # AutoShape passes tensors straight to the network.
+      pred = self.model(batch)
+    if isinstance(pred, (list, tuple)):
+      pred = pred[0]
+    model = self.model
+    detections = nms(pred, getattr(model, 'conf', 0.25), getattr(model, 'iou', 0.45),
+                     getattr(model, 'classes', None), getattr(model, 'max_det', 1000))
+    return [preprocessor.scale_boxes(det) for det in detections]
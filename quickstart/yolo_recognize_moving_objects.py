@@ -2,93 +2,97 @@
 1. Create a main_vehicle and camera
 2. Create random cars in the map
 3. Use YOLO try to recognize them.
+
+Frames are recorded in chunks, and every finished chunk is encoded and run
+through both YOLO models while the simulation goes on. YOLO only runs on
+every `DETECT_EVERY`th frame, the frames between get the boxes of a tracker,
+with an id per car and its trajectory. If the run is interrupted, start it
+again and it resumes after the last finished chunk.
 """
 
 import random
-import subprocess
 from pathlib import Path
 
 import cv2
-import torch
-import numpy as np
 from absl import app
 
 import carla
 
+from actor_registry import ActorRegistry
+from image_utils import bgra_view
+from model_registry import load_yolo
+from resumable_run import ResumableRun, load_trajectories
+from tick_driver import TickDriver
+from traffic import spawn_npcs
+
 SYNC_MASTER = True
 USE_CUDA_IN_FFMPEG = True  # Set 'False' if you don't need CUDA.
 MAX_NUM = 2000  # Number to take pictures from camera.
-IMAGE_FOLDER = '../tmp'
-OUT_VIDEO_RAW = f'{IMAGE_FOLDER}/{Path(__file__).stem}.mp4'
-# Set output path for the video
-# Processed video will be stored under 'YOLO_VIDEO_PROJECT/YOLO_VIDEO_FOLDER'
-YOLO_VIDEO_PROJECT = f'../out/{Path(__file__).stem}'
-YOLO_VIDEO_FOLDER = 'model'
-YOLO_DETECT = Path('../../../common/yolov5/detect.py')
+IMAGE_WIDTH = 800
+IMAGE_HEIGHT = 600
+CHUNK_FRAMES = 250  # Frames per checkpointed chunk.
+DETECT_EVERY = 5  # YOLO on one frame out of 5, tracked in between (a divisor of CHUNK_FRAMES)
+# Frames, per-chunk segments, detections and the final videos go here, e.g.
+# 'RUN_DIR/video.mp4', 'RUN_DIR/detect_yolov5l6.mp4', 'RUN_DIR/detect_yolov5l6_ft.mp4'
+RUN_DIR = f'../out/{Path(__file__).stem}'
 random.seed(2)
 
-model = None  # YOLO model
-count = 0  # Taken picture count
-actor_list = []
+models = {}  # YOLO models, by weights name
+actors = None  # ActorRegistry, owns every actor we spawn
 world = None  # Carla world object
-
-def show_image(carla_img):
-    """Stream the view from camera."""
-    global count
-    carla_img.save_to_disk(f'{IMAGE_FOLDER}/{count:04}.png')
-    count += 1
+main_vehicle = None
+run = None  # Records the camera and post-processes it chunk by chunk
+
+def show_image(bundle):
+    """Stream the view from camera, `bundle` is the aligned data of one tick."""
+    carla_img = bundle.data['rgb']
+    if carla_img is None:
+        return
+    run.append(bgra_view(carla_img), bundle.frame, bundle.timestamp,
+               main_vehicle.get_transform())
+    count = len(run)
     if count % 100 == 0:
-        print(f'{count} pieces of image have been saved.')
-
-
-def make_video(input_dir, raw_video, yolo_project, yolo_folder):
-    subprocess.check_output(
-        f'ffmpeg {"-hwaccel cuda" if USE_CUDA_IN_FFMPEG else ""} -y -r 25 -s 800x600 -i {input_dir}/%04d.png -vcodec libx264 -crf 25 -pix_fmt yuv420p {raw_video}',
-        shell=True)
-    
-    # Fine tuned model
-    subprocess.check_output(
-        f'python {YOLO_DETECT} --source {raw_video} --weights yolov5l6.pt --conf 0.25 --project {yolo_project} --name {yolo_folder}',
-        shell=True)
+        print(f'{count} pieces of image have been recorded.')
 
-    # Original model
-    subprocess.check_output(
-        f'python {YOLO_DETECT} --source {raw_video} --weights yolov5l6_ft.pt --conf 0.5 --project {yolo_project} --name {yolo_folder}',
-        shell=True)
-
-def spawn_npc():
-    global actor_list
+def spawn_npc(client, tm, main_vehicle_transform):
+    global actors
     global world
 
-    blueprint_library = world.get_blueprint_library()
-    spawn_points = world.get_map().get_spawn_points()
-
-    # Create vehicles in random spawn points
+    # Create vehicles in random spawn points, all in one batch
     NUM_OF_VEHS = 100
-    for i in range(0, NUM_OF_VEHS):
-        # randomly pick a car and its position in the map
-        bp = random.choice(blueprint_library.filter('vehicle'))
-        init_main_transform = random.choice(spawn_points)
-
-        # This time we are using `try_spawn_actor()`. If the spot is already
-        # occupied by another object, the function will return None.
-        npc = world.try_spawn_actor(bp, init_main_transform)
-        if npc is not None:
-            actor_list.append(npc)
-            npc.set_autopilot(True)
-            print('created %s' % npc.type_id)
+    npcs = spawn_npcs(client,
+                      world,
+                      NUM_OF_VEHS,
+                      tm_port=tm.get_port(),
+                      exclude=[main_vehicle_transform])
+    actors.track(npcs)
 
 
 def init_yolo():
-    global model
-    # MODEL_STORAGE_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'model', 'pretrained')
-    # torch.hub.set_dir(MODEL_STORAGE_PATH)
-    model = torch.hub.load('ultralytics/yolov5', 'yolov5l6', pretrained=True)
+    global models
+    # Local weights from ../model/pretrained, warmed up with a frame of our size.
+    # Original model
+    models['yolov5l6'] = load_yolo('yolov5l6', warmup_size=(IMAGE_HEIGHT, IMAGE_WIDTH))
+    models['yolov5l6'].conf = 0.25
+    # Fine tuned model
+    models['yolov5l6_ft'] = load_yolo('yolov5l6_ft', warmup_size=(IMAGE_HEIGHT, IMAGE_WIDTH))
+    models['yolov5l6_ft'].conf = 0.5
 
 
 def main(argv):
-    global actor_list
+    global actors
     global world
+    global main_vehicle
+    global run
+
+    # The models are needed from the first finished chunk on.
+    init_yolo()
+    run = ResumableRun(RUN_DIR, (IMAGE_HEIGHT, IMAGE_WIDTH, 4),
+                       models,
+                       fps=25,
+                       chunk_frames=CHUNK_FRAMES,
+                       use_cuda=USE_CUDA_IN_FFMPEG,
+                       detect_every=DETECT_EVERY)
 
     try:
         # First of all, we need to create the client that will send the requests
@@ -98,72 +102,67 @@ def main(argv):
         client = carla.Client(host_ip, 2000)
         client.set_timeout(5.0)
 
-        # Once we have a client we can retrieve the world that is currently running.
-        world = client.get_world()
-        tm = client.get_trafficmanager()
-        settings = world.get_settings()
-
-        if SYNC_MASTER:
-            settings.fixed_delta_seconds = 0.04
-            settings.synchronous_mode = SYNC_MASTER  # (Required) Enables synchronous mode on world
-            tm.set_synchronous_mode(
-                SYNC_MASTER
-            )  # (Required) Enables synchronous mode on traffic manager
-            world.apply_settings(settings)
-
-        # The world contains the list blueprints that we can use for adding new
-        # actors into the simulation.
-        blueprint_library = world.get_blueprint_library()
-
-        #NOTE: the main vehicle is deterministic now
-        bp = blueprint_library.find('vehicle.tesla.model3')
-        main_vehicle_transform = random.choice(
-            world.get_map().get_spawn_points())
-        main_vehicle = world.spawn_actor(bp, main_vehicle_transform)
-        main_vehicle.set_autopilot(True)
-        actor_list.append(main_vehicle)
-        print('created %s' % main_vehicle.type_id)
-
-        # Let's add now a "depth" camera attached to the vehicle. Note that the
-        # transform we give here is now relative to the vehicle.
-        camera_bp = blueprint_library.find('sensor.camera.rgb')
-        camera_bp.set_attribute('image_size_x', '800')
-        camera_bp.set_attribute('image_size_y', '600')
-        # The vehicle model towards positive "x". Positive "z" is upward.
-        camera_transform = carla.Transform(carla.Location(x=2.3, z=1.2))
-        camera = world.spawn_actor(camera_bp,
-                                   camera_transform,
-                                   attach_to=main_vehicle)
-        actor_list.append(camera)
-        # When sensor gets data, it will process with `show_image()`
-        camera.listen(lambda data: show_image(data))
-        print('created %s' % camera.type_id)
-
-        # Prepare npcs to recognize
-        spawn_npc()
-
-        # Last, init YOLO model
-        init_yolo()
-
-        while True:
-            if count > MAX_NUM:
-                break
-            world.tick()
-
-    finally:
-        print('Disconnecting from server...')
-        if SYNC_MASTER:
-            settings = world.get_settings()
-            settings.synchronous_mode = False
-            settings.fixed_delta_seconds = None
-            world.apply_settings(settings)
-        print('Destroying actors')
-        camera.destroy()
-        client.apply_batch([carla.command.DestroyActor(x) for x in actor_list])
-        print('Done.')
-
-    # Collect processed images and make it a video
-    make_video(input_dir=IMAGE_FOLDER, raw_video=OUT_VIDEO_RAW, yolo_project=YOLO_VIDEO_PROJECT, yolo_folder=YOLO_VIDEO_FOLDER)
+        # Leaving this block, also with an exception, destroys every actor
+        # spawned through the registry and gets the server back to async mode.
+        with ActorRegistry(client, endpoint=f'{host_ip}:2000') as actors:
+            # Once we have a client we can retrieve the world that is currently running.
+            world = actors.world
+            tm = client.get_trafficmanager()
+
+            if SYNC_MASTER:
+                actors.enable_sync(0.04, tm)
+
+            # The world contains the list blueprints that we can use for adding new
+            # actors into the simulation.
+            blueprint_library = world.get_blueprint_library()
+
+            #NOTE: the main vehicle is deterministic now
+            bp = blueprint_library.find('vehicle.tesla.model3')
+            main_vehicle_transform = random.choice(
+                world.get_map().get_spawn_points())
+            main_vehicle = actors.spawn(bp, main_vehicle_transform)
+            main_vehicle.set_autopilot(True)
+            print('created %s' % main_vehicle.type_id)
+
+            # Let's add now a "depth" camera attached to the vehicle. Note that the
+            # transform we give here is now relative to the vehicle.
+            camera_bp = blueprint_library.find('sensor.camera.rgb')
+            camera_bp.set_attribute('image_size_x', str(IMAGE_WIDTH))
+            camera_bp.set_attribute('image_size_y', str(IMAGE_HEIGHT))
+            # The vehicle model towards positive "x". Positive "z" is upward.
+            camera_transform = carla.Transform(carla.Location(x=2.3, z=1.2))
+            camera = actors.spawn(camera_bp,
+                                  camera_transform,
+                                  attach_to=main_vehicle)
+            # Every tick waits for the camera frame of that tick, then hands it
+            # to `show_image()`, so no frame is lost or out of order.
+            driver = TickDriver(world)
+            driver.add_sensor('rgb', camera)
+            print('created %s' % camera.type_id)
+
+            # Prepare npcs to recognize
+            spawn_npc(client, tm, main_vehicle_transform)
+
+            # Only what is left, if this run resumes an interrupted one.
+            driver.run(show_image, max_ticks=max(0, MAX_NUM - len(run)))
+            print('Disconnecting from server...')
+    except BaseException:
+        # Still process what was recorded, but the error of the run is the one
+        # to see, not the chunks it left unfinished. The next run on RUN_DIR
+        # redoes them.
+        try:
+            run.close()
+        except Exception as e:
+            print(f'Closing {RUN_DIR} after the failure: {e!r}')
+        raise
+    # The camera is gone, process the last chunk and join the videos. Raises if
+    # a chunk failed, the next run on RUN_DIR redoes it.
+    run.close()
+
+    for name in models:
+        trajectories = load_trajectories(RUN_DIR, name)
+        print(f'{name}: {len(trajectories)} tracked objects')
+    print('Done.')
 
 
 if __name__ == '__main__':
@@ -2,62 +2,131 @@
 1. Create a main_vehicle and camera
 2. Create another car in front of it
 3. Use YOLO try to recognize the front car.
+4. Measure how far each detected object is, with a depth camera.
+
+Frames are only submitted to a `BatchedDetector` from the tick, YOLO runs on
+its own thread and the results are shown after the run. `LetterboxModel`
+letterboxes the BGR frames into a reused batch, instead of AutoShape. The depth
+frame of the same tick is kept by `DepthFusion`, which gives the distance of
+every box.
+
+An `AdaptiveScheduler` holds `TARGET_FPS`: under load YOLO skips frames (they
+are shown with the last detections), runs on smaller frames, or the tick gets
+longer, every change is logged to `SCHEDULER_LOG`.
 """
 
 import random
+import time
 
 import cv2
-import torch
-import numpy as np
 from absl import app
 
 import carla
 
+from actor_registry import ActorRegistry
+from adaptive_scheduler import AdaptiveScheduler
+from depth_fusion import DepthFusion
+from image_utils import to_bgr
+from model_registry import load_yolo
+from tick_driver import TickDriver
+from yolo_preprocess import LetterboxModel
+from yolo_worker import BatchedDetector
+
 SYNC_MASTER = True
 MAX_NUM = 2
+IMAGE_WIDTH = 800
+IMAGE_HEIGHT = 600
+MAX_BATCH_SIZE = 2  # Frames run through YOLO together
+MAX_BATCH_WAIT = 0.05  # Seconds the first frame of a batch may wait for others
+TARGET_FPS = 25  # Frames per second the scheduler holds, YOLO included
+SCHEDULER_LOG = '../out/yolo_recognize_static_objects/scheduler.jsonl'
 random.seed(10)
 
 # YOLO model
 model = None
-count = 0
+detector = None
+fusion = None  # Depth of the recent frames, to measure the detections
+scheduler = None  # Decides which frames go to YOLO, and at which scale
+submitted = []  # (frame, BGR np_img, future of detections or None if skipped)
+submit_times = {}  # frame -> when it went to YOLO, for the detection latency
+ranges = {}  # frame -> [ObjectRange], filled on the detector thread
 
-def show_image(carla_img):
-  """Stream the view from camera."""
-  global count 
-  global model
-  count += 1
-  np_img = np.array(carla_img.raw_data, dtype=np.uint8).reshape((600, 800, 4))#[:,:,:3]
-  np_img = cv2.cvtColor(np_img, cv2.COLOR_BGR2RGB)
-  res = model(np_img)
-  res.show()
+def show_image(bundle):
+  """Stream the view from camera, `bundle` has the rgb and depth of one tick."""
+  carla_img, depth_img = bundle.data['rgb'], bundle.data['depth']
+  if carla_img is None:
+    return
+  if depth_img is not None:
+    fusion.add_depth(depth_img)
+  plan = scheduler.tick(carla_img.frame)
+  np_img = to_bgr(carla_img)
+  future = None
+  if plan.detect:
+    submit_times[carla_img.frame] = time.perf_counter()
+    # The scale goes with the frame, the detector may still run older ones.
+    future = detector.submit(np_img, carla_img.frame, 'front', callback=print_detections,
+                             scale=plan.scale)
+    future.add_done_callback(lambda f, frame_id=carla_img.frame: forget_submit(frame_id, f))
+  submitted.append((carla_img.frame, np_img, future))
+
+def forget_submit(frame_id, future):
+  """A dropped or failed frame never gets to `print_detections()`, forget it here."""
+  if future.cancelled() or future.exception() is not None:
+    submit_times.pop(frame_id, None)
+
+def print_detections(frame_id, camera, det):
+  """Called on the detector thread, `det` rows are x1, y1, x2, y2, conf, class."""
+  scheduler.record('detect', time.perf_counter() - submit_times.pop(frame_id))
+  objects = fusion.fuse(frame_id, det)
+  if objects is None:
+    names = [model.names[int(c)] for c in det[:, 5]]
+    print(f'frame {frame_id} ({camera}): {len(det)} objects {names}, no depth')
+    return
+  ranges[frame_id] = objects
+  found = [f'{model.names[o.cls]} {o.distance:.1f} m' for o in objects]
+  print(f'frame {frame_id} ({camera}): {len(det)} objects {found}')
+
+def draw_detections(np_img, det, objects=None):
+  """Draw the boxes (and distances) on a copy of the BGR frame."""
+  img = np_img.copy()
+  distances = [o.distance for o in objects] if objects else [None] * len(det)
+  for (x1, y1, x2, y2, conf, cls), distance in zip(det, distances):
+    label = f'{model.names[int(cls)]} {conf:.2f}'
+    if distance is not None:
+      label += f' {distance:.1f} m'
+    cv2.rectangle(img, (int(x1), int(y1)), (int(x2), int(y2)), (0, 255, 0), 2)
+    cv2.putText(img, label, (int(x1), int(y1) - 4),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+  return img
 
 def init_yolo():
   global model
-  # MODEL_STORAGE_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'model', 'pretrained')
-  # torch.hub.set_dir(MODEL_STORAGE_PATH)
-  model = torch.hub.load('ultralytics/yolov5', 'yolov5l6', pretrained=True)
+  # Local weights from ../model/pretrained, warmed up with a frame of our size.
+  model = load_yolo('yolov5l6', warmup_size=(IMAGE_HEIGHT, IMAGE_WIDTH))
+  # Letterboxes straight into a reused batch, boxes come back in camera pixels.
+  model = LetterboxModel(model, IMAGE_WIDTH, IMAGE_HEIGHT, max_batch_size=MAX_BATCH_SIZE)
 
 def main(argv):
-  actor_list = []
+  global detector
+  global fusion
+  global scheduler
 
-  try:
-    # First of all, we need to create the client that will send the requests
-    # to the simulator. Here we'll assume the simulator is accepting
-    # requests in the localhost at port 2000.
-    host_ip = '127.0.0.1'
-    client = carla.Client(host_ip, 2000)
-    client.set_timeout(5.0)
+  # First of all, we need to create the client that will send the requests
+  # to the simulator. Here we'll assume the simulator is accepting
+  # requests in the localhost at port 2000.
+  host_ip = '127.0.0.1'
+  client = carla.Client(host_ip, 2000)
+  client.set_timeout(5.0)
 
+  # Leaving this block, also with an exception, destroys every actor spawned
+  # through the registry and gets the server back to the async mode.
+  with ActorRegistry(client, endpoint=f'{host_ip}:2000') as actors:
     # Once we have a client we can retrieve the world that is currently running.
-    world = client.get_world()
+    world = actors.world
     tm = client.get_trafficmanager()
-    settings = world.get_settings()
     
     if SYNC_MASTER:
-      settings.fixed_delta_seconds = 0.04
-      settings.synchronous_mode = SYNC_MASTER  # (Required) Enables synchronous mode on world
-      tm.set_synchronous_mode(SYNC_MASTER)  # (Required) Enables synchronous mode on traffic manager
-      world.apply_settings(settings)
+      actors.enable_sync(0.04, tm)
 
     # The world contains the list blueprints that we can use for adding new
     # actors into the simulation.
@@ -66,52 +135,73 @@ def main(argv):
     #NOTE: the main vehicle is deterministic now
     bp = blueprint_library.find('vehicle.tesla.model3')
     main_vehicle_transform = random.choice(world.get_map().get_spawn_points())
-    main_vehicle = world.spawn_actor(bp, main_vehicle_transform)
-    actor_list.append(main_vehicle)
+    main_vehicle = actors.spawn(bp, main_vehicle_transform)
     print('created %s' % main_vehicle.type_id)
 
     # Let's add now a "depth" camera attached to the vehicle. Note that the
     # transform we give here is now relative to the vehicle.
     camera_bp = blueprint_library.find('sensor.camera.rgb')
-    camera_bp.set_attribute('image_size_x', '800')
-    camera_bp.set_attribute('image_size_y', '600')
+    camera_bp.set_attribute('image_size_x', str(IMAGE_WIDTH))
+    camera_bp.set_attribute('image_size_y', str(IMAGE_HEIGHT))
     # The vehicle model towards positive "x". Positive "z" is upward. 
     camera_transform = carla.Transform(carla.Location(x=1.2, z=1.2))
-    camera = world.spawn_actor(camera_bp, camera_transform, attach_to=main_vehicle)
-    actor_list.append(camera)
-    # When sensor gets data, it will process with `show_image()`
-    camera.listen(lambda data: show_image(data))
+    camera = actors.spawn(camera_bp, camera_transform, attach_to=main_vehicle)
     print('created %s' % camera.type_id)
+
+    # A depth camera at the same place, its frames line up with the rgb ones.
+    depth_bp = blueprint_library.find('sensor.camera.depth')
+    depth_bp.set_attribute('image_size_x', str(IMAGE_WIDTH))
+    depth_bp.set_attribute('image_size_y', str(IMAGE_HEIGHT))
+    depth_camera = actors.spawn(depth_bp, camera_transform, attach_to=main_vehicle)
+    print('created %s' % depth_camera.type_id)
+    fusion = DepthFusion(IMAGE_WIDTH, IMAGE_HEIGHT, fov=float(depth_bp.get_attribute('fov')))
     
     # Create vehicles in front of the `main_vehicle`
     front_car_bp = blueprint_library.find('vehicle.nissan.patrol')
     front_car_transform = main_vehicle_transform
     front_car_transform.location.y += -6
     front_car_transform.location.z += 0.1
-    front_car = world.spawn_actor(front_car_bp, front_car_transform)
-    actor_list.append(front_car)
+    front_car = actors.spawn(front_car_bp, front_car_transform)
     print('created %s' % front_car.type_id)
       
     # Last, init YOLO model
     init_yolo()
-    
-    while True:
-      if count >= MAX_NUM:
-        break
-      world.tick()
-    
-  finally:
+    detector = BatchedDetector(model, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT,
+                               postprocess=list)
+    # Detections may lag 5 frames at most, before YOLO is given less to do.
+    scheduler = AdaptiveScheduler(TARGET_FPS, world=world if SYNC_MASTER else None,
+                                  fixed_delta_seconds=0.04,
+                                  stage_budgets={'detect': 5.0 / TARGET_FPS},
+                                  log_path=SCHEDULER_LOG)
+
+    # Every tick hands `show_image()` the rgb and depth frames of that tick.
+    driver = TickDriver(world)
+    driver.add_sensor('rgb', camera)
+    driver.add_sensor('depth', depth_camera)
+    driver.run(show_image, max_ticks=MAX_NUM)
     print('Disconnecting from server...')
-    if SYNC_MASTER:
-      settings = world.get_settings()
-      settings.synchronous_mode = False
-      settings.fixed_delta_seconds = None
-      world.apply_settings(settings)
-    print('Destroying actors')
-    cv2.destroyAllWindows()
-    camera.destroy()
-    client.apply_batch([carla.command.DestroyActor(x) for x in actor_list])
-    print('Done.')
+  print('Done.')
+
+  # Wait for YOLO and show what it found.
+  if detector is not None:
+    detector.close()
+    print('Detector: %s' % detector.stats())
+  if scheduler is not None:
+    print('Scheduler: %s' % scheduler.stats())
+  # Skipped frames are shown with the detections of the last detected one.
+  det, objects = None, None
+  for frame_id, np_img, future in submitted:
+    if future is not None:
+      if future.cancelled():
+        continue
+      if future.exception() is not None:
+        print(f'frame {frame_id}: detection failed: {future.exception()!r}')
+        continue
+      det, objects = future.result(), ranges.get(frame_id)
+    if det is not None:
+      cv2.imshow('YOLO', draw_detections(np_img, det, objects))
+      cv2.waitKey(0)
+  cv2.destroyAllWindows()
 
 if __name__ == '__main__':
   app.run(main)
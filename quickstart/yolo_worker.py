@@ -0,0 +1,133 @@
+"""
+Batched, asynchronous YOLO inference for live camera streams.
+
+The sensor callback only submits the frame and gets a `Future` back, the model
+runs on its own thread. Frames from one or more cameras are collected into
+micro-batches, a batch is run once it has `max_batch_size` frames or its first
+frame has waited `max_wait` seconds, so the simulator tick never waits on the
+detector. `options` of a frame are passed to the model as keyword arguments,
+a batch only holds frames with the same options.
+
+  detector = BatchedDetector(model, max_batch_size=4, max_wait=0.02)
+  camera.listen(lambda img: detector.submit(to_rgb(img), img.frame, 'front',
+                                            callback=on_detections))
+  ...
+  detector.close()
+"""
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+import instrumentation
+from frame_pipeline import DROP_OLDEST, FrameQueue
+
+# One submitted frame, `camera` tells where it comes from when several cameras
+# share the detector, `options` are the keyword arguments of the model call.
+Request = collections.namedtuple('Request', ['frame_id', 'camera', 'frame', 'future', 'callback',
+                                             'options'])
+
+
+def yolov5_xyxy(results):
+  """Split YOLOv5 `Detections` into one (N, 6) array per image.
+
+  Columns are x1, y1, x2, y2, confidence, class.
+  """
+  return [det.cpu().numpy() for det in results.xyxy]
+
+
+class BatchedDetector:
+  """Runs `model(list_of_frames)` on micro-batches on a dedicated thread."""
+
+  def __init__(self, model, max_batch_size=8, max_wait=0.02, queue_size=32,
+               policy=DROP_OLDEST, postprocess=yolov5_xyxy, profiler=None):
+    self.model = model
+    self.profiler = profiler or instrumentation.DISABLED
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait
+    self.postprocess = postprocess
+    self.queue = FrameQueue(maxsize=queue_size, policy=policy, on_drop=self._cancel)
+    self._carry = None  # A request with other options than its batch, it starts the next one
+    # Counters, only for reading.
+    self.batch_count = 0
+    self.frame_count = 0
+    self._thread = threading.Thread(target=self._run, name='BatchedDetector', daemon=True)
+    self._thread.start()
+
+  def submit(self, frame, frame_id, camera=None, callback=None, **options):
+    """Queue a frame for detection, never blocks (unless policy is BLOCK).
+
+    Returns a `Future` of the detections of this frame, it is cancelled if the
+    frame gets dropped. `callback(frame_id, camera, detections)` is called on
+    the detector thread once the detections are ready. The frame is run with
+    `model(frames, **options)`, e.g. `scale=0.5` for a `LetterboxModel`.
+    """
+    future = concurrent.futures.Future()
+    self.queue.put(Request(frame_id, camera, frame, future, callback, options))
+    return future
+
+  @staticmethod
+  def _cancel(request):
+    request.future.cancel()
+
+  def _next_batch(self):
+    first, self._carry = self._carry, None
+    if first is None:
+      first = self.queue.get(timeout=0.1)
+    if first is None:
+      return []
+    batch = [first]
+    deadline = time.perf_counter() + self.max_wait
+    while len(batch) < self.max_batch_size:
+      remaining = deadline - time.perf_counter()
+      if remaining <= 0:
+        break
+      request = self.queue.get(timeout=remaining)
+      if request is None:
+        break
+      if request.options != first.options:
+        self._carry = request
+        break
+      batch.append(request)
+    return batch
+
+  def _run(self):
+    while True:
+      batch = self._next_batch()
+      if not batch:
+        if self.queue.closed and not len(self.queue) and self._carry is None:
+          break
+        continue
+      # Dropped frames may have been cancelled in the meantime, skip them.
+      batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+      if not batch:
+        continue
+      try:
+        with self.profiler.timed('inference'):
+          detections = self.postprocess(self.model([r.frame for r in batch], **batch[0].options))
+      except Exception as e:
+        for request in batch:
+          request.future.set_exception(e)
+        continue
+      self.batch_count += 1
+      self.frame_count += len(batch)
+      for request, det in zip(batch, detections):
+        request.future.set_result(det)
+        if request.callback is not None:
+          try:
+            request.callback(request.frame_id, request.camera, det)
+          except Exception as e:  # A bad callback should not stop the detector.
+            print(f'Detection callback failed on frame {request.frame_id}: {e!r}')
+
+  def close(self, timeout=None):
+    """Finish the queued frames and stop the detector thread."""
+    self.queue.close()
+    self._thread.join(timeout)
+
+  def stats(self):
+    stats = self.queue.stats()
+    stats['batches'] = self.batch_count
+    stats['frames'] = self.frame_count
+    stats['avg_batch'] = self.frame_count / self.batch_count if self.batch_count else 0.0
+    return stats